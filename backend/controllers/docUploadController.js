@@ -17,6 +17,7 @@ const modelClustering = require("../models/modelClustering");
 const { generateKeywords } = require("../models/modelKeywords");
 const File = require("../../database/File.js");
 const sequelize = require("../../sequelize.config.js");
+const { Op } = require("sequelize");
 const folderSuggestion = require("../models/modelFolderSuggestion");
 
 /**
@@ -97,13 +98,6 @@ exports.uploadFile = async (req, res) => {
     const fileId = newFile.file_id;
     await generateKeywordsInBackground(textContent, fileId);
 
-    const allEmbeddings = await File.findAll({
-      attributes: ["file_id", "embedding"],
-    });
-
-    const existingEmbeddings = allEmbeddings.map((item) => item.embedding);
-    existingEmbeddings.push(embedding);
-
     // Clustering parameters
     const defaultParams = {
       minClusterSize: 3,
@@ -114,6 +108,74 @@ exports.uploadFile = async (req, res) => {
       semanticThreshold: 0.52,
     };
 
+    // Mit CLUSTERING_ASSIGN=true wird das neue Dokument nur dem passenden gespeicherten
+    // Cluster zugeordnet, statt alle Dokumente neu zu clustern
+    if (process.env.CLUSTERING_ASSIGN === "true" && !clusteringParams) {
+      try {
+        const assignment = await modelClustering.assignDocument(
+          embedding,
+          userId,
+          folderIdToUse
+        );
+        await File.update(
+          { cluster_label: assignment.label },
+          { where: { file_id: fileId } }
+        );
+
+        return res.status(201).json({
+          message: "File uploaded successfully",
+          fileId: fileId,
+          clusteringResults: {
+            assignedCluster: assignment.label,
+            probability: assignment.probability,
+            similarDocuments: assignment.exemplars,
+          },
+          folderSuggestions: {
+            topAffinities: Object.entries(assignment.folderAffinities)
+              .sort(([, a], [, b]) => b - a)
+              .slice(0, 5)
+              .map(([folderId, score]) => ({
+                folderId,
+                score: Math.round(score * 100) / 100,
+              })),
+          },
+        });
+      } catch (assignError) {
+        // z.B. noch keine gespeicherte Zusammenfassung: vollständig clustern
+        console.error("Cluster assignment failed, running full clustering:", assignError);
+      }
+    }
+
+    // Mit CLUSTERING_SCHEDULER=true wird das Clustering nur eingeplant: Der Clustering-Server fasst
+    // die Anfragen vieler gleichzeitiger Uploads eines Benutzers zu einem Clustering zusammen
+    if (process.env.CLUSTERING_SCHEDULER === "true" && !clusteringParams) {
+      const scheduled = await modelClustering.scheduleClustering(
+        defaultParams,
+        userId
+      );
+      return res.status(201).json({
+        message: "File uploaded successfully",
+        fileId: fileId,
+        clusteringResults: {
+          scheduled: true,
+          generation: scheduled.generation,
+          state: scheduled.state,
+        },
+      });
+    }
+
+    // Only the user's own files; the new file is appended below as the last row
+    const allEmbeddings = await File.findAll({
+      attributes: ["file_id", "embedding", "cluster_label"],
+      where: {
+        user_id: userId,
+        file_id: { [Op.ne]: fileId },
+      },
+      order: [["file_id", "ASC"]],
+    });
+
+    const existingEmbeddings = allEmbeddings.map((item) => item.embedding);
+    existingEmbeddings.push(embedding);
 
     const clusteringConfig = {
       ...defaultParams,
@@ -127,25 +189,38 @@ exports.uploadFile = async (req, res) => {
     );
     const clusteringResult = await modelClustering.runClustering(
       existingEmbeddings,
-      clusteringConfig,
+      {
+        ...clusteringConfig,
+        // Cluster an den bisherigen Labels ausrichten und nur geänderte Zeilen zurückgeben
+        previousLabels: [
+          ...allEmbeddings.map((item) => item.cluster_label),
+          null,
+        ],
+        labelDelta: true,
+        // Clustering des gesamten Bestands: Baum und Cluster-Zusammenfassung für recut/assign speichern
+        persistState: true,
+      },
       userId
     );
 
-    const clusterLabels = clusteringResult.labels;
+    const labelChanges = clusteringResult.labelChanges;
     const clusterStats = clusteringResult.clusterStats;
     const folderContext = clusteringResult.folderContext;
 
-    console.log("Clustering complete. Results:", clusterLabels);
-
-    // Update cluster labels
-    for (let i = 0; i < clusterLabels.length; i++) {
-      const fileIdToUpdate =
-        i < allEmbeddings.length ? allEmbeddings[i].file_id : fileId;
-      await File.update(
-        { cluster_label: clusterLabels[i] },
-        { where: { file_id: fileIdToUpdate } }
+    // Update only the cluster labels that changed
+    const changedFileIds =
+      labelChanges.fileIds ??
+      labelChanges.rows.map((row) =>
+        row < allEmbeddings.length ? allEmbeddings[row].file_id : fileId
       );
-    }
+    await modelClustering.writeClusterLabels(
+      changedFileIds,
+      labelChanges.labels
+    );
+
+    console.log(
+      `Clustering complete. ${changedFileIds.length} of ${clusterStats.documents} labels changed`
+    );
 
     res.status(201).json({
       message: "File uploaded successfully",
@@ -154,14 +229,15 @@ exports.uploadFile = async (req, res) => {
         totalDocuments: allEmbeddings.length + 1,
         uniqueClusters: clusterStats.num_clusters,
         noisePoints: clusterStats.noise_points,
-        assignedCluster: clusterLabels[clusterLabels.length - 1],
+        // The new document has no previous label, so it is always among the changes
+        assignedCluster: labelChanges.labels[changedFileIds.indexOf(fileId)],
         clusterSizes: clusterStats.cluster_sizes,
       },
       ...(folderContext && {
         folderSuggestions: {
           statistics: folderContext.statistics,
           topAffinities: Object.entries(
-            folderContext.affinities[clusterLabels.length - 1] || {}
+            folderContext.affinities[allEmbeddings.length] || {}
           )
             .sort(([, a], [, b]) => b - a)
             .slice(0, 5)
@@ -181,6 +257,104 @@ exports.uploadFile = async (req, res) => {
   }
 };
 
+/**
+ * Wählt die Cluster des Benutzers mit neuen Parametern aus dem gespeicherten Clustering-Baum
+ * neu aus, ohne neu zu clustern (für interaktives Einstellen der Parameter in der UI).
+ * Die neuen Cluster werden an den gespeicherten Labels ausgerichtet; liefert das Ergebnis die
+ * Datei-IDs mit, werden nur die geänderten Labels gespeichert.
+ *
+ * @async
+ * @function recutClusters
+ * @param {Object} req - Das Request-Objekt mit `minClusterSize`, `clusterSelectionMethod` und/oder `clusterSelectionEpsilon` im Body.
+ * @param {Object} res - Das Response-Objekt.
+ * @returns {Promise<void>} Antwort mit den neuen Clustering-Ergebnissen.
+ * @throws {Error} Falls kein gespeicherter Baum vorhanden ist oder ein Fehler auftritt.
+ */
+exports.recutClusters = async (req, res) => {
+  try {
+    const userId = req.session.userId;
+    const { minClusterSize, clusterSelectionMethod, clusterSelectionEpsilon } =
+      req.body;
+    const recutConfig = {
+      ...(minClusterSize !== undefined && { minClusterSize: Number(minClusterSize) }),
+      ...(clusterSelectionMethod !== undefined && { clusterSelectionMethod }),
+      ...(clusterSelectionEpsilon !== undefined && {
+        clusterSelectionEpsilon: Number(clusterSelectionEpsilon),
+      }),
+    };
+
+    // An den gespeicherten Labels ausrichten und nur geänderte Zeilen zurückgeben; cluster.py
+    // ordnet sie über die Datei-IDs des gespeicherten Baums zu
+    const storedLabels = await db.query(
+      "SELECT file_id, cluster_label FROM main.files WHERE user_id = $1",
+      [userId]
+    );
+    recutConfig.previousLabels = Object.fromEntries(
+      storedLabels.rows.map((row) => [row.file_id, row.cluster_label])
+    );
+    recutConfig.labelDelta = true;
+
+    const clusteringResult = await modelClustering.recutClustering(
+      recutConfig,
+      userId
+    );
+    const clusterStats = clusteringResult.clusterStats;
+    const labelChanges = clusteringResult.labelChanges;
+
+    if (labelChanges.fileIds) {
+      await modelClustering.writeClusterLabels(
+        labelChanges.fileIds,
+        labelChanges.labels
+      );
+    }
+
+    res.json({
+      labelsSaved: Boolean(labelChanges.fileIds),
+      changedLabels: labelChanges.rows.length,
+      clusteringResults: {
+        totalDocuments: clusterStats.documents,
+        uniqueClusters: clusterStats.num_clusters,
+        noisePoints: clusterStats.noise_points,
+        clusterSizes: clusterStats.cluster_sizes,
+      },
+    });
+  } catch (error) {
+    console.error("Error recutting clusters:", error);
+    res
+      .status(422)
+      .json({ message: "Error recutting clusters", error: error.message });
+  }
+};
+
+/**
+ * Liefert den Stand der eingeplanten Clusterings des Benutzers (CLUSTERING_SCHEDULER=true).
+ * Das Frontend fragt ihn nach einem Upload ab, bis `completedGeneration` die `generation`
+ * des Uploads erreicht; die Labels hat der Clustering-Server dann bereits gespeichert.
+ *
+ * @async
+ * @function clusteringStatus
+ * @param {Object} req - Das Request-Objekt, optional mit `since` (zuletzt bekannte Generation) in der Query.
+ * @param {Object} res - Das Response-Objekt.
+ * @returns {Promise<void>} Antwort mit `generation`, `state`, `completedGeneration` und ggf. `latest`.
+ * @throws {Error} Falls der Clustering-Server nicht aktiviert ist oder ein Fehler auftritt.
+ */
+exports.clusteringStatus = async (req, res) => {
+  try {
+    const userId = req.session.userId;
+    const since = parseInt(req.query.since, 10);
+    const status = await modelClustering.getClusteringStatus(
+      userId,
+      isNaN(since) ? 0 : since
+    );
+    res.json(status);
+  } catch (error) {
+    console.error("Error fetching clustering status:", error);
+    res
+      .status(422)
+      .json({ message: "Error fetching clustering status", error: error.message });
+  }
+};
+
 /**
  * Führt den "Smart Upload" durch: Die Datei wird hochgeladen, verarbeitet und erhält anschließend Ordnervorschläge.
  * 
@@ -257,7 +431,7 @@ exports.smartUploadFile = async (req, res) => {
 
     //holt die embeddings 
     const embeddingsQuery = `
-            SELECT file_id, embedding 
+            SELECT file_id, embedding, cluster_label
             FROM main.files 
             WHERE user_id = $1
         `;
@@ -297,28 +471,36 @@ exports.smartUploadFile = async (req, res) => {
     );
     const clusteringResult = await modelClustering.runClustering(
       existingEmbeddings,
-      clusteringConfig,
+      {
+        ...clusteringConfig,
+        // Cluster an den bisherigen Labels ausrichten und nur geänderte Zeilen zurückgeben
+        previousLabels: [
+          ...embeddingsResult.rows.map((row) => row.cluster_label),
+          null,
+        ],
+        labelDelta: true,
+        // Clustering des gesamten Bestands: Baum und Cluster-Zusammenfassung für recut/assign speichern
+        persistState: true,
+      },
       userId
     );
 
-    const clusterLabels = clusteringResult.labels;
+    const labelChanges = clusteringResult.labelChanges;
     const clusterStats = clusteringResult.clusterStats;
     const folderContext = clusteringResult.folderContext;
 
-    // Update cluster labels
-    for (let i = 0; i < clusterLabels.length; i++) {
-      const fileIdToUpdate =
-        i < embeddingsResult.rows.length
-          ? embeddingsResult.rows[i].file_id
-          : fileId;
-
-      const updateQuery = `
-                UPDATE main.files 
-                SET cluster_label = $1 
-                WHERE file_id = $2
-            `;
-      await db.query(updateQuery, [clusterLabels[i], fileIdToUpdate]);
-    }
+    // Update only the cluster labels that changed
+    const changedFileIds =
+      labelChanges.fileIds ??
+      labelChanges.rows.map((row) =>
+        row < embeddingsResult.rows.length
+          ? embeddingsResult.rows[row].file_id
+          : fileId
+      );
+    await modelClustering.writeClusterLabels(
+      changedFileIds,
+      labelChanges.labels
+    );
 
     // Get folder suggestions
     const suggestions = await folderSuggestion.getSuggestedFolders({
@@ -335,14 +517,14 @@ exports.smartUploadFile = async (req, res) => {
         totalDocuments: existingEmbeddings.length,
         uniqueClusters: clusterStats.num_clusters,
         noisePoints: clusterStats.noise_points,
-        assignedCluster: clusterLabels[clusterLabels.length - 1],
+        assignedCluster: labelChanges.labels[changedFileIds.indexOf(fileId)],
         clusterSizes: clusterStats.cluster_sizes,
       },
       ...(folderContext && {
         folderContext: {
           statistics: folderContext.statistics,
           topAffinities: Object.entries(
-            folderContext.affinities[clusterLabels.length - 1] || {}
+            folderContext.affinities[embeddingsResult.rows.length] || {}
           )
             .sort(([, a], [, b]) => b - a)
             .slice(0, 5)
@@ -830,26 +1012,25 @@ exports.assignFolder = async (req, res) => {
         minSamples: 2,
         clusterSelectionMethod: "eom",
         clusterSelectionEpsilon: 0.18,
+        persistState: true,
       },
       userId
     );
 
-    // Update cluster labels
-    for (let i = 0; i < clusteringResult.labels.length; i++) {
-      const updateClusterQuery =
-        "UPDATE main.files SET cluster_label = $1 WHERE file_id = $2";
-      await db.query(updateClusterQuery, [
-        clusteringResult.labels[i],
-        allEmbeddings[i].fileId,
-      ]);
-    }
+    // Update cluster labels; with CLUSTERING_SOURCE=database cluster.py reads the embeddings
+    // itself and returns the file id of every label, in its own order
+    await modelClustering.writeClusterLabels(
+      clusteringResult.fileIds ??
+        allEmbeddings.map((item) => item.fileId),
+      clusteringResult.labels
+    );
 
     res.json({
       message: "Folder assigned successfully",
       fileId: fileId,
       folderId: folderId,
       clusteringResults: {
-        totalDocuments: allEmbeddings.length,
+        totalDocuments: clusteringResult.labels.length,
         uniqueClusters: clusteringResult.clusterStats.num_clusters,
         noisePoints: clusteringResult.clusterStats.noise_points,
         clusterSizes: clusteringResult.clusterStats.cluster_sizes,
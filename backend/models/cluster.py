@@ -11,286 +11,2390 @@ import hdbscan
 import numpy as np
 import json
 import sys
+import os
+import hashlib
+import itertools
+import time
+import pickle
+import re
+import tempfile
+import signal
+import socketserver
+import struct
+import threading
 import traceback
+import argparse
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from sklearn.decomposition import PCA, TruncatedSVD
+from sklearn.neighbors import KDTree
+from sklearn.random_projection import GaussianRandomProjection
 from sklearn.preprocessing import normalize
-from scipy.spatial.distance import cdist
+from hdbscan._hdbscan_linkage import mst_linkage_core_vector, label
+from hdbscan._hdbscan_tree import condense_tree, compute_stability, get_clusters
+from hdbscan.dist_metrics import DistanceMetric
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.sparse.csgraph import connected_components, minimum_spanning_tree
+
+# pgvector stores embeddings as float32, so the whole pipeline works in float32;
+# only the HDBSCAN stages (KD-tree, spanning tree) operate on a float64 copy.
+FEATURE_DTYPE = np.float32
+
+def as_features(values):
+    """Input embeddings as a float32 matrix (no copy if they already are float32)."""
+    return np.asarray(values, dtype=FEATURE_DTYPE)
+
+def cosine_similarities(normalized_a, normalized_b):
+    """Cosine similarities of L2-normalized rows as a single matrix product."""
+    return normalized_a @ normalized_b.T
+
+def cosine_distances(normalized):
+    """Pairwise cosine distances of L2-normalized rows, computed in place with a zero diagonal."""
+    distances = normalized @ normalized.T
+    np.subtract(1, distances, out=distances)
+    np.fill_diagonal(distances, 0)
+    return distances
 
 class GuidedClustering:
-    def __init__(self, folder_weight=0.45, semantic_similarity_threshold=0.7):
-        self.folder_weight = folder_weight
-        self.semantic_similarity_threshold = semantic_similarity_threshold
+    """
+    Clustering on a precomputed, folder-guided distance matrix. Two guidance strategies are available:
+
+    - 'folder_similarity': scale document distances down for documents in semantically similar
+      folders and slightly up for documents in dissimilar folders
+    - 'enhanced_features': cluster on document embeddings extended by their folder similarities
+    """
+    STRATEGY_DEFAULTS = {
+        'folder_similarity': {'folder_weight': 0.3, 'semantic_similarity_threshold': 0.8},
+        'enhanced_features': {'folder_weight': 0.45, 'semantic_similarity_threshold': 0.7},
+    }
+
+    def __init__(self, folder_weight=None, semantic_similarity_threshold=None,
+                 strategy='folder_similarity', tile_size=2048):
+        if strategy not in self.STRATEGY_DEFAULTS:
+            raise ValueError(f"Unknown guidance strategy '{strategy}'")
+        defaults = self.STRATEGY_DEFAULTS[strategy]
+        self.strategy = strategy
+        self.folder_weight = defaults['folder_weight'] if folder_weight is None else folder_weight
+        self.semantic_similarity_threshold = (defaults['semantic_similarity_threshold']
+                                              if semantic_similarity_threshold is None
+                                              else semantic_similarity_threshold)
+        self.tile_size = tile_size
         self.folder_affinities = {}  # Store document-folder affinities
-    
+
     def prepare_data(self, doc_embeddings, folder_embeddings=None, doc_to_folder_map=None):
         """
-        Enhanced data preparation with folder affinity computation
+        Prepare embeddings and folder data. Falls back to regular clustering if folder data is not provided.
         """
         # Convert to numpy arrays and normalize
-        self.doc_embeddings = np.array(doc_embeddings)
-        self.doc_embeddings = normalize(self.doc_embeddings)
-        
+        self.doc_embeddings = normalize(as_features(doc_embeddings))
+        self.folder_affinities = {}
+
         # Store folder information if provided
         self.has_folder_guidance = folder_embeddings is not None and doc_to_folder_map is not None
-        if self.has_folder_guidance:
-            self.folder_ids = list(folder_embeddings.keys())
-            self.folder_matrix = np.array(list(folder_embeddings.values()))
-            self.folder_matrix = normalize(self.folder_matrix)
-            self.doc_to_folder = doc_to_folder_map
-            
-            # Compute and store folder affinities for each document
-            folder_similarities = 1 - cdist(self.doc_embeddings, self.folder_matrix, metric='cosine')
-            for i, similarities in enumerate(folder_similarities):
-                significant_affinities = {}
-                for j, sim in enumerate(similarities):
-                    if sim >= self.semantic_similarity_threshold:
-                        significant_affinities[self.folder_ids[j]] = float(sim)
-                if significant_affinities:
-                    self.folder_affinities[str(i)] = significant_affinities
-            
-            # Compute semantic similarities between folders
-            folder_distances = cdist(self.folder_matrix, self.folder_matrix, metric='cosine')
-            self.folder_similarities = 1 - folder_distances
-    
-    def compute_distances(self):
-        """
-        Enhanced distance computation with semantic context
-        """
-        # Base distances between documents
-        distances = cdist(self.doc_embeddings, self.doc_embeddings, metric='cosine')
-        
         if not self.has_folder_guidance:
-            return distances
-            
-        # Create enhanced feature space
-        folder_similarities = 1 - cdist(self.doc_embeddings, self.folder_matrix, metric='cosine')
-        enhanced_features = np.hstack([
-            self.doc_embeddings * (1 - self.folder_weight),
-            folder_similarities * self.folder_weight
-        ])
-        enhanced_features = normalize(enhanced_features)
-        
-        # Compute final distances in enhanced space
-        final_distances = cdist(enhanced_features, enhanced_features, metric='cosine')
-        
-        return final_distances
-    def __init__(self, folder_weight=0.3, semantic_similarity_threshold=0.8):
-        self.folder_weight = folder_weight
-        self.semantic_similarity_threshold = semantic_similarity_threshold
-    
-    def prepare_data(self, doc_embeddings, folder_embeddings=None, doc_to_folder_map=None):
+            return
+
+        self.folder_ids = list(folder_embeddings.keys())
+        self.folder_index = {folder_id: idx for idx, folder_id in enumerate(self.folder_ids)}
+        self.folder_matrix = normalize(as_features(list(folder_embeddings.values())))
+        self.doc_to_folder = doc_to_folder_map
+
+        # Compute semantic similarities between folders (1 - distance)
+        self.folder_similarities = cosine_similarities(self.folder_matrix, self.folder_matrix)
+        self.similar_folders = self.folder_similarities >= self.semantic_similarity_threshold
+        print(f"[DEBUG] Folder similarities matrix shape: {self.folder_similarities.shape}", file=sys.stderr)
+        print(f"[DEBUG] Similar folder pairs: {int(np.triu(self.similar_folders, 1).sum())}", file=sys.stderr)
+
+        # Compute and store folder affinities for each document
+        doc_folder_similarities = cosine_similarities(self.doc_embeddings, self.folder_matrix)
+        self.folder_affinities = sparse_affinities(
+            doc_folder_similarities, self.folder_ids, self.semantic_similarity_threshold
+        )
+
+        self._map_documents_to_folders()
+
+    def _map_documents_to_folders(self):
         """
-        Prepare embeddings and create weighted distance matrix.
-        Falls back to regular clustering if folder data is not provided.
+        Map every document to a row of an extended folder similarity matrix once. Folder ids without
+        an embedding get their own rows (similar only to themselves), unassigned documents get -1.
         """
-        # Convert to numpy arrays and normalize
-        self.doc_embeddings = np.array(doc_embeddings)
-        self.doc_embeddings = normalize(self.doc_embeddings)
-        
-        # Store folder information if provided
-        self.has_folder_guidance = folder_embeddings is not None and doc_to_folder_map is not None
-        if self.has_folder_guidance:
-            self.folder_ids = list(folder_embeddings.keys())
-            self.folder_matrix = np.array(list(folder_embeddings.values()))
-            self.folder_matrix = normalize(self.folder_matrix)
-            self.doc_to_folder = doc_to_folder_map
-            
-            # Compute semantic similarities between folders
-            folder_distances = cdist(self.folder_matrix, self.folder_matrix, metric='cosine')
-            # Convert distances to similarities (1 - distance)
-            self.folder_similarities = 1 - folder_distances
-            print(f"[DEBUG] Folder similarities matrix shape: {self.folder_similarities.shape}", file=sys.stderr)
-            
-            # Create a matrix of similar folder pairs
-            self.similar_folders = self.folder_similarities >= self.semantic_similarity_threshold
-            
-            # Log folder similarity information
-            for i in range(len(self.folder_ids)):
-                for j in range(i + 1, len(self.folder_ids)):
-                    similarity = self.folder_similarities[i, j]
-                    print(f"[DEBUG] Folder similarity between '{self.folder_ids[i]}' and '{self.folder_ids[j]}': {similarity:.3f}", 
-                          file=sys.stderr)
-    
+        doc_count = len(self.doc_embeddings)
+        folder_codes = dict(self.folder_index)
+        self.doc_folder_idx = np.full(doc_count, -1, dtype=np.intp)
+        for doc_idx, folder_id in self.doc_to_folder.items():
+            doc_idx = int(doc_idx)
+            if folder_id is not None and 0 <= doc_idx < doc_count:
+                self.doc_folder_idx[doc_idx] = folder_codes.setdefault(folder_id, len(folder_codes))
+
+        folder_count = len(self.folder_ids)
+        similarity = np.zeros((len(folder_codes), len(folder_codes)), dtype=FEATURE_DTYPE)
+        similarity[:folder_count, :folder_count] = self.folder_similarities
+        np.fill_diagonal(similarity, 1.0)
+        self.extended_folder_similarities = similarity
+
     def get_folder_similarity(self, folder_id1, folder_id2):
         """Get semantic similarity between two folders."""
         if folder_id1 == folder_id2:
             return 1.0
-            
-        try:
-            idx1 = self.folder_ids.index(folder_id1)
-            idx2 = self.folder_ids.index(folder_id2)
-            return self.folder_similarities[idx1, idx2]
-        except (ValueError, IndexError):
+        idx1 = self.folder_index.get(folder_id1)
+        idx2 = self.folder_index.get(folder_id2)
+        if idx1 is None or idx2 is None:
             return 0.0
-    
+        return self.folder_similarities[idx1, idx2]
+
     def compute_distances(self):
+        """Compute the distance matrix with the selected guidance strategy."""
+        if self.strategy == 'enhanced_features':
+            return self._compute_enhanced_feature_distances()
+        return self._compute_folder_similarity_distances()
+
+    def _compute_enhanced_feature_distances(self):
+        """Cosine distances in a feature space extended by weighted document-folder similarities."""
+        if not self.has_folder_guidance:
+            return cosine_distances(self.doc_embeddings)
+
+        folder_similarities = cosine_similarities(self.doc_embeddings, self.folder_matrix)
+        enhanced_features = normalize(np.hstack([
+            self.doc_embeddings * (1 - self.folder_weight),
+            folder_similarities * self.folder_weight
+        ]))
+        return cosine_distances(enhanced_features)
+
+    def _folder_factors(self, row_folders, col_folders):
+        """Distance scaling factors for a tile of document pairs."""
+        similarity = self.extended_folder_similarities[row_folders[:, None], col_folders[None, :]]
+        factors = np.where(
+            similarity >= self.semantic_similarity_threshold,
+            # Documents in semantically similar folders - reduce distance
+            1 - self.folder_weight * similarity,
+            # Documents in different, dissimilar folders - slightly increase distance
+            1 + self.folder_weight * (1 - similarity) * 0.5
+        )
+        assigned = (row_folders >= 0)[:, None] & (col_folders >= 0)[None, :]
+        return np.where(assigned, factors, 1.0)
+
+    def _compute_folder_similarity_distances(self):
         """
-        Compute distance matrix with optional folder guidance and semantic similarity
+        Cosine distances scaled by the similarity of the documents' folders. The upper triangle is
+        scaled tile by tile and mirrored, so the result is symmetric like the pairwise definition.
         """
         # Base distances between documents
-        distances = cdist(self.doc_embeddings, self.doc_embeddings, metric='cosine')
-        
+        distances = cosine_distances(self.doc_embeddings)
+
         if not self.has_folder_guidance:
             return distances
-            
-        # Adjust distances based on folder membership and semantic similarity
-        for i in range(len(self.doc_embeddings)):
-            for j in range(i + 1, len(self.doc_embeddings)):
-                folder_i = self.doc_to_folder.get(str(i))
-                folder_j = self.doc_to_folder.get(str(j))
-                
-                if folder_i is not None and folder_j is not None:
-                    # Get semantic similarity between folders
-                    folder_similarity = self.get_folder_similarity(folder_i, folder_j)
-                    
-                    if folder_similarity >= self.semantic_similarity_threshold:
-                        # Documents in semantically similar folders - reduce distance
-                        reduction_factor = self.folder_weight * folder_similarity
-                        distances[i, j] *= (1 - reduction_factor)
-                        distances[j, i] = distances[i, j]
-                    else:
-                        # Documents in different, dissimilar folders - slightly increase distance
-                        increase_factor = self.folder_weight * (1 - folder_similarity) * 0.5
-                        distances[i, j] *= (1 + increase_factor)
-                        distances[j, i] = distances[i, j]
-                    
-        return distances
 
-def main():
-    try:
-        # Load embeddings and config
-        with open(sys.argv[1], 'r') as f:
-            embeddings_data = json.load(f)
-        
-        with open(sys.argv[2], 'r') as f:
-            config = json.load(f)
+        doc_count = len(distances)
+        for start in range(0, doc_count, self.tile_size):
+            stop = min(start + self.tile_size, doc_count)
+            tile_rows = stop - start
 
-        # Handle both document embeddings and folder data
-        doc_embeddings = np.array(embeddings_data.get('doc_embeddings', []))
-        folder_embeddings = embeddings_data.get('folder_embeddings', {})
-        doc_to_folder_map = embeddings_data.get('doc_to_folder_map', {})
-        
-        # Normalize document embeddings
-        normalized_docs = normalize(doc_embeddings)
-        
-        # Process folder data if available
-        if folder_embeddings:
-            # Convert folder embeddings to matrix
-            folder_matrix = np.array(list(folder_embeddings.values()))
-            folder_matrix = normalize(folder_matrix)
-            
-            # Compute folder-document similarities
-            folder_similarities = 1 - cdist(normalized_docs, folder_matrix, metric='cosine')
-            
-            # Compute semantic context
-            anchor_influence = config.get('anchorInfluence', 0.45)
-            semantic_threshold = config.get('semanticThreshold', 0.7)
-            
-            # Enhanced feature space combining document and folder information
-            transformed_embeddings = np.hstack([
-                normalized_docs * (1 - anchor_influence),
-                folder_similarities * anchor_influence
-            ])
-            
-            # Apply additional weighting for documents with known folders
-            folder_ids = list(folder_embeddings.keys())
-            for doc_idx, folder_id in doc_to_folder_map.items():
-                doc_idx = int(doc_idx)
-                if doc_idx < len(transformed_embeddings):
-                    folder_idx = folder_ids.index(folder_id)
-                    folder_vec = folder_similarities[doc_idx]
-                    
-                    # Create boost vector based on folder similarity
-                    boost = np.zeros_like(folder_vec)
-                    boost[folder_idx] = 1.0
-                    
-                    # Find and boost similar folders
-                    for other_idx, sim in enumerate(folder_vec):
-                        if sim >= semantic_threshold and other_idx != folder_idx:
-                            boost[other_idx] = sim
-                    
-                    # Apply boost to folder context
-                    transformed_embeddings[doc_idx, -len(folder_vec):] *= (1 + boost * 0.5)
-            
-            # Normalize final embeddings
-            transformed_embeddings = normalize(transformed_embeddings)
-            
-            # Compute folder affinities for future suggestions
-            folder_affinities = {}
-            for i, similarities in enumerate(folder_similarities):
-                significant_folders = {}
-                for j, sim in enumerate(similarities):
-                    if sim >= semantic_threshold:
-                        significant_folders[folder_ids[j]] = float(sim)
-                if significant_folders:
-                    folder_affinities[str(i)] = significant_folders
-            
-        else:
-            transformed_embeddings = normalized_docs
-            folder_affinities = {}
+            factors = self._folder_factors(self.doc_folder_idx[start:stop], self.doc_folder_idx[start:])
+            factors[np.arange(tile_rows), np.arange(tile_rows)] = 1.0
+            distances[start:stop, start:] *= factors
 
-        # Initialize HDBSCAN clusterer
+            block = distances[start:stop, start:stop]
+            distances[start:stop, start:stop] = np.triu(block) + np.triu(block, 1).T
+            distances[stop:, start:stop] = distances[start:stop, stop:].T
+
+        return distances
+
+    def fit_predict(self, config=None):
+        """Cluster the prepared documents on the guided distance matrix; returns (labels, probabilities)."""
+        config = config or {}
         clusterer = hdbscan.HDBSCAN(
             min_cluster_size=config.get('minClusterSize', 2),
             min_samples=config.get('minSamples', 2),
             cluster_selection_method=config.get('clusterSelectionMethod', 'eom'),
             cluster_selection_epsilon=config.get('clusterSelectionEpsilon', 0.15),
-            metric='euclidean',
-            core_dist_n_jobs=-1
+            metric='precomputed'
+        )
+        labels = clusterer.fit_predict(self.compute_distances().astype(np.float64, copy=False))
+        return labels, clusterer.probabilities_
+
+# ---------------------------------------------------------------------------
+# Input loading: JSON (fallback) or binary float32 matrices
+# ---------------------------------------------------------------------------
+
+# Binary layout (all little-endian):
+#   magic 'IDCB' | uint32 header length | JSON header (space-padded so the matrices start
+#   at a 64-byte boundary) | doc matrix float32[doc_count, dim] | folder matrix float32[len(folder_ids), dim]
+# The header carries dim, doc_count, folder_ids and doc_to_folder_map; server requests
+# additionally put id, mode and config into it.
+BINARY_MAGIC = b'IDCB'
+BINARY_PREAMBLE = struct.Struct('<4sI')
+
+def _parse_binary_header(buffer):
+    """Return (header, data_offset) of a binary embeddings buffer."""
+    magic, header_length = BINARY_PREAMBLE.unpack_from(buffer, 0)
+    if magic != BINARY_MAGIC:
+        raise ValueError("Not a binary embeddings buffer")
+    header_start = BINARY_PREAMBLE.size
+    header = json.loads(bytes(buffer[header_start:header_start + header_length]).decode('utf-8'))
+    return header, header_start + header_length
+
+def _embeddings_from_matrices(header, doc_matrix, folder_matrix):
+    """Build the same embeddings_data structure json.load would produce, backed by the matrices."""
+    folder_ids = [str(folder_id) for folder_id in header.get('folder_ids', [])]
+    return {
+        'doc_embeddings': doc_matrix,
+        'folder_embeddings': dict(zip(folder_ids, folder_matrix)),
+        'doc_to_folder_map': header.get('doc_to_folder_map', {})
+    }
+
+def _matrix_shapes(header):
+    dim = int(header['dim'])
+    return (int(header['doc_count']), dim), (len(header.get('folder_ids', [])), dim)
+
+def decode_binary_embeddings(buffer):
+    """Decode an in-memory binary embeddings buffer; the matrices are views, not copies."""
+    header, offset = _parse_binary_header(buffer)
+    doc_shape, folder_shape = _matrix_shapes(header)
+    doc_matrix = np.frombuffer(buffer, dtype='<f4', count=doc_shape[0] * doc_shape[1],
+                               offset=offset).reshape(doc_shape)
+    offset += doc_matrix.nbytes
+    folder_matrix = np.frombuffer(buffer, dtype='<f4', count=folder_shape[0] * folder_shape[1],
+                                  offset=offset).reshape(folder_shape)
+    return header, _embeddings_from_matrices(header, doc_matrix, folder_matrix)
+
+def load_binary_embeddings(path):
+    """Memory-map a binary embeddings file instead of reading it into memory."""
+    with open(path, 'rb') as f:
+        preamble = f.read(BINARY_PREAMBLE.size)
+        _, header_length = BINARY_PREAMBLE.unpack(preamble)
+        header, offset = _parse_binary_header(preamble + f.read(header_length))
+    doc_shape, folder_shape = _matrix_shapes(header)
+
+    doc_matrix = np.empty(doc_shape, dtype='<f4')
+    if doc_matrix.size:
+        doc_matrix = np.memmap(path, dtype='<f4', mode='r', offset=offset, shape=doc_shape)
+    offset += doc_matrix.nbytes
+    folder_matrix = np.empty(folder_shape, dtype='<f4')
+    if folder_matrix.size:
+        folder_matrix = np.memmap(path, dtype='<f4', mode='r', offset=offset, shape=folder_shape)
+    return _embeddings_from_matrices(header, doc_matrix, folder_matrix)
+
+def load_embeddings(path):
+    """Load clustering input from either the binary format or the JSON fallback."""
+    with open(path, 'rb') as f:
+        magic = f.read(len(BINARY_MAGIC))
+    if magic == BINARY_MAGIC:
+        return load_binary_embeddings(path)
+    with open(path, 'r') as f:
+        return json.load(f)
+
+# ---------------------------------------------------------------------------
+# Phase instrumentation
+# ---------------------------------------------------------------------------
+
+class PhaseTimer:
+    """
+    Collects the wall time of each pipeline phase and, if trace_memory is set, the
+    tracemalloc peak reached inside the phase. tracemalloc is process-wide, so with
+    several concurrent server requests the memory peaks overlap.
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.timings = {}
+        self.memory_peaks = {}
+        self.started = time.perf_counter()
+
+    @classmethod
+    def from_config(cls, config, timer=None):
+        """Reuse a timer created before the config was known (e.g. around input loading)."""
+        timer = timer or cls()
+        timer.trace_memory = bool(config.get('traceMemory', False))
+        if timer.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        return timer
+
+    @staticmethod
+    def enabled(config):
+        return bool(config.get('timings', os.environ.get('CLUSTERING_TIMINGS') == 'true'))
+
+    @contextmanager
+    def phase(self, name):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + (time.perf_counter() - start) * 1000
+            if self.trace_memory:
+                _, peak = tracemalloc.get_traced_memory()
+                self.memory_peaks[name] = max(self.memory_peaks.get(name, 0), peak)
+
+    def report(self):
+        """The clustering_stats.timings block (milliseconds, bytes)."""
+        report = {
+            'total_ms': round((time.perf_counter() - self.started) * 1000, 3),
+            'phases_ms': {name: round(ms, 3) for name, ms in self.timings.items()}
+        }
+        if self.memory_peaks:
+            report['memory_peak_bytes'] = dict(self.memory_peaks)
+        return report
+
+    def log(self, config, doc_count):
+        """Emit one structured [METRIC] line per phase on stderr for log aggregation."""
+        for name, ms in self.timings.items():
+            metric = {
+                'event': 'clustering_phase',
+                'phase': name,
+                'ms': round(ms, 3),
+                'documents': doc_count,
+                'user_id': config.get('userId')
+            }
+            if name in self.memory_peaks:
+                metric['memory_peak_bytes'] = self.memory_peaks[name]
+            print(f"[METRIC] {json.dumps(metric)}", file=sys.stderr)
+
+# ---------------------------------------------------------------------------
+# Clustering pipeline
+# ---------------------------------------------------------------------------
+
+def sparse_affinities(similarities, folder_ids, threshold, start_index=0):
+    """
+    Extract {doc_index: {folder_id: similarity}} for all similarities >= threshold.
+    The matches are gathered as CSR arrays (row pointers, columns, values) in row-major order,
+    so documents and folders appear in the same order as a nested loop would produce them.
+    """
+    mask = similarities >= threshold
+    rows, columns = np.nonzero(mask)
+    values = similarities[rows, columns].tolist()
+    row_pointers = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=len(similarities)))]).tolist()
+    column_ids = [folder_ids[column] for column in columns.tolist()]
+
+    affinities = {}
+    for row in np.unique(rows).tolist():
+        start, stop = row_pointers[row], row_pointers[row + 1]
+        affinities[str(start_index + row)] = dict(zip(column_ids[start:stop], values[start:stop]))
+    return affinities
+
+def anchor_transform(normalized_docs, folder_matrix, folder_ids, doc_to_folder_map, config, start_index=0,
+                     timer=None):
+    """
+    Project normalized documents into the folder-anchored feature space used for clustering.
+    Rows correspond to documents start_index, start_index + 1, ...; the indices in
+    doc_to_folder_map and in the returned affinities refer to the whole corpus.
+    Returns (transformed_embeddings, folder_similarities, folder_affinities).
+    """
+    timer = timer or PhaseTimer()
+
+    # Compute folder-document similarities
+    with timer.phase('folder_similarity'):
+        folder_similarities = cosine_similarities(normalized_docs, folder_matrix)
+
+    with timer.phase('anchor_transform'):
+        transformed_embeddings = _anchor_features(
+            normalized_docs, folder_similarities, folder_ids, doc_to_folder_map, config, start_index
+        )
+
+    # Compute folder affinities for future suggestions
+    with timer.phase('folder_affinities'):
+        folder_affinities = sparse_affinities(
+            folder_similarities, folder_ids, config.get('semanticThreshold', 0.7), start_index
         )
 
-        # Perform clustering
-        labels = clusterer.fit_predict(transformed_embeddings)
-        
-        # Calculate cluster statistics
-        num_clusters = len(set(labels[labels != -1]))
-        noise_points = sum(labels == -1)
-        
-        # Log clustering information
-        print(f"[INFO] Documents processed: {len(doc_embeddings)}", file=sys.stderr)
-        print(f"[INFO] Clusters found: {num_clusters}", file=sys.stderr)
-        print(f"[INFO] Noise points: {noise_points}", file=sys.stderr)
-        
-        if folder_embeddings:
-            print(f"[INFO] Folders used for guidance: {len(folder_embeddings)}", file=sys.stderr)
-            
-            # Debug folder similarities
-            folder_docs = {str(i): list(affs.items()) 
-                         for i, affs in folder_affinities.items() 
-                         if len(affs) > 0}
+    return transformed_embeddings, folder_similarities, folder_affinities
+
+def _anchor_features(normalized_docs, folder_similarities, folder_ids, doc_to_folder_map, config, start_index):
+    """Combine documents and their folder similarities and boost the folder columns of assigned documents."""
+    # Compute semantic context
+    anchor_influence = config.get('anchorInfluence', 0.45)
+    semantic_threshold = config.get('semanticThreshold', 0.7)
+
+    # Enhanced feature space combining document and folder information
+    transformed_embeddings = np.hstack([
+        normalized_docs * (1 - anchor_influence),
+        folder_similarities * anchor_influence
+    ])
+
+    # Apply additional weighting for documents with known folders
+    folder_columns = {folder_id: idx for idx, folder_id in enumerate(folder_ids)}
+    doc_rows = []
+    doc_columns = []
+    for doc_idx, folder_id in doc_to_folder_map.items():
+        doc_idx = int(doc_idx) - start_index
+        if 0 <= doc_idx < len(transformed_embeddings):
+            doc_rows.append(doc_idx)
+            doc_columns.append(folder_columns[folder_id])
+
+    if doc_rows:
+        doc_rows = np.array(doc_rows, dtype=np.intp)
+        folder_vecs = folder_similarities[doc_rows]
+
+        # Boost the document's own folder fully and semantically similar folders by their similarity
+        boost = np.where(folder_vecs >= semantic_threshold, folder_vecs, 0)
+        boost[np.arange(len(doc_rows)), doc_columns] = 1.0
+
+        # Apply boost to folder context
+        transformed_embeddings[doc_rows, -folder_vecs.shape[1]:] *= (1 + boost * 0.5)
+
+    # Normalize final embeddings
+    return normalize(transformed_embeddings)
+
+def prepare_features(embeddings_data, config, timer=None):
+    """
+    Normalize the input and apply the folder anchor transform if folder embeddings are present.
+    Returns a dict with the clustering features and the folder context needed for the result.
+    """
+    timer = timer or PhaseTimer()
+
+    # Handle both document embeddings and folder data (float32 memory-mapped input is not copied)
+    doc_embeddings = as_features(embeddings_data.get('doc_embeddings', []))
+    folder_embeddings = embeddings_data.get('folder_embeddings', {})
+    doc_to_folder_map = embeddings_data.get('doc_to_folder_map', {})
+
+    # Normalize document embeddings
+    with timer.phase('normalize'):
+        normalized_docs = normalize(doc_embeddings)
+
+    features = {
+        'doc_count': len(doc_embeddings),
+        'normalized_docs': normalized_docs,
+        'folder_ids': [],
+        'folder_matrix': None,
+        'folder_similarities': None,
+        'folder_affinities': {},
+        'transformed': normalized_docs
+    }
+
+    # Process folder data if available
+    if folder_embeddings:
+        # Convert folder embeddings to matrix
+        folder_ids = list(folder_embeddings.keys())
+        with timer.phase('normalize'):
+            folder_matrix = normalize(as_features(list(folder_embeddings.values())))
+        transformed, folder_similarities, folder_affinities = anchor_transform(
+            normalized_docs, folder_matrix, folder_ids, doc_to_folder_map, config, timer=timer
+        )
+        features.update(
+            folder_ids=folder_ids,
+            folder_matrix=folder_matrix,
+            folder_similarities=folder_similarities,
+            folder_affinities=folder_affinities,
+            transformed=transformed
+        )
+
+    return features
+
+def make_clusterer(config, prediction_data=False):
+    """Create the HDBSCAN clusterer from the request config."""
+    return hdbscan.HDBSCAN(
+        min_cluster_size=config.get('minClusterSize', 2),
+        min_samples=config.get('minSamples', 2),
+        cluster_selection_method=config.get('clusterSelectionMethod', 'eom'),
+        cluster_selection_epsilon=config.get('clusterSelectionEpsilon', 0.15),
+        metric='euclidean',
+        core_dist_n_jobs=-1,
+        prediction_data=prediction_data
+    )
+
+def effective_min_samples(config, size):
+    """min_samples clamped to the corpus size the same way hdbscan does it."""
+    return max(min(size - 1, config.get('minSamples', 2)), 1)
+
+def neighbor_distances(features, k):
+    """Distances of every point to its k nearest neighbours including itself (KD-tree, exact)."""
+    tree = KDTree(features, metric='euclidean', leaf_size=40)
+    return tree.query(features, k=k, dualtree=True, breadth_first=True)[0]
+
+def build_spanning_tree(features, core_distances):
+    """Minimum spanning tree of the mutual reachability graph as (a, b, distance) rows sorted by distance."""
+    min_spanning_tree = mst_linkage_core_vector(features, core_distances, DistanceMetric.get_metric('euclidean'), 1.0)
+    return min_spanning_tree[np.argsort(min_spanning_tree.T[2]), :]
+
+def select_clusters(single_linkage_tree, config):
+    """Condense the single-linkage tree and select flat clusters; returns (labels, probabilities, condensed_tree)."""
+    condensed_tree = condense_tree(single_linkage_tree, config.get('minClusterSize', 2))
+    stability = compute_stability(condensed_tree)
+    labels, probabilities, _ = get_clusters(
+        condensed_tree,
+        stability,
+        cluster_selection_method=config.get('clusterSelectionMethod', 'eom'),
+        cluster_selection_epsilon=float(config.get('clusterSelectionEpsilon', 0.15))
+    )
+    return labels, probabilities, condensed_tree
+
+def fit_hdbscan(features, config, timer=None):
+    """
+    Fit HDBSCAN and return (labels, probabilities, single_linkage_tree); the tree is kept for recut.
+    By default this is hdbscan.HDBSCAN.fit, timed as one phase. With config.knnGraph the core
+    distances and spanning tree come from the sparse k-NN graph instead and are condensed the same
+    way hdbscan does it (select_clusters).
+    """
+    timer = timer or PhaseTimer()
+
+    if not config.get('knnGraph'):
+        clusterer = make_clusterer(config)
+        with timer.phase('hdbscan_fit'):
+            clusterer.fit(features)
+        return clusterer.labels_, clusterer.probabilities_, clusterer.single_linkage_tree_.to_numpy()
+
+    # Core distances and spanning tree from the (cached) sparse k-NN graph
+    min_samples = effective_min_samples(config, len(features))
+    features = as_features(features)
+    neighbors = max(int(config.get('knnNeighbors', 15)), min_samples + 1)
+    with timer.phase('knn_graph'):
+        indices, distances = user_knn_graph(features, config, neighbors)
+    with timer.phase('hdbscan_core_distances'):
+        core_distances = distances[:, min_samples].astype(np.float64)
+    with timer.phase('hdbscan_spanning_tree'):
+        single_linkage_tree = label(knn_spanning_tree(features, indices, distances, core_distances))
+    with timer.phase('hdbscan_condense_tree'):
+        labels, probabilities, _ = select_clusters(single_linkage_tree, config)
+
+    return labels, probabilities, single_linkage_tree
+
+def build_result(labels, probabilities, features):
+    """Assemble the result dict returned to Node and log the clustering summary."""
+    folder_affinities = features['folder_affinities']
+    folder_similarities = features['folder_similarities']
+
+    # Calculate cluster statistics in one counting pass
+    cluster_ids, counts = np.unique(labels, return_counts=True)
+    is_noise = cluster_ids == -1
+    num_clusters = int(np.count_nonzero(~is_noise))
+    noise_points = int(counts[is_noise].sum())
+
+    # Log clustering information
+    print(f"[INFO] Documents processed: {features['doc_count']}", file=sys.stderr)
+    print(f"[INFO] Clusters found: {num_clusters}", file=sys.stderr)
+    print(f"[INFO] Noise points: {noise_points}", file=sys.stderr)
+
+    if features['folder_ids']:
+        print(f"[INFO] Folders used for guidance: {len(features['folder_ids'])}", file=sys.stderr)
+
+        # Debug folder similarities
+        folder_docs = {str(i): list(affs.items())
+                     for i, affs in folder_affinities.items()
+                     if len(affs) > 0}
+        if folder_similarities is not None and folder_similarities.size:
             print(f"[DEBUG] Max similarity score: {folder_similarities.max():.3f}", file=sys.stderr)
             print(f"[DEBUG] Mean similarity score: {folder_similarities.mean():.3f}", file=sys.stderr)
-            print(f"[DEBUG] Documents with strong folder affinities: {len(folder_docs)}", 
-                  file=sys.stderr)
+        print(f"[DEBUG] Documents with strong folder affinities: {len(folder_docs)}",
+              file=sys.stderr)
 
-        # Prepare output with clusterer probabilities
-        result = {
-            'labels': labels.tolist(),
-            'probabilities': clusterer.probabilities_.tolist(),
-            'folder_context': {
-                'affinities': folder_affinities,
-                'statistics': {
-                    'documents_with_affinities': len(folder_affinities),
-                    'average_affinities_per_doc': 
-                        sum(len(v) for v in folder_affinities.values()) / 
-                        len(folder_affinities) if folder_affinities else 0
-                }
+    # Prepare output with clusterer probabilities
+    return {
+        'labels': labels.tolist(),
+        'probabilities': probabilities.tolist(),
+        'folder_context': {
+            'affinities': folder_affinities,
+            'statistics': {
+                'documents_with_affinities': len(folder_affinities),
+                'average_affinities_per_doc':
+                    sum(len(v) for v in folder_affinities.values()) /
+                    len(folder_affinities) if folder_affinities else 0
+            }
+        },
+        'clustering_stats': {
+            'num_clusters': num_clusters,
+            'noise_points': noise_points,
+            'cluster_sizes': list(zip(cluster_ids[~is_noise].tolist(), counts[~is_noise].tolist()))
+        }
+    }
+
+# ---------------------------------------------------------------------------
+# Cluster summary: centroids, exemplars and radius per cluster
+# ---------------------------------------------------------------------------
+
+def _cluster_sums(members, member_labels, cluster_count, matrix):
+    """Per-cluster row sums of matrix as one sparse (cluster x document) indicator product."""
+    indicator = csr_matrix(
+        (np.ones(len(members), dtype=FEATURE_DTYPE), (member_labels, members)),
+        shape=(cluster_count, len(matrix))
+    )
+    return np.asarray(indicator @ matrix)
+
+def summarize_clusters(labels, probabilities, normalized_docs, exemplar_count=5):
+    """
+    Per-cluster centroid (unit length, in the embedding space so new documents can be routed
+    without the anchor transform), the exemplar_count members closest to it, the cosine distance
+    of the members to the centroid (mean, 90th percentile, max) and the mean HDBSCAN membership
+    probability. All reductions run over all clusters at once; noise is ignored.
+    """
+    labels = np.asarray(labels)
+    members = np.flatnonzero(labels >= 0)
+    member_labels = labels[members]
+    cluster_count = int(member_labels.max()) + 1 if len(members) else 0
+    sizes = np.bincount(member_labels, minlength=cluster_count)
+
+    sums = _cluster_sums(members, member_labels, cluster_count, normalized_docs)
+    norms = np.linalg.norm(sums, axis=1, keepdims=True)
+    centroids = (sums / np.maximum(norms, np.finfo(FEATURE_DTYPE).tiny)).astype(FEATURE_DTYPE)
+    distances = 1 - np.einsum('ij,ij->i', normalized_docs[members], centroids[member_labels])
+
+    radius_max = np.zeros(cluster_count)
+    np.maximum.at(radius_max, member_labels, distances)
+    radius_mean = np.bincount(member_labels, weights=distances, minlength=cluster_count) / np.maximum(sizes, 1)
+    mean_probability = (np.bincount(member_labels, weights=np.asarray(probabilities)[members],
+                                    minlength=cluster_count) / np.maximum(sizes, 1))
+
+    # Members ordered by cluster, then by distance to the centroid; rank = position inside the cluster
+    order = np.lexsort((distances, member_labels))
+    sorted_labels = member_labels[order]
+    starts = np.searchsorted(sorted_labels, np.arange(cluster_count))
+    ranks = np.arange(len(order)) - starts[sorted_labels]
+    radius_p90 = distances[order[starts + np.floor(0.9 * (sizes - 1)).astype(np.intp)]] if cluster_count else np.empty(0)
+
+    exemplars = np.full((cluster_count, exemplar_count), -1, dtype=np.int64)
+    top = ranks < exemplar_count
+    exemplars[sorted_labels[top], ranks[top]] = members[order[top]]
+
+    return {
+        'sizes': sizes,
+        'centroids': centroids,
+        'exemplars': exemplars,
+        'radius_mean': radius_mean,
+        'radius_p90': radius_p90,
+        'radius_max': radius_max,
+        'mean_probability': mean_probability
+    }
+
+def summary_to_json(summary):
+    """The cluster_summary block of the result: one entry per cluster label."""
+    return [
+        {
+            'label': label_id,
+            'size': int(summary['sizes'][label_id]),
+            'exemplars': [int(index) for index in summary['exemplars'][label_id] if index >= 0],
+            'radius': {
+                'mean': float(summary['radius_mean'][label_id]),
+                'p90': float(summary['radius_p90'][label_id]),
+                'max': float(summary['radius_max'][label_id])
             },
-            'clustering_stats': {
-                'num_clusters': int(num_clusters),
-                'noise_points': int(noise_points),
-                'cluster_sizes': [(int(label), int(sum(labels == label))) 
-                                for label in set(labels) if label != -1]
+            'mean_probability': float(summary['mean_probability'][label_id]),
+            'centroid': summary['centroids'][label_id].tolist()
+        }
+        for label_id in range(len(summary['sizes']))
+    ]
+
+ROUTING_QUANTILES = 21  # member distance quantiles kept per cluster (0 %, 5 %, ..., 100 %)
+
+def clustering_input(normalized_docs, folder_ids, folder_matrix, doc_to_folder_map, config, reducer=None):
+    """Map normalized documents into the space HDBSCAN ran in: anchor transform (with folders), then reduction."""
+    if folder_ids:
+        folder_similarities = cosine_similarities(normalized_docs, folder_matrix)
+        normalized_docs = _anchor_features(
+            normalized_docs, folder_similarities, folder_ids, doc_to_folder_map, config, 0
+        )
+    return reducer.transform(normalized_docs) if reducer is not None else normalized_docs
+
+def routing_model(labels, cluster_input, features, reducer, config):
+    """
+    Everything `assign` needs to place a new document: the transform parameters of this run and,
+    per cluster, the centroid and the member distance quantiles in the clustering feature space.
+    """
+    labels = np.asarray(labels)
+    members = np.flatnonzero(labels >= 0)
+    member_labels = labels[members]
+    cluster_count = int(member_labels.max()) + 1 if len(members) else 0
+    sizes = np.bincount(member_labels, minlength=cluster_count)
+
+    cluster_input = as_features(cluster_input)
+    centroids = (_cluster_sums(members, member_labels, cluster_count, cluster_input)
+                 / np.maximum(sizes, 1)[:, None]).astype(FEATURE_DTYPE)
+    distances = np.linalg.norm(cluster_input[members] - centroids[member_labels], axis=1)
+
+    order = np.lexsort((distances, member_labels))
+    starts = np.searchsorted(member_labels[order], np.arange(cluster_count))
+    positions = starts[:, None] + np.round(
+        np.linspace(0, 1, ROUTING_QUANTILES)[None, :] * (sizes - 1)[:, None]
+    ).astype(np.intp)
+
+    return {
+        'centroids': centroids,
+        'distance_quantiles': distances[order][positions] if cluster_count else np.empty((0, ROUTING_QUANTILES)),
+        'folder_ids': features['folder_ids'],
+        'folder_matrix': features['folder_matrix'],
+        'anchorInfluence': config.get('anchorInfluence', 0.45),
+        'semanticThreshold': config.get('semanticThreshold', 0.7),
+        'reducer': reducer
+    }
+
+def add_cluster_summary(result, labels, probabilities, features, config, file_ids=None, timer=None,
+                        cluster_input=None, reducer=None, corpus_key=None):
+    """
+    Compute the cluster summary if config.clusterSummary is set (added to the result) or the run
+    persists state (see persists_state; saved as 'cluster_summary.pkl', together with the routing
+    model of cluster_input and the corpus_key of the run, for routing new documents).
+    """
+    persist = persists_state(config)
+    if not (config.get('clusterSummary') or persist):
+        return result
+    timer = timer or PhaseTimer()
+    with timer.phase('cluster_summary'):
+        summary = summarize_clusters(labels, probabilities, features['normalized_docs'],
+                                     int(config.get('exemplarCount', 5)))
+    if persist:
+        with timer.phase('save_summary'):
+            routing = None
+            if cluster_input is not None:
+                routing = routing_model(labels, cluster_input, features, reducer, config)
+            save_user_model(config, 'cluster_summary.pkl', {
+                **summary,
+                'doc_count': features['doc_count'],
+                'file_ids': file_ids,
+                'labels': np.asarray(labels, dtype=np.int32),
+                'routing': routing,
+                'corpus_key': corpus_key
+            })
+    if config.get('clusterSummary'):
+        result['cluster_summary'] = summary_to_json(summary)
+    return result
+
+# ---------------------------------------------------------------------------
+# Optional dimensionality reduction between anchor transform and HDBSCAN
+# ---------------------------------------------------------------------------
+
+REDUCERS = {
+    'pca': lambda dim: PCA(n_components=dim, svd_solver='randomized', random_state=0),
+    'svd': lambda dim: TruncatedSVD(n_components=dim, algorithm='randomized', random_state=0),
+    'random_projection': lambda dim: GaussianRandomProjection(n_components=dim, random_state=0),
+}
+
+def _reducer_usable(state, method, dim, features, config):
+    if state is None:
+        return False
+    if (state['method'], state['dim'], state['input_dim']) != (method, dim, features.shape[1]):
+        return False
+    # Refit once the corpus has grown well beyond the data the reducer was fitted on
+    return len(features) <= state['fitted_count'] * (1 + config.get('reductionRefitGrowth', 1.0))
+
+def reduce_features(features, config, timer=None, stats=None):
+    """
+    Reduce the anchor-transformed features to config.reductionDim dimensions with the method in
+    config.reduction ('pca', 'svd' or 'random_projection'). If the run persists state, the fitted
+    reducer is saved and reused by later runs. Returns (features, reducer); both unchanged if disabled.
+    """
+    method = config.get('reduction')
+    if not method:
+        return features, None
+    if method not in REDUCERS:
+        raise ValueError(f"Unknown reduction method '{method}'")
+
+    timer = timer or PhaseTimer()
+    dim = int(config.get('reductionDim', 32))
+    if method != 'random_projection':
+        dim = min(dim, len(features) - 1, features.shape[1] - 1)
+    if dim < 1 or dim >= features.shape[1]:
+        return features, None
+
+    persist = persists_state(config)
+    with timer.phase('reduction_fit'):
+        state = load_user_model(config, 'reducer.pkl') if persist else None
+        reused = _reducer_usable(state, method, dim, features, config)
+        if not reused:
+            reducer = REDUCERS[method](dim).fit(features)
+            state = {
+                'method': method,
+                'dim': dim,
+                'input_dim': features.shape[1],
+                'fitted_count': len(features),
+                'reducer': reducer
             }
+            if persist:
+                save_user_model(config, 'reducer.pkl', state)
+
+    with timer.phase('reduction_transform'):
+        reduced = state['reducer'].transform(features)
+
+    if stats is not None:
+        stats['reduction'] = {'method': method, 'dim': dim, 'reused': bool(reused)}
+    return reduced, state['reducer']
+
+# ---------------------------------------------------------------------------
+# Sparse k-NN graph: core distances and spanning tree for large corpora
+# ---------------------------------------------------------------------------
+
+KNN_BLOCK_ELEMENTS = 1 << 23  # distance entries computed per block (32 MB in float32)
+
+def _squared_norms(features):
+    return np.einsum('ij,ij->i', features, features)
+
+def knn_search(queries, points, k):
+    """
+    Exact k nearest neighbours (euclidean) of every query row among points, computed in row blocks
+    with one matrix product each, so memory stays bounded by KNN_BLOCK_ELEMENTS.
+    Returns (indices, distances), both sorted by distance.
+    """
+    k = min(k, len(points))
+    indices = np.empty((len(queries), k), dtype=np.int32)
+    distances = np.empty((len(queries), k), dtype=FEATURE_DTYPE)
+    point_norms = _squared_norms(points)
+    block = max(1, KNN_BLOCK_ELEMENTS // max(len(points), 1))
+
+    for start in range(0, len(queries), block):
+        chunk = queries[start:start + block]
+        squared = chunk @ points.T
+        squared *= -2
+        squared += point_norms
+        squared += _squared_norms(chunk)[:, None]
+        nearest = np.argpartition(squared, k - 1, axis=1)[:, :k]
+        nearest_squared = np.take_along_axis(squared, nearest, axis=1)
+        order = np.argsort(nearest_squared, axis=1, kind='stable')
+        indices[start:start + len(chunk)] = np.take_along_axis(nearest, order, axis=1)
+        distances[start:start + len(chunk)] = np.sqrt(np.maximum(
+            np.take_along_axis(nearest_squared, order, axis=1), 0
+        ))
+    return indices, distances
+
+def _merge_neighbors(indices, distances, candidate_indices, candidate_distances):
+    """Keep the k closest of the current and the candidate neighbours of every row."""
+    k = indices.shape[1]
+    merged_indices = np.concatenate([indices, candidate_indices], axis=1)
+    merged_distances = np.concatenate([distances, candidate_distances], axis=1)
+    order = np.argsort(merged_distances, axis=1, kind='stable')[:, :k]
+    return (
+        np.take_along_axis(merged_indices, order, axis=1),
+        np.take_along_axis(merged_distances, order, axis=1)
+    )
+
+def user_knn_graph(features, config, k):
+    """
+    k-NN graph of the features. If the run persists state, the graph is saved ('knn_graph.pkl'); if the
+    features of the previously indexed documents are unchanged and only documents were appended,
+    just the new rows are searched and the old rows merged with their new candidates.
+    """
+    persist = persists_state(config)
+    state = load_user_model(config, 'knn_graph.pkl') if persist else None
+    k = min(k, len(features))
+    hasher = hashlib.blake2b(digest_size=16)
+
+    indexed = 0
+    if (state is not None and (state['k'], state['dim']) == (k, features.shape[1])
+            and state['count'] <= len(features)):
+        hasher.update(memoryview(np.ascontiguousarray(features[:state['count']])).cast('B'))
+        if hasher.hexdigest() == state['digest']:
+            indexed = state['count']
+    if not indexed:
+        hasher = hashlib.blake2b(digest_size=16)
+
+    if indexed == len(features):
+        print(f"[INFO] Reusing k-NN graph of {indexed} documents", file=sys.stderr)
+        return state['indices'], state['distances']
+
+    if indexed:
+        print(f"[INFO] Extending k-NN graph from {indexed} to {len(features)} documents", file=sys.stderr)
+        added = features[indexed:]
+        new_indices, new_distances = knn_search(added, features, k)
+        candidate_indices, candidate_distances = knn_search(features[:indexed], added, k)
+        candidate_indices += indexed
+        old_indices, old_distances = _merge_neighbors(
+            state['indices'], state['distances'], candidate_indices, candidate_distances
+        )
+        indices = np.concatenate([old_indices, new_indices])
+        distances = np.concatenate([old_distances, new_distances])
+    else:
+        indices, distances = knn_search(features, features, k)
+
+    if persist:
+        hasher.update(memoryview(np.ascontiguousarray(features[indexed:])).cast('B'))
+        save_user_model(config, 'knn_graph.pkl', {
+            'k': k,
+            'dim': features.shape[1],
+            'count': len(features),
+            'digest': hasher.hexdigest(),
+            'indices': indices,
+            'distances': distances
+        })
+    return indices, distances
+
+def _link_components(features, component_labels, component_count):
+    """
+    Edges (a, b, distance) connecting the components of the k-NN spanning forest: a minimum
+    spanning tree (Prim, O(components) memory) over one representative per component, the member
+    closest to the component mean. These links only shape the top of the hierarchy.
+    """
+    sizes = np.bincount(component_labels, minlength=component_count)
+    centroids = np.zeros((component_count, features.shape[1]), dtype=np.float64)
+    np.add.at(centroids, component_labels, features)
+    centroids /= sizes[:, None]
+    spread = ((features - centroids[component_labels]) ** 2).sum(axis=1)
+    order = np.lexsort((spread, component_labels))
+    representatives = order[np.searchsorted(component_labels[order], np.arange(component_count))]
+    points = features[representatives].astype(np.float64)
+
+    in_tree = np.zeros(component_count, dtype=bool)
+    best = np.full(component_count, np.inf)
+    parent = np.zeros(component_count, dtype=np.int64)
+    current = 0
+    in_tree[current] = True
+    links = []
+    for _ in range(component_count - 1):
+        reach = np.sqrt(((points - points[current]) ** 2).sum(axis=1))
+        closer = reach < best
+        best[closer] = reach[closer]
+        parent[closer] = current
+        current = int(np.argmin(np.where(in_tree, np.inf, best)))
+        in_tree[current] = True
+        links.append((representatives[parent[current]], representatives[current], best[current]))
+    return links
+
+def knn_spanning_tree(features, indices, distances, core_distances):
+    """
+    Minimum spanning tree of the mutual reachability graph restricted to the k-NN edges, as
+    (a, b, distance) rows sorted by distance. Disconnected parts are joined by _link_components.
+    """
+    count, k = indices.shape
+    rows = np.repeat(np.arange(count), k)
+    columns = indices.ravel()
+    weights = np.maximum(distances.ravel().astype(np.float64),
+                         np.maximum(core_distances[rows], core_distances[columns]))
+    keep = rows != columns
+    # csgraph drops explicit zeros, so duplicates get the smallest positive weight instead
+    weights = np.maximum(weights[keep], np.finfo(np.float64).tiny)
+    graph = coo_matrix((weights, (rows[keep], columns[keep])), shape=(count, count)).tocsr()
+
+    forest = minimum_spanning_tree(graph).tocoo()
+    edges = np.column_stack([forest.row, forest.col, forest.data]).astype(np.float64)
+
+    component_count, component_labels = connected_components(forest, directed=False)
+    if component_count > 1:
+        print(f"[INFO] Linking {component_count} k-NN graph components", file=sys.stderr)
+        links = np.array([
+            (a, b, max(reach, core_distances[a], core_distances[b]))
+            for a, b, reach in _link_components(features, component_labels, component_count)
+        ], dtype=np.float64)
+        edges = np.concatenate([edges, links])
+
+    return edges[np.argsort(edges[:, 2], kind='stable')]
+
+def run_clustering(embeddings_data, config, timer=None):
+    """
+    Run the guided HDBSCAN pipeline on already loaded input data and return the result dict
+    (labels, probabilities, folder_context, clustering_stats). With config.timings the
+    per-phase timings are added as clustering_stats.timings.
+    """
+    timer = PhaseTimer.from_config(config, timer)
+
+    if config.get('source') == 'database':
+        # Node only sends userId and config; the embeddings are read directly from Postgres
+        from pg_embedding_reader import read_user_embeddings
+        with timer.phase('load_database'):
+            embeddings_data = read_user_embeddings(config['userId'], database_url=config.get('databaseUrl'))
+
+    if config.get('incremental'):
+        result = run_incremental_clustering(embeddings_data, config, timer)
+        return finish_result(result, embeddings_data, config, timer, persist_label_map=persists_state(config))
+
+    cache = ResultCache.from_config(config)
+    persist = persists_state(config)
+    corpus_key = None
+    if cache is not None or persist:
+        with timer.phase('cache_lookup'):
+            corpus_key = result_cache_key(embeddings_data, config)
+            cached = cache.get(corpus_key) if cache is not None else None
+            if cached is not None:
+                cached = result_from_cache(cached, config)
+        # The stored tree and summary must describe the returned result, otherwise recut and
+        # assign would work on another corpus; only a run that persists them can be skipped then
+        if cached is not None and persist and not persisted_state_matches(config, corpus_key):
+            print(f"[INFO] Ignoring cache hit ({corpus_key}), the stored state is from another run",
+                  file=sys.stderr)
+            cached = None
+        if cached is not None:
+            print(f"[INFO] Clustering cache hit ({corpus_key})", file=sys.stderr)
+            cached['clustering_stats']['cache_hit'] = True
+            return finish_result(cached, embeddings_data, config, timer, persist_label_map=persist)
+
+    features = prepare_features(embeddings_data, config, timer)
+    reduction_stats = {}
+    cluster_input, reducer = reduce_features(features['transformed'], config, timer, reduction_stats)
+
+    # Perform clustering
+    labels, probabilities, single_linkage_tree = fit_hdbscan(cluster_input, config, timer)
+    if persist:
+        with timer.phase('save_tree'):
+            save_linkage_tree(config, single_linkage_tree, features, embeddings_data.get('file_ids'), corpus_key)
+
+    with timer.phase('build_result'):
+        result = build_result(labels, probabilities, features)
+    result['clustering_stats'].update(reduction_stats)
+    add_cluster_summary(result, labels, probabilities, features, config, embeddings_data.get('file_ids'), timer,
+                        cluster_input, reducer, corpus_key)
+    if cache is not None:
+        result['clustering_stats']['cache_hit'] = False
+        with timer.phase('cache_store'):
+            # A reducer fitted on an earlier corpus makes the result depend on the user's history;
+            # an older entry for this key would no longer match the state this run stored
+            if reduction_stats.get('reduction', {}).get('reused'):
+                cache.discard(corpus_key)
+            else:
+                cache.put(corpus_key, cache_entry(result, config))
+    return finish_result(result, embeddings_data, config, timer, persist_label_map=persist)
+
+def finish_result(result, embeddings_data, config, timer, persist_label_map=False):
+    """
+    Attach the timings block if requested (it is never stored in the result cache) and, for
+    database input, the file id of every label. Given previous labels, the clusters are aligned to
+    them (see align_result_labels). persist_label_map records in the stored cluster summary which
+    of the returned labels each of its clusters now has (see summary_label_map). With
+    config.compactOutput, labels and probabilities are moved into a binary side file (see
+    write_compact_result).
+    """
+    if 'file_ids' in embeddings_data:
+        result['file_ids'] = embeddings_data['file_ids']
+    labels = np.asarray(result['labels'], dtype=np.int64) if 'labels' in result else None
+    previous = embeddings_data.get('previous_labels', config.get('previousLabels'))
+    if labels is not None and (previous is not None or config.get('labelDelta')):
+        with timer.phase('align_labels'):
+            labels = align_result_labels(result, previous, config)
+    if labels is not None and persist_label_map:
+        summary = load_user_model(config, 'cluster_summary.pkl')
+        if summary is not None and len(summary.get('labels', ())) == len(labels):
+            summary['label_map'] = summary_label_map(summary['labels'], labels)
+            save_user_model(config, 'cluster_summary.pkl', summary)
+    if config.get('compactOutput') and 'labels' in result:
+        with timer.phase('compact_output'):
+            result = write_compact_result(result, config['compactOutput'])
+    if PhaseTimer.enabled(config):
+        result['clustering_stats']['timings'] = timer.report()
+    return result
+
+# ---------------------------------------------------------------------------
+# Label alignment with the previous run and delta output
+# ---------------------------------------------------------------------------
+
+UNKNOWN_LABEL = -2  # previous label of a document that has never been clustered
+
+def previous_label_array(previous, count):
+    """Previous labels (None for never clustered documents) as an int64 array of length count."""
+    if previous is None:
+        return np.full(count, UNKNOWN_LABEL, dtype=np.int64)
+    if len(previous) != count:
+        raise ValueError(f"Got {len(previous)} previous labels for {count} documents")
+    return np.array([UNKNOWN_LABEL if value is None else int(value) for value in previous], dtype=np.int64)
+
+def align_labels(labels, previous):
+    """
+    Map every new cluster id to a previous cluster id by Hungarian matching on the number of shared
+    documents, so that HDBSCAN's arbitrary numbering does not permute between runs. New clusters
+    without a partner get fresh ids above all previous ones. Returns {new id: aligned id}.
+    """
+    new_ids = np.unique(labels[labels >= 0])
+    old_ids = np.unique(previous[previous >= 0])
+    mapping = {}
+    shared = (labels >= 0) & (previous >= 0)
+    if shared.any():
+        overlap = coo_matrix(
+            (np.ones(np.count_nonzero(shared)),
+             (np.searchsorted(new_ids, labels[shared]), np.searchsorted(old_ids, previous[shared]))),
+            shape=(len(new_ids), len(old_ids))
+        ).toarray()
+        # Only clusters that share documents take part in the matching
+        rows = np.flatnonzero(overlap.any(axis=1))
+        columns = np.flatnonzero(overlap.any(axis=0))
+        matched_rows, matched_columns = linear_sum_assignment(overlap[np.ix_(rows, columns)], maximize=True)
+        mapping = dict(zip(new_ids[rows[matched_rows]].tolist(), old_ids[columns[matched_columns]].tolist()))
+
+    next_id = int(old_ids[-1]) + 1 if len(old_ids) else 0
+    for new_id in new_ids.tolist():
+        if new_id not in mapping:
+            mapping[new_id] = next_id
+            next_id += 1
+    return mapping
+
+def summary_label_map(summary_labels, labels):
+    """
+    {summary cluster id: label} with the label most members of every cluster of a stored summary have
+    in labels (-1 if all of them are noise now). For the run that wrote the summary this is just its
+    alignment; after a recut the summary still routes by the clusters of the full run.
+    """
+    summary_labels = np.asarray(summary_labels, dtype=np.int64)
+    both = (summary_labels >= 0) & (labels >= 0)
+    pairs, counts = np.unique(np.stack([summary_labels[both], labels[both]]), axis=1, return_counts=True)
+    order = np.lexsort((-counts, pairs[0]))
+    clusters, first = np.unique(pairs[0][order], return_index=True)
+    label_map = {cluster_id: -1 for cluster_id in range(int(summary_labels.max(initial=-1)) + 1)}
+    label_map.update(zip(clusters.tolist(), pairs[1][order][first].tolist()))
+    return label_map
+
+def align_result_labels(result, previous, config):
+    """
+    Relabel the result with align_labels and add label_changes: the rows (and file ids, if known)
+    whose label differs from the previous one, with their new labels. With config.labelDelta, the
+    full labels and probabilities lists are dropped, so only the changes are returned. Returns the
+    aligned labels.
+    """
+    labels = np.asarray(result['labels'], dtype=np.int64)
+    previous = previous_label_array(previous, len(labels))
+    mapping = align_labels(labels, previous)
+
+    lookup = np.full(int(labels.max(initial=-1)) + 1, -1, dtype=np.int64)
+    lookup[np.fromiter(mapping, dtype=np.int64)] = np.fromiter(mapping.values(), dtype=np.int64)
+    aligned = labels.copy()
+    clustered = labels >= 0
+    aligned[clustered] = lookup[labels[clustered]]
+
+    changed = np.flatnonzero(aligned != previous)
+    result['labels'] = aligned.tolist()
+    result['label_changes'] = {'rows': changed.tolist(), 'labels': aligned[changed].tolist()}
+    if result.get('file_ids') is not None:
+        file_ids = result['file_ids']
+        result['label_changes']['file_ids'] = [file_ids[row] for row in changed.tolist()]
+
+    stats = result['clustering_stats']
+    if 'cluster_sizes' in stats:
+        stats['cluster_sizes'] = sorted((mapping[label_id], size) for label_id, size in stats['cluster_sizes'])
+    for entry in result.get('cluster_summary', []):
+        entry['label'] = mapping[entry['label']]
+    stats['documents'] = len(labels)
+    stats['changed_labels'] = len(changed)
+    stats['matched_clusters'] = int(np.count_nonzero(np.isin(list(mapping.values()), previous)))
+
+    if config.get('labelDelta'):
+        result.pop('labels')
+        result.pop('probabilities', None)
+    return aligned
+
+# ---------------------------------------------------------------------------
+# Compact result encoding
+# ---------------------------------------------------------------------------
+
+# Side file layout (little endian): header, int32 labels[count], uint8 probabilities[count]
+COMPACT_MAGIC = b'IDCR'
+COMPACT_VERSION = 1
+COMPACT_HEADER = struct.Struct('<4sHHI')  # magic, version, reserved, count
+PROBABILITY_SCALE = 255
+
+def write_compact_result(result, target):
+    """
+    Write labels as int32 and probabilities quantized to uint8 (p * 255, rounded) into a binary
+    side file and replace both lists in the result by a reference to it. target is the file path,
+    or True for a new file in the temp directory; the reader is responsible for deleting it.
+    """
+    labels = np.asarray(result['labels'], dtype='<i4')
+    probabilities = np.asarray(result.get('probabilities', np.zeros(len(labels))), dtype=np.float64)
+    quantized = np.rint(np.clip(probabilities, 0, 1) * PROBABILITY_SCALE).astype(np.uint8)
+
+    if target is True:
+        handle, path = tempfile.mkstemp(prefix='clustering_result_', suffix='.bin')
+        os.close(handle)
+    else:
+        path = str(target)
+    with open(path, 'wb') as f:
+        f.write(COMPACT_HEADER.pack(COMPACT_MAGIC, COMPACT_VERSION, 0, len(labels)))
+        f.write(labels.tobytes())
+        f.write(quantized.tobytes())
+
+    compact = {key: value for key, value in result.items() if key not in ('labels', 'probabilities')}
+    compact['compact_output'] = {
+        'path': path,
+        'count': len(labels),
+        'labels_offset': COMPACT_HEADER.size,
+        'probabilities_offset': COMPACT_HEADER.size + labels.nbytes,
+        'probability_scale': PROBABILITY_SCALE
+    }
+    return compact
+
+def read_compact_result(path):
+    """Inverse of write_compact_result: (int32 labels, float probabilities) from a side file."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, _, count = COMPACT_HEADER.unpack_from(data, 0)
+    if magic != COMPACT_MAGIC or version != COMPACT_VERSION:
+        raise ValueError(f"Unsupported compact result file '{path}'")
+    labels = np.frombuffer(data, dtype='<i4', count=count, offset=COMPACT_HEADER.size)
+    quantized = np.frombuffer(data, dtype=np.uint8, count=count, offset=COMPACT_HEADER.size + 4 * count)
+    return labels, quantized / PROBABILITY_SCALE
+
+def result_size(result):
+    """Number of documents in a (possibly compact) result, for the [METRIC] log line."""
+    if 'compact_output' in result:
+        return result['compact_output']['count']
+    if 'labels' not in result:
+        return result.get('clustering_stats', {}).get('documents', 0)
+    return len(result['labels'])
+
+# ---------------------------------------------------------------------------
+# Content-addressed result cache
+# ---------------------------------------------------------------------------
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'intellidoc_clustering_cache')
+
+# Defaults applied before hashing so that {} and the explicit defaults share a cache entry
+CONFIG_DEFAULTS = {
+    'minClusterSize': 2,
+    'minSamples': 2,
+    'clusterSelectionMethod': 'eom',
+    'clusterSelectionEpsilon': 0.15,
+    'anchorInfluence': 0.45,
+    'semanticThreshold': 0.7,
+}
+
+# Config keys that do not influence the clustering result. The cluster summary options only add a
+# block to it, which result_from_cache checks on a hit. userId is ignored as well: the same input
+# gives the same result for every user, and the per-user side effects are handled in run_clustering
+# (a run that persists state only takes a hit if the stored state was written for the same key, and
+# results computed with a reused persisted reducer are never cached).
+CACHE_IGNORED_KEYS = {
+    'userId', 'persistState', 'cache', 'cacheDir', 'cacheMaxBytes', 'cacheMaxAge', 'modelDir', 'compactOutput',
+    'previousLabels', 'labelDelta', 'timings', 'traceMemory', 'source', 'databaseUrl', 'clusterSummary',
+    'exemplarCount'
+}
+
+def normalized_config(config):
+    """Config with defaults applied, result-neutral keys removed and numbers as floats."""
+    normalized = {**CONFIG_DEFAULTS, **config}
+    return {
+        key: float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else value
+        for key, value in sorted(normalized.items())
+        if key not in CACHE_IGNORED_KEYS
+    }
+
+def result_cache_key(embeddings_data, config):
+    """Hash of the embedding matrices, folder ids, folder assignments and normalized config."""
+    hasher = hashlib.blake2b(digest_size=16)
+
+    def update_matrix(matrix):
+        matrix = np.ascontiguousarray(matrix)
+        hasher.update(f"{matrix.dtype.str}{matrix.shape}".encode('utf-8'))
+        hasher.update(memoryview(matrix).cast('B'))
+
+    update_matrix(np.asarray(embeddings_data.get('doc_embeddings', [])))
+    folder_embeddings = embeddings_data.get('folder_embeddings', {})
+    hasher.update(json.dumps(list(folder_embeddings.keys())).encode('utf-8'))
+    if folder_embeddings:
+        update_matrix(np.asarray(list(folder_embeddings.values())))
+    hasher.update(json.dumps(embeddings_data.get('doc_to_folder_map', {}), sort_keys=True).encode('utf-8'))
+    hasher.update(json.dumps(normalized_config(config), sort_keys=True).encode('utf-8'))
+    return hasher.hexdigest()
+
+def cache_entry(result, config):
+    """The result as stored in the cache, with the exemplar count of its cluster summary."""
+    if 'cluster_summary' not in result:
+        return result
+    return {**result, 'summary_exemplar_count': int(config.get('exemplarCount', 5))}
+
+def result_from_cache(entry, config):
+    """
+    The cached result as config would have produced it: without the cluster summary unless
+    config.clusterSummary is set, or None if the entry has none built with config.exemplarCount.
+    """
+    exemplar_count = entry.pop('summary_exemplar_count', None)
+    if not config.get('clusterSummary'):
+        entry.pop('cluster_summary', None)
+        return entry
+    return entry if exemplar_count == int(config.get('exemplarCount', 5)) else None
+
+class ResultCache:
+    """
+    On-disk LRU cache of clustering results (one JSON file per key). Hits refresh the file's
+    mtime; entries older than max_age seconds are dropped and the least recently used entries
+    are evicted while the cache exceeds max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes=256 * 1024 * 1024, max_age=24 * 60 * 60):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config):
+        """Return the cache if enabled by config.cache or CLUSTERING_CACHE=true, else None."""
+        if not config.get('cache', os.environ.get('CLUSTERING_CACHE') == 'true'):
+            return None
+        return cls(
+            config.get('cacheDir') or os.environ.get('CLUSTERING_CACHE_DIR', DEFAULT_CACHE_DIR),
+            max_bytes=int(config.get('cacheMaxBytes', 256 * 1024 * 1024)),
+            max_age=float(config.get('cacheMaxAge', 24 * 60 * 60))
+        )
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                os.unlink(path)
+                return None
+            with open(path, 'r') as f:
+                result = json.load(f)
+            os.utime(path)
+            return result
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def discard(self, key):
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def put(self, key, result):
+        path = self._path(key)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(result, f)
+        os.replace(temp_path, path)
+        self.evict()
+
+    def evict(self):
+        """Drop expired entries, then the least recently used ones until the size limit holds."""
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if now - stat.st_mtime > self.max_age:
+                self._remove(entry.path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            self._remove(path)
+            total_bytes -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+# ---------------------------------------------------------------------------
+# Per-user model store
+# ---------------------------------------------------------------------------
+
+DEFAULT_MODEL_DIR = os.path.join(tempfile.gettempdir(), 'intellidoc_clustering')
+
+_user_locks = {}
+_user_locks_guard = threading.Lock()
+
+def persists_state(config):
+    """
+    True if the run clusters the user's whole corpus and saves its state (tree, cluster summary,
+    reducer, k-NN graph) for later runs, recut and assign. Only the corpus-level callers set
+    config.persistState; a clustering of e.g. search hits must not replace the user's state.
+    """
+    return bool(config.get('persistState')) and config.get('userId') is not None
+
+def persisted_state_matches(config, corpus_key):
+    """True if the stored tree and cluster summary were both written by a run on corpus_key."""
+    return all(
+        (state := load_user_model(config, name)) is not None and state.get('corpus_key') == corpus_key
+        for name in ('linkage_tree.pkl', 'cluster_summary.pkl')
+    )
+
+def load_corpus_state(config, name):
+    """
+    Load the tree or cluster summary of the user's last corpus clustering. Artifacts without a
+    corpus key were written before persistence required persistState and may come from a clustering
+    of search hits, so they are treated as missing.
+    """
+    state = load_user_model(config, name)
+    return state if state is not None and state.get('corpus_key') is not None else None
+
+def user_lock(config):
+    """Lock serializing state updates of one user inside a (server) process."""
+    with _user_locks_guard:
+        return _user_locks.setdefault(str(config.get('userId')), threading.Lock())
+
+def user_model_path(config, name):
+    """Path of a persisted per-user artifact, e.g. user_model_path(config, 'clusterer.pkl')."""
+    user_id = config.get('userId')
+    if user_id is None:
+        raise ValueError("userId is required for persisted clustering state")
+    model_dir = config.get('modelDir') or os.environ.get('CLUSTERING_MODEL_DIR', DEFAULT_MODEL_DIR)
+    return os.path.join(model_dir, f"user_{int(user_id)}", name)
+
+def load_user_model(config, name):
+    """Load a persisted per-user artifact, or None if it does not exist or cannot be read."""
+    path = user_model_path(config, name)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except Exception as e:
+        print(f"[ERROR] Could not load {path}: {str(e)}", file=sys.stderr)
+        return None
+
+def save_user_model(config, name, state):
+    """Persist a per-user artifact atomically (write to a temp file, then rename)."""
+    path = user_model_path(config, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
+
+# ---------------------------------------------------------------------------
+# Incremental mode: assign new documents with the persisted clusterer
+# ---------------------------------------------------------------------------
+
+# Config keys that change the fitted model; a different value forces a refit
+MODEL_CONFIG_KEYS = (
+    'minClusterSize', 'minSamples', 'clusterSelectionMethod',
+    'clusterSelectionEpsilon', 'anchorInfluence', 'semanticThreshold',
+    'reduction', 'reductionDim'
+)
+FINGERPRINT_ROWS = 32
+
+def model_signature(config):
+    return {key: config.get(key) for key in MODEL_CONFIG_KEYS}
+
+def _fingerprint_rows(doc_count):
+    """Evenly spaced row indices used to detect changes of already clustered documents."""
+    return np.unique(np.linspace(0, doc_count - 1, num=min(doc_count, FINGERPRINT_ROWS)).astype(int))
+
+def folder_fingerprint(folder_embeddings):
+    """Hash of the folder ids and embeddings the anchor transform of the fitted model was based on."""
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(json.dumps(list(folder_embeddings.keys())).encode('utf-8'))
+    if folder_embeddings:
+        hasher.update(as_features(list(folder_embeddings.values())).tobytes())
+    return hasher.hexdigest()
+
+def refit_reason(state, embeddings_data, features, config):
+    """Return why the persisted clusterer cannot be reused, or None if new documents can be assigned."""
+    if state is None:
+        return 'no persisted model'
+    if state['signature'] != model_signature(config):
+        return 'config changed'
+    # Renamed, added or removed folders and changed folder embeddings alike change the guided features
+    if state.get('folder_fingerprint') != folder_fingerprint(embeddings_data.get('folder_embeddings', {})):
+        return 'folders changed'
+
+    known = state['doc_count']
+    doc_count = features['doc_count']
+    if doc_count < known:
+        return 'documents removed'
+    if doc_count < config.get('incrementalMinDocuments', 50):
+        return 'corpus below incremental minimum'
+
+    rows = state['fingerprint_rows']
+    if not np.allclose(features['normalized_docs'][rows], state['fingerprint'], atol=1e-6):
+        return 'existing documents changed'
+
+    doc_to_folder_map = embeddings_data.get('doc_to_folder_map', {})
+    known_map = {k: v for k, v in doc_to_folder_map.items() if int(k) < known}
+    if known_map != state['doc_to_folder_map']:
+        return 'folder assignments changed'
+
+    # Size threshold: too many documents added since the last fit
+    added_total = doc_count - state['fitted_count']
+    if added_total > config.get('refitGrowthRatio', 0.25) * state['fitted_count']:
+        return 'growth threshold reached'
+
+    # Drift threshold: too many assigned documents ended up as noise
+    assigned = state['assigned_count'] + (doc_count - known)
+    noise = state['assigned_noise']
+    if assigned >= config.get('refitMinAssigned', 5) and noise / assigned > config.get('refitNoiseRatio', 0.5):
+        return 'noise drift threshold reached'
+
+    return None
+
+# Parts of the incremental state that change with every incremental run. They are saved on their own
+# ('clusterer_progress.pkl'), so the fitted clusterer is only pickled again by a refit.
+PROGRESS_STATE_KEYS = (
+    'doc_count', 'assigned_count', 'assigned_noise', 'doc_to_folder_map', 'labels', 'probabilities',
+    'folder_affinities'
+)
+
+def load_incremental_state(config):
+    """The state of the last refit, updated by the progress of the incremental runs since then."""
+    state = load_user_model(config, 'clusterer.pkl')
+    if state is None:
+        return None
+    progress = load_user_model(config, 'clusterer_progress.pkl')
+    if progress is not None and progress['fit_id'] == state.get('fit_id'):
+        state.update({key: progress[key] for key in PROGRESS_STATE_KEYS})
+    return state
+
+def _new_state(features, embeddings_data, config, clusterer, labels, probabilities):
+    doc_count = features['doc_count']
+    rows = _fingerprint_rows(doc_count)
+    return {
+        'fit_id': os.urandom(8).hex(),
+        'signature': model_signature(config),
+        'clusterer': clusterer,
+        # Anchor-transform parameters needed to project new documents
+        'folder_ids': features['folder_ids'],
+        'folder_matrix': features['folder_matrix'],
+        'folder_fingerprint': folder_fingerprint(embeddings_data.get('folder_embeddings', {})),
+        'anchor_influence': config.get('anchorInfluence', 0.45),
+        'semantic_threshold': config.get('semanticThreshold', 0.7),
+        'doc_count': doc_count,
+        'fitted_count': doc_count,
+        'assigned_count': 0,
+        'assigned_noise': 0,
+        'fingerprint_rows': rows,
+        'fingerprint': features['normalized_docs'][rows].copy(),
+        'doc_to_folder_map': dict(embeddings_data.get('doc_to_folder_map', {})),
+        'labels': labels,
+        'probabilities': probabilities,
+        'folder_affinities': features['folder_affinities']
+    }
+
+def incremental_corpus_key(embeddings_data, config):
+    # Key for the summary of an incremental run, so assign accepts it as corpus state
+    return result_cache_key(embeddings_data, config) if persists_state(config) else None
+
+def run_incremental_clustering(embeddings_data, config, timer=None):
+    """
+    Assign documents appended since the last run with approximate_predict on the persisted
+    clusterer; fall back to a full fit (with prediction data) when a refit threshold is crossed.
+    Only a refit saves the clusterer, incremental runs save their progress (PROGRESS_STATE_KEYS).
+    """
+    timer = timer or PhaseTimer()
+    with user_lock(config):
+        with timer.phase('load_model'):
+            state = load_incremental_state(config)
+        doc_embeddings = as_features(embeddings_data.get('doc_embeddings', []))
+        folder_embeddings = embeddings_data.get('folder_embeddings', {})
+        known = state['doc_count'] if state else 0
+
+        # Only the new rows go through the anchor transform; everything else comes from the state
+        features = {
+            'doc_count': len(doc_embeddings),
+            'normalized_docs': normalize(doc_embeddings),
+            'folder_ids': list(folder_embeddings.keys()),
+            'folder_similarities': None
         }
-        
-        # Output final result
-        print(json.dumps(result))
-        
+        reason = refit_reason(state, embeddings_data, features, config)
+
+        if reason is not None:
+            print(f"[INFO] Full refit ({reason})", file=sys.stderr)
+            features = prepare_features(embeddings_data, config, timer)
+            # The incremental model keeps its own reducer, fitted together with the clusterer
+            cluster_input, reducer = reduce_features(features['transformed'], {**config, 'persistState': False},
+                                                     timer)
+            clusterer = make_clusterer(config, prediction_data=True)
+            with timer.phase('hdbscan_fit'):
+                labels = clusterer.fit_predict(cluster_input)
+            probabilities = clusterer.probabilities_
+            state = _new_state(features, embeddings_data, config, clusterer, labels, probabilities)
+            state['reducer'] = reducer
+            with timer.phase('save_model'):
+                save_user_model(config, 'clusterer.pkl', state)
+            result = build_result(labels, probabilities, features)
+            result['clustering_stats'].update(mode='refit', refit_reason=reason, assigned_documents=0)
+            return add_cluster_summary(result, labels, probabilities, features, config,
+                                       embeddings_data.get('file_ids'), timer, cluster_input, reducer,
+                                       incremental_corpus_key(embeddings_data, config))
+
+        new_docs = features['normalized_docs'][known:]
+        folder_affinities = dict(state['folder_affinities'])
+        if state['folder_ids']:
+            new_transformed, folder_similarities, new_affinities = anchor_transform(
+                new_docs, state['folder_matrix'], state['folder_ids'],
+                embeddings_data.get('doc_to_folder_map', {}), config, start_index=known, timer=timer
+            )
+            folder_affinities.update(new_affinities)
+            features['folder_similarities'] = folder_similarities
+        else:
+            new_transformed = new_docs
+
+        if len(new_transformed) and state.get('reducer') is not None:
+            with timer.phase('reduction_transform'):
+                new_transformed = state['reducer'].transform(new_transformed)
+
+        if len(new_transformed):
+            with timer.phase('approximate_predict'):
+                new_labels, new_probabilities = hdbscan.approximate_predict(state['clusterer'], new_transformed)
+        else:
+            new_labels = np.empty(0, dtype=state['labels'].dtype)
+            new_probabilities = np.empty(0)
+
+        labels = np.concatenate([state['labels'], new_labels])
+        probabilities = np.concatenate([state['probabilities'], new_probabilities])
+        features['folder_affinities'] = folder_affinities
+
+        state.update(
+            doc_count=len(labels),
+            assigned_count=state['assigned_count'] + len(new_labels),
+            assigned_noise=state['assigned_noise'] + int(np.count_nonzero(new_labels == -1)),
+            doc_to_folder_map=dict(embeddings_data.get('doc_to_folder_map', {})),
+            labels=labels,
+            probabilities=probabilities,
+            folder_affinities=folder_affinities
+        )
+        with timer.phase('save_model'):
+            save_user_model(config, 'clusterer_progress.pkl', {
+                'fit_id': state['fit_id'], **{key: state[key] for key in PROGRESS_STATE_KEYS}
+            })
+
+        result = build_result(labels, probabilities, features)
+        result['clustering_stats'].update(mode='incremental', assigned_documents=int(len(new_labels)))
+        if config.get('includeMembership') and len(new_transformed) and labels.max() >= 0:
+            result['membership_vectors'] = hdbscan.membership_vector(state['clusterer'], new_transformed).tolist()
+        # The routing model needs the clustering features of all documents, not just the new ones
+        features['folder_matrix'] = state['folder_matrix']
+        cluster_input = clustering_input(
+            features['normalized_docs'], state['folder_ids'], state['folder_matrix'],
+            embeddings_data.get('doc_to_folder_map', {}), config, state.get('reducer')
+        )
+        return add_cluster_summary(result, labels, probabilities, features, config,
+                                   embeddings_data.get('file_ids'), timer, cluster_input, state.get('reducer'),
+                                   incremental_corpus_key(embeddings_data, config))
+
+# ---------------------------------------------------------------------------
+# Recut mode: new cluster selection from the persisted single-linkage tree
+# ---------------------------------------------------------------------------
+
+# Config keys that shape the single-linkage tree; everything else (minClusterSize,
+# clusterSelectionMethod, clusterSelectionEpsilon) can be changed by a recut
+TREE_CONFIG_KEYS = (
+    'minSamples', 'anchorInfluence', 'semanticThreshold',
+    'reduction', 'reductionDim', 'knnGraph', 'knnNeighbors'
+)
+SELECTION_CONFIG_KEYS = ('minClusterSize', 'clusterSelectionMethod', 'clusterSelectionEpsilon')
+
+def save_linkage_tree(config, single_linkage_tree, features, file_ids=None, corpus_key=None):
+    """Persist the single-linkage tree of a full fit together with what build_result needs."""
+    save_user_model(config, 'linkage_tree.pkl', {
+        'signature': {key: config.get(key) for key in TREE_CONFIG_KEYS},
+        'selection': {key: config[key] for key in SELECTION_CONFIG_KEYS if key in config},
+        'single_linkage_tree': single_linkage_tree,
+        'doc_count': features['doc_count'],
+        'folder_ids': features['folder_ids'],
+        'folder_affinities': features['folder_affinities'],
+        'file_ids': file_ids,
+        'corpus_key': corpus_key
+    })
+
+def run_recut(embeddings_data, config, timer=None):
+    """
+    Select new flat clusters from the single-linkage tree stored by the last full clustering of
+    config.userId with persistState, without loading embeddings or refitting. Only the selection parameters may
+    differ from that run; omitted ones keep their previous values. config.previousLabels may also map
+    file ids to their stored labels; the result is aligned to them like a full run, and the cluster
+    summary of the full run learns which of the new labels its clusters correspond to (for assign).
+    """
+    timer = PhaseTimer.from_config(config, timer)
+    with timer.phase('load_tree'):
+        state = load_corpus_state(config, 'linkage_tree.pkl')
+    if state is None:
+        raise ValueError("No stored clustering tree for this user, run a full clustering with persistState first")
+
+    changed = [key for key in TREE_CONFIG_KEYS if key in config and config[key] != state['signature'][key]]
+    if changed:
+        raise ValueError(f"Cannot recut with changed {', '.join(changed)}, run a full clustering instead")
+
+    selection = {**state['selection'], **{key: config[key] for key in SELECTION_CONFIG_KEYS if key in config}}
+    with timer.phase('hdbscan_condense_tree'):
+        labels, probabilities, _ = select_clusters(state['single_linkage_tree'], selection)
+
+    features = {
+        'doc_count': state['doc_count'],
+        'folder_ids': state['folder_ids'],
+        'folder_affinities': state['folder_affinities'],
+        'folder_similarities': None
+    }
+    with timer.phase('build_result'):
+        result = build_result(labels, probabilities, features)
+    result['clustering_stats']['mode'] = 'recut'
+    stored = {'file_ids': state['file_ids']} if state['file_ids'] is not None else {}
+    previous = config.get('previousLabels')
+    if isinstance(previous, dict):
+        # Without file ids the rows cannot be matched, and the caller cannot store the labels either
+        file_ids = state['file_ids']
+        config = {**config, 'previousLabels': None if file_ids is None else [
+            previous.get(str(file_id)) for file_id in file_ids
+        ]}
+    return finish_result(result, stored, config, timer,
+                         persist_label_map=persisted_state_matches(config, state['corpus_key']))
+
+# ---------------------------------------------------------------------------
+# Assign mode: place one new document with the persisted cluster summary
+# ---------------------------------------------------------------------------
+
+def run_assign(embeddings_data, config, timer=None):
+    """
+    Assign one new document (the single row of doc_embeddings; config.folderId if it already lies
+    in a folder) to a cluster of config.userId, using only the cluster summary persisted by the last
+    full clustering with persistState, so clusterings of search hits never change the answer. The
+    document goes through the anchor transform and reduction of the fitted run and is routed to
+    the centroid that is closest relative to the cluster's median member distance. It is noise if
+    it lies more than config.assignTolerance (default 10 %) beyond the farthest member; the
+    probability is the share of members lying farther away.
+    """
+    timer = PhaseTimer.from_config(config, timer)
+    with timer.phase('load_summary'):
+        summary = load_corpus_state(config, 'cluster_summary.pkl')
+    if summary is None or summary.get('routing') is None:
+        raise ValueError("No stored cluster summary for this user, run a full clustering with persistState first")
+    routing = summary['routing']
+
+    doc_embeddings = as_features(embeddings_data.get('doc_embeddings', []))
+    if doc_embeddings.ndim != 2 or len(doc_embeddings) != 1:
+        raise ValueError("assign expects exactly one document embedding")
+
+    with timer.phase('anchor_transform'):
+        normalized_doc = normalize(doc_embeddings)
+        folder_id = config.get('folderId')
+        doc_to_folder_map = {}
+        if folder_id is not None and str(folder_id) in routing['folder_ids']:
+            doc_to_folder_map = {'0': str(folder_id)}
+        anchor_config = {
+            'anchorInfluence': routing['anchorInfluence'],
+            'semanticThreshold': routing['semanticThreshold']
+        }
+        features = clustering_input(
+            normalized_doc, routing['folder_ids'], routing['folder_matrix'],
+            doc_to_folder_map, anchor_config, routing['reducer']
+        )
+        folder_affinities = {}
+        if routing['folder_ids']:
+            folder_affinities = sparse_affinities(
+                cosine_similarities(normalized_doc, routing['folder_matrix']),
+                routing['folder_ids'], routing['semanticThreshold']
+            ).get('0', {})
+
+    with timer.phase('route'):
+        quantiles = routing['distance_quantiles']
+        label_id, probability, distance = -1, 0.0, None
+        if len(quantiles):
+            distances = np.linalg.norm(routing['centroids'] - features[0], axis=1)
+            scale = np.maximum(quantiles[:, ROUTING_QUANTILES // 2], np.finfo(FEATURE_DTYPE).tiny)
+            nearest = int(np.argmin(distances / scale))
+            distance = float(distances[nearest])
+            # The farthest of n members underestimates the extent of the cluster, hence the tolerance
+            if distance <= quantiles[nearest, -1] * (1 + config.get('assignTolerance', 0.1)):
+                label_id = nearest
+                probability = float(1 - np.interp(distance, quantiles[nearest], np.linspace(0, 1, ROUTING_QUANTILES)))
+
+    exemplars = []
+    if label_id >= 0:
+        exemplars = [int(index) for index in summary['exemplars'][label_id] if index >= 0]
+        if summary['file_ids'] is not None:
+            exemplars = [summary['file_ids'][index] for index in exemplars]
+        # Report the label the cluster has in the stored labels (aligned, possibly recut since)
+        label_id = summary.get('label_map', {}).get(label_id, label_id)
+        if label_id < 0:
+            probability, exemplars = 0.0, []
+
+    result = {
+        'label': label_id,
+        'probability': probability,
+        'distance': distance,
+        'exemplars': exemplars,
+        'folder_affinities': folder_affinities,
+        'clustering_stats': {
+            'mode': 'assign',
+            'num_clusters': int(len(quantiles)),
+            'corpus_key': summary['corpus_key']
+        }
+    }
+    return finish_result(result, {}, config, timer)
+
+# ---------------------------------------------------------------------------
+# Sweep mode: evaluate a parameter grid with shared intermediate results
+# ---------------------------------------------------------------------------
+
+def relative_validity(labels, spanning_tree):
+    """
+    Cheap density-based validity score in [-1, 1] computed on the minimum spanning tree (the DBCV
+    approximation behind hdbscan's relative_validity_); higher is better, 0 without clusters.
+    """
+    cluster_count = int(labels.max()) + 1
+    if cluster_count < 1:
+        return 0.0
+    a = labels[spanning_tree[:, 0].astype(np.intp)]
+    b = labels[spanning_tree[:, 1].astype(np.intp)]
+    weights = spanning_tree[:, 2]
+
+    # Sparseness: longest edge inside a cluster; separation: shortest edge to another cluster
+    inside = (a == b) & (a >= 0)
+    sparseness = np.zeros(cluster_count)
+    np.maximum.at(sparseness, a[inside], weights[inside])
+    between = (a != b) & (a >= 0) & (b >= 0)
+    separation = np.full(cluster_count, np.inf)
+    np.minimum.at(separation, a[between], weights[between])
+    np.minimum.at(separation, b[between], weights[between])
+
+    # Clusters without an edge to another cluster get a large separation, as in hdbscan
+    to_noise = (a == -1) != (b == -1)
+    if cluster_count > 1 or not to_noise.any():
+        correction = 2 * weights.max()
+    else:
+        correction = 2 * weights[to_noise].min()
+    separation[np.isinf(separation)] = correction
+
+    denominators = np.maximum(separation, sparseness)
+    validity = np.divide(separation - sparseness, denominators,
+                         out=np.zeros(cluster_count), where=denominators > 0)
+    sizes = np.bincount(labels[labels >= 0], minlength=cluster_count)
+    return float((sizes * validity).sum() / len(labels))
+
+def _grid_values(config, key):
+    values = config.get('grid', {}).get(key, config.get(key, CONFIG_DEFAULTS[key]))
+    return values if isinstance(values, list) else [values]
+
+def run_sweep(embeddings_data, config, timer=None):
+    """
+    Evaluate every combination of the lists in config.grid (parameters without a list use the
+    config value). The anchor transform runs once per anchorInfluence/semanticThreshold pair,
+    the neighbour distances once per transform and the spanning tree once per minSamples; only
+    the cluster selection runs per combination. Returns the table sorted by validity.
+    """
+    timer = PhaseTimer.from_config(config, timer)
+    # Nothing of a sweep is persisted as user state
+    config = {key: value for key, value in config.items() if key != 'userId'}
+    grid = {key: _grid_values(config, key) for key in CONFIG_DEFAULTS}
+    grid['minSamples'] = _grid_values({'minSamples': 2, **config}, 'minSamples')
+
+    table = []
+    trees = 0
+    for anchor_influence, semantic_threshold in itertools.product(grid['anchorInfluence'], grid['semanticThreshold']):
+        transform_config = {**config, 'anchorInfluence': anchor_influence, 'semanticThreshold': semantic_threshold}
+        features = prepare_features(embeddings_data, transform_config, timer)
+        cluster_input, _ = reduce_features(features['transformed'], transform_config, timer)
+        min_samples_values = sorted({
+            effective_min_samples({'minSamples': value}, len(cluster_input)) for value in grid['minSamples']
+        })
+
+        # One neighbour query serves the core distances of every minSamples value
+        with timer.phase('hdbscan_core_distances'):
+            if config.get('knnGraph'):
+                tree_input = as_features(cluster_input)
+                neighbors = max(int(config.get('knnNeighbors', 15)), min_samples_values[-1] + 1)
+                indices, distances = knn_search(tree_input, tree_input, neighbors)
+            else:
+                tree_input = np.ascontiguousarray(cluster_input, dtype=np.float64)
+                distances = neighbor_distances(tree_input, min_samples_values[-1] + 1)
+
+        for min_samples in min_samples_values:
+            core_distances = distances[:, min_samples].astype(np.float64)
+            with timer.phase('hdbscan_spanning_tree'):
+                if config.get('knnGraph'):
+                    spanning_tree = knn_spanning_tree(tree_input, indices, distances, core_distances)
+                else:
+                    spanning_tree = build_spanning_tree(tree_input, core_distances)
+                single_linkage_tree = label(spanning_tree)
+            trees += 1
+
+            for min_cluster_size, method, epsilon in itertools.product(
+                    grid['minClusterSize'], grid['clusterSelectionMethod'], grid['clusterSelectionEpsilon']):
+                selection = {
+                    'minClusterSize': min_cluster_size,
+                    'clusterSelectionMethod': method,
+                    'clusterSelectionEpsilon': epsilon
+                }
+                with timer.phase('hdbscan_condense_tree'):
+                    labels, _, _ = select_clusters(single_linkage_tree, selection)
+                with timer.phase('validity'):
+                    validity = relative_validity(labels, spanning_tree)
+                table.append({
+                    'anchorInfluence': anchor_influence,
+                    'semanticThreshold': semantic_threshold,
+                    'minSamples': min_samples,
+                    **selection,
+                    'num_clusters': int(labels.max()) + 1,
+                    'noise_fraction': float((labels == -1).mean()),
+                    'validity': validity
+                })
+
+    table.sort(key=lambda row: row['validity'], reverse=True)
+    print(f"[INFO] Sweep evaluated {len(table)} combinations on {trees} spanning trees", file=sys.stderr)
+    result = {
+        'sweep': table,
+        'best': table[0] if table else None,
+        'clustering_stats': {'combinations': len(table), 'spanning_trees': trees}
+    }
+    return finish_result(result, {}, config, timer)
+
+# ---------------------------------------------------------------------------
+# Server mode: keeps hdbscan/sklearn/scipy imported between requests
+# ---------------------------------------------------------------------------
+
+FRAME_HEADER = struct.Struct('>I')  # 4-byte big-endian payload length
+
+def read_frame(stream):
+    """Read one length-prefixed frame. Returns None on a clean EOF."""
+    header = _read_exact(stream, FRAME_HEADER.size)
+    if not header:
+        return None
+    if len(header) < FRAME_HEADER.size:
+        raise EOFError("Connection closed inside a frame header")
+    (length,) = FRAME_HEADER.unpack(header)
+    payload = _read_exact(stream, length)
+    if len(payload) < length:
+        raise EOFError(f"Connection closed inside a frame of {length} bytes")
+    return payload
+
+def _read_exact(stream, size):
+    """Read up to `size` bytes, stopping early only at EOF."""
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+def write_frame(stream, payload):
+    """Write one length-prefixed frame and flush it."""
+    stream.write(FRAME_HEADER.pack(len(payload)) + payload)
+    stream.flush()
+
+def decode_request(payload):
+    """
+    Decode a request frame into (request_id, mode, embeddings_data, config).
+    A request is either a JSON object {"id": ..., "mode": "cluster", "embeddings": {...}, "config": {...}}
+    or a binary embeddings buffer whose header carries id, mode and config.
+    """
+    if payload[:len(BINARY_MAGIC)] == BINARY_MAGIC:
+        header, embeddings_data = decode_binary_embeddings(payload)
+        return header.get('id'), header.get('mode', 'cluster'), embeddings_data, header.get('config', {})
+
+    request = json.loads(payload.decode('utf-8'))
+    return (
+        request.get('id'),
+        request.get('mode', 'cluster'),
+        request.get('embeddings', {}),
+        request.get('config', {})
+    )
+
+# Request modes the server understands; each handler takes (embeddings_data, config, timer).
+# serve() adds 'schedule' and 'status', which need the long-running scheduler.
+REQUEST_HANDLERS = {
+    'cluster': run_clustering,
+    'recut': run_recut,
+    'sweep': run_sweep,
+    'assign': run_assign,
+}
+
+def handle_request(payload):
+    """
+    Process one request frame and return the encoded response frame. Every failure, including a
+    result that cannot be encoded, is answered with an error frame carrying the request id.
+    """
+    request_id = None
+    timer = PhaseTimer()
+    try:
+        with timer.phase('load_input'):
+            request_id, mode, embeddings_data, config = decode_request(payload)
+        handler = REQUEST_HANDLERS.get(mode)
+        if handler is None:
+            raise ValueError(f"Unknown request mode '{mode}'")
+        response = handler(embeddings_data, config, timer)
+        with timer.phase('serialize'):
+            encoded = json.dumps({'id': request_id, **response}).encode('utf-8')
+        if PhaseTimer.enabled(config):
+            timer.log(config, result_size(response))
+        return encoded
+    except Exception as e:
+        print(f"[ERROR] Request {request_id}: {str(e)}", file=sys.stderr)
+        print(f"[TRACEBACK] {traceback.format_exc()}", file=sys.stderr)
+        return json.dumps({'id': request_id, 'error': str(e)}).encode('utf-8')
+
+def warm_up():
+    """Run a tiny fit so lazily imported sklearn/hdbscan internals are loaded before the first request."""
+    rng = np.random.default_rng(0)
+    run_clustering({'doc_embeddings': rng.normal(size=(8, 4)).tolist()}, {'timings': False})
+
+def serve_stream(executor, rfile, wfile):
+    """
+    Answer the request frames of one stream (stdin/stdout or a socket connection) in completion
+    order. Returns when the stream is closed, after all of its requests have been answered.
+    """
+    write_lock = threading.Lock()
+
+    def respond(future):
+        with write_lock:
+            try:
+                write_frame(wfile, future.result())
+            except OSError as e:
+                print(f"[ERROR] Could not send response: {str(e)}", file=sys.stderr)
+
+    pending = []
+    while True:
+        try:
+            payload = read_frame(rfile)
+        except EOFError as e:
+            print(f"[ERROR] {str(e)}", file=sys.stderr)
+            break
+        if payload is None:
+            break
+        future = executor.submit(handle_request, payload)
+        future.add_done_callback(respond)
+        # Only the unfinished requests are kept, so a long-lived connection does not accumulate them
+        pending = [f for f in pending if not f.done()]
+        pending.append(future)
+
+    for future in pending:
+        future.result()
+
+def serve_stdio(executor):
+    """Read request frames from stdin and answer on stdout, in completion order."""
+    serve_stream(executor, sys.stdin.buffer, sys.stdout.buffer)
+
+def serve_socket(executor, socket_path):
+    """Accept connections on a Unix socket; every connection may pipeline several requests."""
+    class ConnectionHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            serve_stream(executor, self.rfile, self.wfile)
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    server = Server(socket_path, ConnectionHandler)
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    print(f"[INFO] Clustering server listening on {socket_path}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+# ---------------------------------------------------------------------------
+# Scheduler: coalesce clustering requests per user (server mode)
+# ---------------------------------------------------------------------------
+
+class ClusteringScheduler:
+    """
+    Coalesces the clustering requests that e.g. a bulk upload produces into as few runs as possible.
+    A submission waits `debounce` seconds for further submissions of the same user (measured from
+    the newest one, but at most `max_delay` after the oldest pending one); the newest config wins.
+    At most one job per user runs at a time, submissions arriving meanwhile are coalesced into one
+    follow-up run.
+
+    Jobs read the user's embeddings and previous labels from Postgres when they start, so they always
+    see the complete corpus, and write only the changed labels back (see align_result_labels). The
+    newest finished job of every user is kept for `status` requests and written to
+    'latest_result.json' in the user's model directory. clock and timer (time.monotonic and
+    threading.Timer by default) can be replaced, e.g. by a fake clock in tests.
+    """
+
+    def __init__(self, debounce=2.0, max_delay=30.0, workers=1, clock=time.monotonic, timer=threading.Timer):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.clock = clock
+        self.timer = timer
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.lock = threading.Lock()
+        self.users = {}
+
+    def submit(self, embeddings_data, config, timer=None):
+        """Request handler 'schedule': queue a clustering of config.userId and return immediately."""
+        if config.get('userId') is None:
+            raise ValueError("userId is required for scheduled clustering")
+        user_id = int(config['userId'])
+        with self.lock:
+            state = self.users.get(user_id)
+            if state is None:
+                # Continue the generations of the published result, so they stay increasing across restarts
+                latest = self._published(config)
+                state = self.users[user_id] = {
+                    'generation': latest['generation'] if latest else 0, 'pending': None,
+                    'first_pending': None, 'timer': None, 'running': False, 'latest': latest
+                }
+            state['generation'] += 1
+            state['pending'] = (config, state['generation'])
+            if state['first_pending'] is None:
+                state['first_pending'] = self.clock()
+            # A running job re-arms the timer when it finishes
+            if not state['running']:
+                self._arm(user_id, state)
+            return {'generation': state['generation'], 'state': self._state_name(state)}
+
+    def status(self, embeddings_data, config, timer=None):
+        """
+        Request handler 'status': state of config.userId's jobs and the newest finished job. Its result
+        is only included if it is newer than config.sinceGeneration.
+        """
+        if config.get('userId') is None:
+            raise ValueError("userId is required for scheduled clustering")
+        with self.lock:
+            state = self.users.get(int(config['userId']))
+            generation = state['generation'] if state else 0
+            state_name = self._state_name(state) if state else 'idle'
+            latest = state['latest'] if state else None
+        if latest is None:
+            # Nothing finished since the server started: fall back to the published file
+            latest = self._published(config)
+            generation = max(generation, latest['generation'] if latest else 0)
+        response = {'generation': generation, 'state': state_name, 'latest': None}
+        if latest is not None:
+            response['completed_generation'] = latest['generation']
+            if latest['generation'] > config.get('sinceGeneration', 0):
+                response['latest'] = latest
+        return response
+
+    def _state_name(self, state):
+        if state['running']:
+            return 'running'
+        return 'waiting' if state['pending'] is not None else 'idle'
+
+    def _arm(self, user_id, state):
+        """(Re)start the debounce timer of a user; the caller holds the lock."""
+        if state['timer'] is not None:
+            state['timer'].cancel()
+        remaining = state['first_pending'] + self.max_delay - self.clock()
+        state['timer'] = self.timer(max(0.0, min(self.debounce, remaining)),
+                                    self.executor.submit, args=(self._run, user_id))
+        state['timer'].daemon = True
+        state['timer'].start()
+
+    def _run(self, user_id):
+        with self.lock:
+            state = self.users[user_id]
+            # A cancelled timer may still fire; the pending job then belongs to the newer timer
+            if state['running'] or state['pending'] is None:
+                return
+            config, generation = state['pending']
+            coalesced = generation - (state['latest']['generation'] if state['latest'] else 0)
+            state.update(pending=None, first_pending=None, timer=None, running=True)
+
+        start = time.perf_counter()
+        try:
+            from pg_embedding_reader import write_cluster_labels
+            result = run_clustering({}, {**config, 'source': 'database', 'labelDelta': True, 'persistState': True})
+            changes = result['label_changes']
+            write_cluster_labels(user_id, changes['file_ids'], changes['labels'], config.get('databaseUrl'))
+            latest = {'generation': generation, 'status': 'ok', 'result': result}
+        except Exception as e:
+            print(f"[ERROR] Scheduled clustering of user {user_id}: {str(e)}", file=sys.stderr)
+            print(f"[TRACEBACK] {traceback.format_exc()}", file=sys.stderr)
+            latest = {'generation': generation, 'status': 'error', 'error': str(e)}
+        latest['coalesced_requests'] = coalesced
+        latest['elapsed_ms'] = (time.perf_counter() - start) * 1000
+        print(f"[INFO] Scheduled clustering of user {user_id} finished ({coalesced} requests coalesced, "
+              f"{latest['elapsed_ms']:.0f} ms)", file=sys.stderr)
+
+        try:
+            self._publish(config, latest)
+        finally:
+            with self.lock:
+                state.update(running=False, latest=latest)
+                if state['pending'] is not None:
+                    self._arm(user_id, state)
+
+    def _published(self, config):
+        path = user_model_path(config, 'latest_result.json')
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def _publish(self, config, latest):
+        """Write the newest finished job atomically to 'latest_result.json'."""
+        path = user_model_path(config, 'latest_result.json')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(latest, f)
+        os.replace(temp_path, path)
+
+def serve(argv):
+    """
+    Entry point for `cluster.py serve [--socket PATH] [--workers N] [--debounce S] [--max-delay S]
+    [--scheduler-workers N]`.
+    """
+    parser = argparse.ArgumentParser(prog='cluster.py serve')
+    parser.add_argument('--socket', help='Unix socket path; reads frames from stdin if omitted')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='Number of requests processed concurrently (further requests are queued)')
+    parser.add_argument('--debounce', type=float, default=2.0,
+                        help='Seconds a scheduled clustering waits for further requests of the same user')
+    parser.add_argument('--max-delay', type=float, default=30.0,
+                        help='Upper bound in seconds for delaying a scheduled clustering by debouncing')
+    parser.add_argument('--scheduler-workers', type=int, default=1,
+                        help='Scheduled clusterings of different users that run concurrently')
+    args = parser.parse_args(argv)
+
+    scheduler = ClusteringScheduler(args.debounce, args.max_delay, args.scheduler_workers)
+    REQUEST_HANDLERS.update({'schedule': scheduler.submit, 'status': scheduler.status})
+
+    warm_up()
+    print(f"[INFO] Clustering server ready (workers: {args.workers})", file=sys.stderr)
+
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        if args.socket:
+            serve_socket(executor, args.socket)
+        else:
+            serve_stdio(executor)
+
+def run_files_command(argv, handler):
+    """Run a handler on the embeddings file argv[0] and the config file argv[1]."""
+    try:
+        timer = PhaseTimer()
+
+        # Load embeddings and config
+        with timer.phase('load_input'):
+            embeddings_data = load_embeddings(argv[0])
+
+            with open(argv[1], 'r') as f:
+                config = json.load(f)
+
+        result = handler(embeddings_data, config, timer)
+
+        # Output final result (serialization time only appears in the [METRIC] log lines)
+        with timer.phase('serialize'):
+            output = json.dumps(result)
+        print(output)
+        if PhaseTimer.enabled(config):
+            timer.log(config, result_size(result))
+
     except Exception as e:
         print(f"[ERROR] {str(e)}", file=sys.stderr)
         print(f"[TRACEBACK] {traceback.format_exc()}", file=sys.stderr)
         print(json.dumps({"error": str(e)}))
         sys.exit(1)
 
+def run_config_command(argv, handler, **overrides):
+    """Run a handler that needs no embeddings file (`db`, `recut`) on the config file in argv[0]."""
+    try:
+        with open(argv[0], 'r') as f:
+            config = json.load(f)
+        config.update(overrides)
+        print(json.dumps(handler({}, config)))
+    except Exception as e:
+        print(f"[ERROR] {str(e)}", file=sys.stderr)
+        print(f"[TRACEBACK] {traceback.format_exc()}", file=sys.stderr)
+        print(json.dumps({"error": str(e)}))
+        sys.exit(1)
+
+def cluster_from_database(argv):
+    """Entry point for `cluster.py db <config.json>`: config.userId selects the user whose embeddings are read."""
+    run_config_command(argv, run_clustering, source='database')
+
+def recut(argv):
+    """Entry point for `cluster.py recut <config.json>`: new selection parameters for config.userId."""
+    run_config_command(argv, run_recut)
+
+def sweep(argv):
+    """Entry point for `cluster.py sweep <embeddings> <config.json>` (the grid is in config.grid)."""
+    run_files_command(argv, run_sweep)
+
+def assign(argv):
+    """Entry point for `cluster.py assign <embedding> <config.json>` (one document, config.userId)."""
+    run_files_command(argv, run_assign)
+
+# ---------------------------------------------------------------------------
+# Batch mode: re-cluster many users in a process pool
+# ---------------------------------------------------------------------------
+
+_blas_limits = None
+
+def _limit_blas_threads(threads):
+    """Process pool initializer: cap the BLAS/OpenMP thread pools so workers do not oversubscribe the cores."""
+    global _blas_limits
+    from threadpoolctl import threadpool_limits
+    _blas_limits = threadpool_limits(limits=threads)
+
+def batch_jobs(args, config):
+    """
+    (user_id, embeddings_path) pairs to process, largest inputs first. Inputs are either the
+    files user_<id>.bin / user_<id>.json in --input-dir or, without it, the database (path None).
+    """
+    if args.input_dir:
+        jobs = []
+        for name in os.listdir(args.input_dir):
+            match = re.fullmatch(r'user_(\d+)\.(bin|json)', name)
+            if match:
+                jobs.append((int(match.group(1)), os.path.join(args.input_dir, name)))
+        jobs.sort(key=lambda job: (-os.path.getsize(job[1]), job[0]))
+        if args.users:
+            jobs = [job for job in jobs if job[0] in set(args.users)]
+        return jobs
+
+    from pg_embedding_reader import list_user_ids
+    user_ids = args.users or list_user_ids(config.get('databaseUrl'))
+    return [(user_id, None) for user_id in user_ids]
+
+def cluster_user(user_id, embeddings_path, config):
+    """Batch worker: cluster the documents of one user and return its NDJSON record."""
+    start = time.perf_counter()
+    config = {**config, 'userId': user_id, 'persistState': True}
+    try:
+        if embeddings_path:
+            embeddings_data = load_embeddings(embeddings_path)
+        else:
+            config['source'] = 'database'
+            embeddings_data = {}
+        result = run_clustering(embeddings_data, config)
+        record = {'userId': user_id, 'status': 'ok', 'result': result}
+    except Exception as e:
+        print(f"[ERROR] User {user_id}: {str(e)}", file=sys.stderr)
+        print(f"[TRACEBACK] {traceback.format_exc()}", file=sys.stderr)
+        record = {'userId': user_id, 'status': 'error', 'error': str(e)}
+    record['elapsed_ms'] = (time.perf_counter() - start) * 1000
+    return record
+
+def batch(argv):
+    """
+    Entry point for `cluster.py batch <config.json> [--users ID ...] [--input-dir DIR] [--workers N]
+    [--blas-threads N]`. Every user is clustered separately in a process pool and each result is
+    written to stdout as one JSON line as soon as it is finished (in completion order).
+    """
+    parser = argparse.ArgumentParser(prog='cluster.py batch')
+    parser.add_argument('config', help='Clustering config applied to every user')
+    parser.add_argument('--users', type=int, nargs='+', help='Only these user ids (default: all users)')
+    parser.add_argument('--input-dir', help='Read user_<id>.bin|json files instead of the database')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Users processed in parallel (default: number of cores)')
+    parser.add_argument('--blas-threads', type=int,
+                        help='BLAS threads per worker (default: cores / workers)')
+    args = parser.parse_args(argv)
+
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+    jobs = batch_jobs(args, config)
+    workers = max(1, min(args.workers, len(jobs)))
+    blas_threads = args.blas_threads or max(1, (os.cpu_count() or 1) // workers)
+    print(f"[INFO] Batch clustering of {len(jobs)} users (workers: {workers}, "
+          f"BLAS threads per worker: {blas_threads})", file=sys.stderr)
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_limit_blas_threads,
+                             initargs=(blas_threads,)) as executor:
+        futures = {
+            executor.submit(cluster_user, user_id, path, config): user_id
+            for user_id, path in jobs
+        }
+        for future in as_completed(futures):
+            try:
+                record = future.result()
+            except Exception as e:
+                # e.g. a worker killed by the OOM killer (BrokenProcessPool)
+                record = {'userId': futures[future], 'status': 'error', 'error': str(e)}
+            failed += record['status'] != 'ok'
+            sys.stdout.write(json.dumps(record) + '\n')
+            sys.stdout.flush()
+
+    print(f"[INFO] Batch finished: {len(jobs)} users, {failed} failed", file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+# Sub-commands besides the classic `cluster.py <embeddings.json> <config.json>` call
+MODES = {
+    'serve': serve,
+    'db': cluster_from_database,
+    'batch': batch,
+    'recut': recut,
+    'sweep': sweep,
+    'assign': assign,
+}
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in MODES:
+        MODES[sys.argv[1]](sys.argv[2:])
+        return
+    run_files_command(sys.argv[1:], run_clustering)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -9,10 +9,11 @@
  */
 
 
-const { exec } = require('child_process');
+const { exec, spawn } = require('child_process');
 const path = require('path');
 const fs = require('fs');
 const os = require('os');
+const readline = require('readline');
 const db = require('../../ConnectPostgres');
 
 /**
@@ -79,13 +80,270 @@ async function getDocumentFolderMap(userId) {
     }, {});
 }
 
+const clusterScriptPath = path.join(__dirname, 'cluster.py');
+
+/**
+ * Umgebung für die Python-Prozesse: Liest `cluster.py` selbst aus der Datenbank
+ * (pg_embedding_reader.py), werden die Verbindungsdaten aus `dbConfig` als
+ * libpq-Variablen übergeben, sofern `CLUSTERING_DATABASE_URL` nicht gesetzt ist.
+ *
+ * @function pythonEnv
+ * @returns {Object} Die Umgebungsvariablen für `spawn`/`exec`.
+ */
+function pythonEnv() {
+    if (process.env.CLUSTERING_DATABASE_URL) {
+        return process.env;
+    }
+    return {
+        ...process.env,
+        PGHOST: db.dbConfig.host,
+        PGPORT: String(db.dbConfig.port),
+        PGUSER: db.dbConfig.user,
+        PGPASSWORD: db.dbConfig.password,
+        PGDATABASE: db.dbConfig.database
+    };
+}
+
+let clusteringServer = null;
+
+/**
+ * Kodiert die Clustering-Eingabe im Binärformat von `cluster.py`: ein kleiner
+ * JSON-Header gefolgt von den Dokument- und Ordner-Embeddings als float32
+ * (little-endian). Python kann die Matrizen so ohne JSON-Parsing und ohne
+ * Kopie einlesen.
+ *
+ * @function encodeBinaryEmbeddings
+ * @param {Object} clusteringData - Dokument-Embeddings, Ordner-Embeddings und Zuordnung.
+ * @param {Object} [extraHeader={}] - Zusätzliche Header-Felder (z.B. `id`, `mode`, `config`).
+ * @returns {Buffer} Der kodierte Buffer.
+ */
+function encodeBinaryEmbeddings(clusteringData, extraHeader = {}) {
+    const docEmbeddings = clusteringData.doc_embeddings;
+    const folderEmbeddings = clusteringData.folder_embeddings || {};
+    const folderIds = Object.keys(folderEmbeddings);
+    const dim = docEmbeddings.length
+        ? docEmbeddings[0].length
+        : (folderIds.length ? folderEmbeddings[folderIds[0]].length : 0);
+
+    let headerJson = JSON.stringify({
+        ...extraHeader,
+        dim,
+        doc_count: docEmbeddings.length,
+        folder_ids: folderIds,
+        doc_to_folder_map: clusteringData.doc_to_folder_map || {}
+    });
+    // Header mit Leerzeichen auffüllen, damit die Matrizen 64-Byte-ausgerichtet beginnen
+    const unpaddedLength = 8 + Buffer.byteLength(headerJson, 'utf-8');
+    headerJson += ' '.repeat((64 - (unpaddedLength % 64)) % 64);
+    const headerBytes = Buffer.from(headerJson, 'utf-8');
+
+    const matrix = new Float32Array((docEmbeddings.length + folderIds.length) * dim);
+    docEmbeddings.forEach((embedding, i) => matrix.set(embedding, i * dim));
+    folderIds.forEach((folderId, i) => {
+        matrix.set(folderEmbeddings[folderId], (docEmbeddings.length + i) * dim);
+    });
+    const matrixBytes = Buffer.from(matrix.buffer);
+    if (os.endianness() !== 'LE') {
+        matrixBytes.swap32();
+    }
+
+    const preamble = Buffer.alloc(8);
+    preamble.write('IDCB', 0, 'ascii');
+    preamble.writeUInt32LE(headerBytes.length, 4);
+
+    return Buffer.concat([preamble, headerBytes, matrixBytes]);
+}
+
+/**
+ * Liefert den dauerhaft laufenden Clustering-Prozess (`cluster.py serve`) und
+ * startet ihn beim ersten Aufruf. Anfragen und Antworten werden als
+ * längenpräfixierte JSON-Frames über stdin/stdout ausgetauscht, sodass
+ * hdbscan, sklearn und scipy nur einmal importiert werden.
+ *
+ * @function getClusteringServer
+ * @returns {Object} Ein Objekt mit der Methode `request(embeddings, config, mode)`.
+ */
+function getClusteringServer() {
+    if (clusteringServer) {
+        return clusteringServer;
+    }
+
+    const workers = process.env.CLUSTERING_SERVER_WORKERS || '2';
+    const args = [clusterScriptPath, 'serve', '--workers', workers];
+    // Wartezeit des Schedulers auf weitere Uploads desselben Benutzers (Sekunden)
+    if (process.env.CLUSTERING_SCHEDULER_DEBOUNCE) {
+        args.push('--debounce', process.env.CLUSTERING_SCHEDULER_DEBOUNCE);
+    }
+    const child = spawn('python', args, {
+        stdio: ['pipe', 'pipe', 'pipe'],
+        env: pythonEnv()
+    });
+    const pending = new Map();
+    let nextRequestId = 1;
+    let buffered = Buffer.alloc(0);
+
+    child.stdout.on('data', (chunk) => {
+        buffered = Buffer.concat([buffered, chunk]);
+        // Vollständige Frames abarbeiten: 4 Byte Länge (big-endian) + JSON
+        while (buffered.length >= 4) {
+            const length = buffered.readUInt32BE(0);
+            if (buffered.length < 4 + length) {
+                break;
+            }
+            const response = JSON.parse(buffered.subarray(4, 4 + length).toString('utf-8'));
+            buffered = buffered.subarray(4 + length);
+
+            const request = pending.get(response.id);
+            if (request) {
+                pending.delete(response.id);
+                request.resolve(response);
+            }
+        }
+    });
+
+    child.stderr.on('data', (data) => {
+        console.error(`Clustering server: ${data}`);
+    });
+
+    child.on('exit', (code) => {
+        console.error(`Clustering server exited with code ${code}`);
+        clusteringServer = null;
+        for (const request of pending.values()) {
+            request.reject(new Error('Clustering server exited'));
+        }
+        pending.clear();
+    });
+
+    clusteringServer = {
+        request(embeddingsData, config, mode = 'cluster') {
+            return new Promise((resolve, reject) => {
+                const id = nextRequestId++;
+                // Ohne Embeddings (Quelle: Datenbank, recut) wird nur die Konfiguration als JSON gesendet
+                const payload = process.env.CLUSTERING_INPUT_FORMAT === 'json' || !embeddingsData.doc_embeddings
+                    ? Buffer.from(JSON.stringify({
+                        id,
+                        mode,
+                        embeddings: embeddingsData,
+                        config
+                    }), 'utf-8')
+                    : encodeBinaryEmbeddings(embeddingsData, { id, mode, config });
+                const header = Buffer.alloc(4);
+                header.writeUInt32BE(payload.length, 0);
+
+                pending.set(id, { resolve, reject });
+                child.stdin.write(Buffer.concat([header, payload]));
+            });
+        }
+    };
+
+    return clusteringServer;
+}
+
+/**
+ * Liest die Binär-Datei eines Ergebnisses mit `compactOutput` (int32-Labels, auf uint8 quantisierte
+ * Wahrscheinlichkeiten) ein, setzt `labels` und `probabilities` wieder ins Ergebnis und löscht die Datei.
+ * Ergebnisse ohne `compact_output` werden unverändert zurückgegeben.
+ *
+ * @function expandCompactResult
+ * @param {Object} result - Das geparste JSON-Ergebnis des Clustering-Skripts.
+ * @returns {Object} Das Ergebnis mit `labels` und `probabilities`.
+ */
+function expandCompactResult(result) {
+    const compact = result.compact_output;
+    if (!compact) {
+        return result;
+    }
+    const data = fs.readFileSync(compact.path);
+    try {
+        fs.unlinkSync(compact.path);
+    } catch (cleanupError) {
+        console.error('Error cleaning up compact result file:', cleanupError);
+    }
+
+    const labels = new Array(compact.count);
+    const probabilities = new Array(compact.count);
+    for (let i = 0; i < compact.count; i++) {
+        labels[i] = data.readInt32LE(compact.labels_offset + 4 * i);
+        probabilities[i] = data[compact.probabilities_offset + i] / compact.probability_scale;
+    }
+    const { compact_output, ...rest } = result;
+    return { ...rest, labels, probabilities };
+}
+
+/**
+ * Bereitet das Ergebnis von `cluster.py` für die Controller auf.
+ *
+ * @function processClusteringResult
+ * @param {Object} result - Das geparste JSON-Ergebnis des Clustering-Skripts.
+ * @param {Object|null} folderData - Die zuvor abgerufenen Ordnerdaten.
+ * @returns {Object} Ein Objekt mit `labels`, `clusterStats`, `folderContext` und ggf. `fileIds`/`clusterSummary`.
+ */
+function processClusteringResult(result, folderData) {
+    result = expandCompactResult(result);
+
+    // Process enhanced clustering results
+    const processedResult = {
+        labels: result.labels,
+        clusterStats: result.clustering_stats,
+        folderContext: null
+    };
+
+    // Mit `source: 'database'` liefert cluster.py die Datei-ID zu jedem Label
+    if (result.file_ids) {
+        processedResult.fileIds = result.file_ids;
+    }
+
+    // Mit `previousLabels` (bzw. den gespeicherten Labels bei `source: 'database'`) sind die
+    // Cluster an den bisherigen ausgerichtet, `labelChanges` enthält nur die geänderten Zeilen
+    if (result.label_changes) {
+        processedResult.labelChanges = {
+            rows: result.label_changes.rows,
+            labels: result.label_changes.labels,
+            ...(result.label_changes.file_ids && { fileIds: result.label_changes.file_ids })
+        };
+    }
+
+    // Mit `clusterSummary: true`: Zentroid, Beispieldokumente und Radius je Cluster
+    if (result.cluster_summary) {
+        processedResult.clusterSummary = result.cluster_summary;
+    }
+
+    // Add folder context if available
+    if (result.folder_context && folderData) {
+        processedResult.folderContext = {
+            affinities: result.folder_context.affinities,
+            statistics: result.folder_context.statistics,
+            folderInfo: {
+                names: folderData.names,
+                hierarchy: folderData.hierarchy
+            }
+        };
+    }
+
+    return processedResult;
+}
+
 /**
  * Führt ein Clustering von Dokument- und Ordner-Embeddings durch.
+ * Ist `CLUSTERING_SERVER=true` gesetzt, wird der dauerhaft laufende
+ * Clustering-Prozess verwendet, ansonsten wird `cluster.py` pro Aufruf gestartet.
+ * Die Embeddings werden binär übergeben; mit `CLUSTERING_INPUT_FORMAT=json`
+ * wird das bisherige JSON-Format verwendet. Mit `config.source = 'database'` liest
+ * `cluster.py` die Embeddings des Benutzers selbst per COPY aus PostgreSQL und ignoriert
+ * `embeddings`, das Ergebnis enthält dann zusätzlich `fileIds` in der Reihenfolge der Labels.
+ * `CLUSTERING_SOURCE=database` setzt dies nur für Aufrufe mit `config.persistState`, deren
+ * Embeddings ohnehin der gesamte Bestand des Benutzers sind.
+ * Nur Aufrufe, die den gesamten Dokumentbestand clustern, setzen `config.persistState`: Dann
+ * speichert `cluster.py` Baum, Cluster-Zusammenfassung, Reduktion und k-NN-Graph des Benutzers für
+ * spätere Läufe, `recut` und `assign`, und `CLUSTERING_INCREMENTAL` gilt. Andere Aufrufe
+ * (z.B. das Clustering von Suchergebnissen) lassen diesen Zustand unverändert.
  *
  * @async
  * @function runClustering
  * @param {Array<Object>} embeddings - Eine Liste von Dokument-Embeddings.
  * @param {Object} [config={}] - Konfigurationsoptionen für das Clustering.
+ * @param {boolean} [config.persistState=false] - Clustering des gesamten Bestands, Zustand des Benutzers speichern.
+ * @param {string} [config.source] - `'database'`: Embeddings aus der Datenbank statt aus `embeddings` lesen.
  * @param {number} userId - Die Benutzer-ID für Sicherheitszwecke.
  * @returns {Promise<Object>} Ein Objekt mit Clustering-Ergebnissen einschließlich Labels und Statistiken.
  * @throws {Error} Falls ein ungültiges Embedding-Format oder ein Fehler während der Ausführung auftritt.
@@ -101,8 +359,14 @@ async function runClustering(embeddings, config = {}, userId) {
     return new Promise((resolve, reject) => {
         const processingFunction = async () => {
             try {
+                // Nur Clusterings des gesamten Bestands dürfen die Embeddings aus der Datenbank lesen,
+                // andere Aufrufe (z.B. Suchtreffer) clustern genau die übergebenen Embeddings
+                const source = config.source
+                    ?? (config.persistState === true ? process.env.CLUSTERING_SOURCE : undefined);
+                const readFromDatabase = source === 'database';
+
                 // Format document embeddings
-                const formattedDocEmbeddings = embeddings.map(emb => {
+                const formattedDocEmbeddings = readFromDatabase ? [] : embeddings.map(emb => {
                     if (typeof emb === 'string') {
                         return emb.replace(/[\[\]]/g, '').split(',').map(Number);
                     }
@@ -122,7 +386,11 @@ async function runClustering(embeddings, config = {}, userId) {
                 let clusteringData = { doc_embeddings: formattedDocEmbeddings };
                 let folderData = null;
 
-                if (userId) {
+                if (readFromDatabase) {
+                    // Nur Namen und Hierarchie für den Ordnerkontext, die Embeddings liest cluster.py
+                    folderData = await getFolderData(userId);
+                    clusteringData = {};
+                } else if (userId) {
                     const [folders, docToFolderMap] = await Promise.all([
                         getFolderData(userId),
                         getDocumentFolderMap(userId)
@@ -139,31 +407,67 @@ async function runClustering(embeddings, config = {}, userId) {
                     };
                 }
 
-                // erstellt temporary files
-                const tempEmbeddingsPath = path.join(os.tmpdir(), `embeddings_${Date.now()}.json`);
-                const tempConfigPath = path.join(os.tmpdir(), `config_${Date.now()}.json`);
-
                 // enhanced config
                 const enhancedConfig = {
                     ...config,
                     anchorInfluence: config.anchorInfluence || 0.45,
-                    semanticThreshold: config.semanticThreshold || 0.7
+                    semanticThreshold: config.semanticThreshold || 0.7,
+                    userId,
+                    // Neue Dokumente mit dem gespeicherten Clusterer zuordnen statt neu zu clustern
+                    incremental: config.incremental
+                        ?? (config.persistState === true && process.env.CLUSTERING_INCREMENTAL === 'true'),
+                    // Kern-Distanzen und Spannbaum über den k-NN-Graphen (große Dokumentmengen)
+                    knnGraph: config.knnGraph ?? process.env.CLUSTERING_KNN_GRAPH === 'true',
+                    // Labels und Wahrscheinlichkeiten als Binär-Datei statt als JSON-Listen
+                    compactOutput: config.compactOutput ?? process.env.CLUSTERING_COMPACT_OUTPUT === 'true'
                 };
+                delete enhancedConfig.source;
+                if (readFromDatabase) {
+                    enhancedConfig.source = 'database';
+                    // cluster.py liest die bisherigen Labels selbst aus der Datenbank
+                    delete enhancedConfig.previousLabels;
+                }
+
+                if (process.env.CLUSTERING_SERVER === 'true') {
+                    const result = await getClusteringServer().request(clusteringData, enhancedConfig);
+                    if (result.error) {
+                        reject(new Error(result.error));
+                        return;
+                    }
+                    resolve(processClusteringResult(result, folderData));
+                    return;
+                }
+
+                // erstellt temporary files (binär, JSON nur als Fallback)
+                const useJsonInput = process.env.CLUSTERING_INPUT_FORMAT === 'json';
+                const tempEmbeddingsPath = path.join(
+                    os.tmpdir(),
+                    `embeddings_${Date.now()}.${useJsonInput ? 'json' : 'bin'}`
+                );
+                const tempConfigPath = path.join(os.tmpdir(), `config_${Date.now()}.json`);
 
                 // Save data and config
-                fs.writeFileSync(tempEmbeddingsPath, JSON.stringify(clusteringData));
+                if (!readFromDatabase) {
+                    fs.writeFileSync(
+                        tempEmbeddingsPath,
+                        useJsonInput ? JSON.stringify(clusteringData) : encodeBinaryEmbeddings(clusteringData)
+                    );
+                }
                 fs.writeFileSync(tempConfigPath, JSON.stringify(enhancedConfig));
 
-                const scriptPath = path.join(__dirname, 'cluster.py');
-
                 // Execute Python clustering script
+                const command = readFromDatabase
+                    ? `python "${clusterScriptPath}" db "${tempConfigPath}"`
+                    : `python "${clusterScriptPath}" "${tempEmbeddingsPath}" "${tempConfigPath}"`;
                 const pythonProcess = exec(
-                    `python "${scriptPath}" "${tempEmbeddingsPath}" "${tempConfigPath}"`,
-                    { maxBuffer: 1024 * 1024 * 10 },
+                    command,
+                    { maxBuffer: 1024 * 1024 * 10, env: pythonEnv() },
                     async (error, stdout, stderr) => {
                         // löscht die temporären Dateien
                         try {
-                            fs.unlinkSync(tempEmbeddingsPath);
+                            if (!readFromDatabase) {
+                                fs.unlinkSync(tempEmbeddingsPath);
+                            }
                             fs.unlinkSync(tempConfigPath);
                         } catch (cleanupError) {
                             console.error('Error cleaning up temp files:', cleanupError);
@@ -191,26 +495,7 @@ async function runClustering(embeddings, config = {}, userId) {
                                 return;
                             }
 
-                            // Process enhanced clustering results
-                            const processedResult = {
-                                labels: result.labels,
-                                clusterStats: result.clustering_stats,
-                                folderContext: null
-                            };
-
-                            // Add folder context if available
-                            if (result.folder_context && folderData) {
-                                processedResult.folderContext = {
-                                    affinities: result.folder_context.affinities,
-                                    statistics: result.folder_context.statistics,
-                                    folderInfo: {
-                                        names: folderData.names,
-                                        hierarchy: folderData.hierarchy
-                                    }
-                                };
-                            }
-
-                            resolve(processedResult);
+                            resolve(processClusteringResult(result, folderData));
                         } catch (parseError) {
                             console.error('Raw clustering output:', stdout);
                             console.error('Parse error:', parseError);
@@ -233,4 +518,296 @@ async function runClustering(embeddings, config = {}, userId) {
     });
 }
 
-module.exports = { runClustering };
\ No newline at end of file
+/**
+ * Wählt die Cluster eines Benutzers mit neuen Auswahlparametern (`minClusterSize`,
+ * `clusterSelectionMethod`, `clusterSelectionEpsilon`) neu aus. `cluster.py recut` verwendet
+ * dafür den beim letzten vollständigen Clustering gespeicherten Baum, ohne Embeddings zu laden
+ * oder HDBSCAN neu zu berechnen; das dauert nur Millisekunden. Mit `previousLabels`
+ * (Datei-ID → gespeichertes Label) werden die neuen Cluster daran ausgerichtet, und `assign`
+ * liefert danach die Labels des Recuts.
+ *
+ * @async
+ * @function recutClustering
+ * @param {Object} [config={}] - Die geänderten Auswahlparameter, optional `previousLabels` und `labelDelta`.
+ * @param {number} userId - Die Benutzer-ID.
+ * @returns {Promise<Object>} Ein Objekt mit `labels` (ohne `labelDelta`), `clusterStats`, ggf. `labelChanges` und `fileIds`.
+ * @throws {Error} Falls noch kein Baum gespeichert ist oder baumbestimmende Parameter geändert wurden.
+ */
+async function recutClustering(config = {}, userId) {
+    if (!userId) {
+        throw new Error('userId is required for security purposes');
+    }
+    const recutConfig = { ...config, userId };
+
+    if (process.env.CLUSTERING_SERVER === 'true') {
+        const result = await getClusteringServer().request({}, recutConfig, 'recut');
+        if (result.error) {
+            throw new Error(result.error);
+        }
+        return processClusteringResult(result, null);
+    }
+
+    const tempConfigPath = path.join(os.tmpdir(), `recut_config_${Date.now()}.json`);
+    fs.writeFileSync(tempConfigPath, JSON.stringify(recutConfig));
+    const stdout = await new Promise((resolve, reject) => {
+        exec(
+            `python "${clusterScriptPath}" recut "${tempConfigPath}"`,
+            { maxBuffer: 1024 * 1024 * 10, env: pythonEnv() },
+            (error, output) => {
+                try {
+                    fs.unlinkSync(tempConfigPath);
+                } catch (cleanupError) {
+                    console.error('Error cleaning up temp files:', cleanupError);
+                }
+                // cluster.py gibt auch im Fehlerfall ein JSON-Objekt mit `error` aus
+                if (error && !output.trim()) {
+                    reject(error);
+                    return;
+                }
+                resolve(output);
+            }
+        );
+    });
+
+    const result = JSON.parse(stdout.trim());
+    if (result.error) {
+        throw new Error(result.error);
+    }
+    return processClusteringResult(result, null);
+}
+
+/**
+ * Plant ein Clustering des Benutzers im Clustering-Server ein, statt es sofort auszuführen.
+ * Der Scheduler in `cluster.py serve` wartet kurz auf weitere Anfragen desselben Benutzers und fasst
+ * sie zusammen (z.B. bei 200 gleichzeitig hochgeladenen Dateien), führt pro Benutzer höchstens ein
+ * Clustering gleichzeitig aus, liest die Embeddings dabei selbst aus der Datenbank und schreibt die
+ * geänderten Labels zurück. Das Ergebnis wird mit `getClusteringStatus` abgefragt.
+ *
+ * @async
+ * @function scheduleClustering
+ * @param {Object} [config={}] - Konfigurationsoptionen für das Clustering.
+ * @param {number} userId - Die Benutzer-ID.
+ * @returns {Promise<Object>} Ein Objekt mit der `generation` der Anfrage und dem `state` des Benutzers.
+ * @throws {Error} Falls der Clustering-Server nicht aktiviert ist oder ein Fehler auftritt.
+ */
+async function scheduleClustering(config = {}, userId) {
+    if (!userId) {
+        throw new Error('userId is required for security purposes');
+    }
+    if (process.env.CLUSTERING_SERVER !== 'true') {
+        throw new Error('Scheduled clustering requires CLUSTERING_SERVER=true');
+    }
+    const result = await getClusteringServer().request({}, {
+        ...config,
+        anchorInfluence: config.anchorInfluence || 0.45,
+        semanticThreshold: config.semanticThreshold || 0.7,
+        userId,
+        knnGraph: config.knnGraph ?? process.env.CLUSTERING_KNN_GRAPH === 'true'
+    }, 'schedule');
+    if (result.error) {
+        throw new Error(result.error);
+    }
+    return { generation: result.generation, state: result.state };
+}
+
+/**
+ * Fragt den Stand der eingeplanten Clusterings eines Benutzers ab.
+ *
+ * @async
+ * @function getClusteringStatus
+ * @param {number} userId - Die Benutzer-ID.
+ * @param {number} [sinceGeneration=0] - Das Ergebnis nur liefern, wenn es neuer als diese Generation ist.
+ * @returns {Promise<Object>} Ein Objekt mit `generation` (letzte Anfrage), `state` (`waiting`, `running`
+ * oder `idle`), `completedGeneration` und ggf. `latest` mit `status`, `result` bzw. `error`.
+ * @throws {Error} Falls der Clustering-Server nicht aktiviert ist oder ein Fehler auftritt.
+ */
+async function getClusteringStatus(userId, sinceGeneration = 0) {
+    if (!userId) {
+        throw new Error('userId is required for security purposes');
+    }
+    if (process.env.CLUSTERING_SERVER !== 'true') {
+        throw new Error('Scheduled clustering requires CLUSTERING_SERVER=true');
+    }
+    const result = await getClusteringServer().request({}, { userId, sinceGeneration }, 'status');
+    if (result.error) {
+        throw new Error(result.error);
+    }
+
+    const status = {
+        generation: result.generation,
+        state: result.state,
+        completedGeneration: result.completed_generation ?? null,
+        latest: null
+    };
+    if (result.latest) {
+        status.latest = {
+            generation: result.latest.generation,
+            status: result.latest.status,
+            coalescedRequests: result.latest.coalesced_requests,
+            ...(result.latest.result && { result: processClusteringResult(result.latest.result, null) }),
+            ...(result.latest.error && { error: result.latest.error })
+        };
+    }
+    return status;
+}
+
+/**
+ * Ordnet ein einzelnes neues Dokument einem bestehenden Cluster zu, ohne neu zu clustern.
+ * `cluster.py assign` verwendet dafür die beim letzten Clustering gespeicherte Cluster-Zusammenfassung
+ * (Zentroide, Ordner-Matrix, Anker-Parameter) und benötigt nur wenige Millisekunden.
+ *
+ * @async
+ * @function assignDocument
+ * @param {Array<number>} embedding - Das Embedding des neuen Dokuments.
+ * @param {number} userId - Die Benutzer-ID.
+ * @param {number|null} [folderId=null] - Der Ordner des Dokuments, falls bekannt.
+ * @returns {Promise<Object>} Ein Objekt mit `label`, `probability`, `exemplars` und `folderAffinities`.
+ * @throws {Error} Falls noch keine Zusammenfassung gespeichert ist oder ein Fehler auftritt.
+ */
+async function assignDocument(embedding, userId, folderId = null) {
+    if (!userId) {
+        throw new Error('userId is required for security purposes');
+    }
+    const embeddingsData = { doc_embeddings: [embedding.map(Number)] };
+    const assignConfig = { userId, ...(folderId !== null && { folderId: String(folderId) }) };
+
+    let result;
+    if (process.env.CLUSTERING_SERVER === 'true') {
+        result = await getClusteringServer().request(embeddingsData, assignConfig, 'assign');
+    } else {
+        const timestamp = Date.now();
+        const tempEmbeddingsPath = path.join(os.tmpdir(), `assign_embedding_${timestamp}.json`);
+        const tempConfigPath = path.join(os.tmpdir(), `assign_config_${timestamp}.json`);
+        fs.writeFileSync(tempEmbeddingsPath, JSON.stringify(embeddingsData));
+        fs.writeFileSync(tempConfigPath, JSON.stringify(assignConfig));
+
+        const stdout = await new Promise((resolve, reject) => {
+            exec(
+                `python "${clusterScriptPath}" assign "${tempEmbeddingsPath}" "${tempConfigPath}"`,
+                { env: pythonEnv() },
+                (error, output) => {
+                    try {
+                        fs.unlinkSync(tempEmbeddingsPath);
+                        fs.unlinkSync(tempConfigPath);
+                    } catch (cleanupError) {
+                        console.error('Error cleaning up temp files:', cleanupError);
+                    }
+                    // cluster.py gibt auch im Fehlerfall ein JSON-Objekt mit `error` aus
+                    if (error && !output.trim()) {
+                        reject(error);
+                        return;
+                    }
+                    resolve(output);
+                }
+            );
+        });
+        result = JSON.parse(stdout.trim());
+    }
+
+    if (result.error) {
+        throw new Error(result.error);
+    }
+    return {
+        label: result.label,
+        probability: result.probability,
+        exemplars: result.exemplars,
+        folderAffinities: result.folder_affinities
+    };
+}
+
+/**
+ * Schreibt die Cluster-Labels eines Benutzers mit einer einzigen UPDATE-Abfrage zurück.
+ *
+ * @async
+ * @function writeClusterLabels
+ * @param {Array<number>} fileIds - Die Datei-IDs in der Reihenfolge der Labels.
+ * @param {Array<number>} labels - Die Cluster-Labels.
+ * @returns {Promise<void>}
+ */
+async function writeClusterLabels(fileIds, labels) {
+    if (!fileIds.length) {
+        return;
+    }
+    await db.query(
+        `UPDATE main.files AS f
+         SET cluster_label = u.label
+         FROM unnest($1::int[], $2::int[]) AS u(file_id, label)
+         WHERE f.file_id = u.file_id`,
+        [fileIds, labels]
+    );
+}
+
+/**
+ * Clustert alle (oder die angegebenen) Benutzer neu (Admin-Route `POST /clustering/batch`).
+ * Startet `cluster.py batch`, das jeden Benutzer getrennt in einem Prozess-Pool clustert
+ * und die Embeddings selbst aus der Datenbank liest. Die Cluster werden an den gespeicherten Labels
+ * ausgerichtet; nur die geänderten Labels eines Benutzers werden geschrieben, sobald seine
+ * Ergebniszeile (NDJSON) eintrifft.
+ * `CLUSTERING_BATCH_WORKERS` begrenzt die Anzahl paralleler Prozesse (Standard: Anzahl Kerne).
+ *
+ * @async
+ * @function runBatchClustering
+ * @param {Object} [config={}] - Konfigurationsoptionen für das Clustering aller Benutzer.
+ * @param {Array<number>} [userIds=[]] - Nur diese Benutzer clustern (leer: alle Benutzer).
+ * @returns {Promise<Object>} Ein Objekt mit den Benutzer-IDs in `succeeded` und `failed`.
+ */
+async function runBatchClustering(config = {}, userIds = []) {
+    const tempConfigPath = path.join(os.tmpdir(), `batch_config_${Date.now()}.json`);
+    fs.writeFileSync(tempConfigPath, JSON.stringify({
+        ...config,
+        anchorInfluence: config.anchorInfluence || 0.45,
+        semanticThreshold: config.semanticThreshold || 0.7,
+        knnGraph: config.knnGraph ?? process.env.CLUSTERING_KNN_GRAPH === 'true',
+        // Nur die gegenüber den gespeicherten Labels geänderten Zeilen zurückgeben
+        labelDelta: true
+    }));
+
+    const args = [clusterScriptPath, 'batch', tempConfigPath];
+    if (userIds.length) {
+        args.push('--users', ...userIds.map(String));
+    }
+    if (process.env.CLUSTERING_BATCH_WORKERS) {
+        args.push('--workers', process.env.CLUSTERING_BATCH_WORKERS);
+    }
+
+    const child = spawn('python', args, { stdio: ['ignore', 'pipe', 'pipe'], env: pythonEnv() });
+    child.stderr.on('data', (chunk) => console.error(`Batch clustering output: ${chunk}`));
+    const exited = new Promise((resolve) => child.on('close', resolve));
+
+    const summary = { succeeded: [], failed: [] };
+    try {
+        for await (const line of readline.createInterface({ input: child.stdout })) {
+            if (!line.trim()) {
+                continue;
+            }
+            const record = JSON.parse(line);
+            if (record.status !== 'ok') {
+                console.error(`Batch clustering failed for user ${record.userId}: ${record.error}`);
+                summary.failed.push(record.userId);
+                continue;
+            }
+            const changes = record.result.label_changes;
+            await writeClusterLabels(changes.file_ids, changes.labels);
+            summary.succeeded.push(record.userId);
+        }
+        await exited;
+    } finally {
+        try {
+            fs.unlinkSync(tempConfigPath);
+        } catch (cleanupError) {
+            console.error('Error cleaning up temp files:', cleanupError);
+        }
+    }
+
+    return summary;
+}
+
+module.exports = {
+    runClustering,
+    runBatchClustering,
+    recutClustering,
+    scheduleClustering,
+    getClusteringStatus,
+    assignDocument,
+    writeClusterLabels
+};
\ No newline at end of file
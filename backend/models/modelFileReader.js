@@ -7,8 +7,9 @@
  * @module modelFileReader
  */
 
-const { PythonShell } = require('python-shell');
+const { spawn } = require('child_process');
 const fs = require('fs').promises;
+const os = require('os');
 const path = require('path');
 const mammoth = require('mammoth');
 const { performOCR } = require('./modelOcr');
@@ -16,13 +17,180 @@ const { performance } = require('perf_hooks');
 
 const pythonScriptPath = path.join(__dirname, 'pdf_extractor.py');
 
+let pdfExtractorServer = null;
+
+/**
+ * Liefert die Budget-Argumente für `pdf_extractor.py`: Mit `PDF_EXTRACTOR_MAX_CHARS` oder
+ * `PDF_EXTRACTOR_MAX_TOKENS` (geschätzte Tokens) endet die Extraktion, sobald der Text das Budget
+ * erreicht hat, plus `PDF_EXTRACTOR_EXTRA_PAGES` weitere Seiten (z.B. für die Schlüsselwörter).
+ * Das Embedding-Modell verwendet ohnehin nur den Anfang des Textes.
+ *
+ * @function budgetArgs
+ * @returns {string[]} Die Argumente, leer ohne Budget.
+ */
+function budgetArgs() {
+    const args = [];
+    if (process.env.PDF_EXTRACTOR_MAX_CHARS) {
+        args.push('--max-chars', process.env.PDF_EXTRACTOR_MAX_CHARS);
+    }
+    if (process.env.PDF_EXTRACTOR_MAX_TOKENS) {
+        args.push('--max-tokens', process.env.PDF_EXTRACTOR_MAX_TOKENS);
+    }
+    if (args.length > 0 && process.env.PDF_EXTRACTOR_EXTRA_PAGES) {
+        args.push('--extra-pages', process.env.PDF_EXTRACTOR_EXTRA_PAGES);
+    }
+    return args;
+}
+
+/**
+ * Liefert den dauerhaft laufenden PDF-Extraktionsdienst (`pdf_extractor.py serve`) und startet ihn
+ * beim ersten Aufruf. Ein Pool von Worker-Prozessen mit bereits importiertem pdfminer bearbeitet die
+ * Anfragen parallel; Anfragen (ID + PDF-Bytes) und Antworten (ID, Status, Text) werden als Frames über
+ * stdin/stdout ausgetauscht, Antworten kommen in der Reihenfolge ihrer Fertigstellung.
+ * `PDF_EXTRACTOR_WORKERS` legt die Anzahl Worker fest (Standard: Anzahl Kerne),
+ * `PDF_EXTRACTOR_MAX_DOCS` nach wie vielen Dokumenten ein Worker ersetzt wird (Standard: 50).
+ * Mit `PDF_EXTRACTOR_PARALLEL_MIN_PAGES=N` werden PDFs ab N Seiten seitenweise auf die Worker verteilt.
+ * Ein Budget (siehe `budgetArgs`) gilt für alle Anfragen; gekürzte Dokumente meldet der Dienst im Log.
+ *
+ * @function getPdfExtractorServer
+ * @returns {Object} Ein Objekt mit der Methode `extract(buffer)`.
+ */
+function getPdfExtractorServer() {
+    if (pdfExtractorServer) {
+        return pdfExtractorServer;
+    }
+
+    const args = [
+        pythonScriptPath, 'serve',
+        '--workers', process.env.PDF_EXTRACTOR_WORKERS || String(os.cpus().length),
+        '--max-docs-per-worker', process.env.PDF_EXTRACTOR_MAX_DOCS || '50'
+    ];
+    if (process.env.PDF_EXTRACTOR_PARALLEL_MIN_PAGES) {
+        args.push('--parallel-min-pages', process.env.PDF_EXTRACTOR_PARALLEL_MIN_PAGES);
+    }
+    args.push(...budgetArgs());
+    const child = spawn('python', args, { stdio: ['pipe', 'pipe', 'pipe'] });
+    const pending = new Map();
+    let nextRequestId = 1;
+    let buffered = Buffer.alloc(0);
+
+    child.stdout.on('data', (chunk) => {
+        buffered = Buffer.concat([buffered, chunk]);
+        // Vollständige Frames abarbeiten: 4 Byte ID, 1 Byte Status, 4 Byte Länge (big-endian) + Text
+        while (buffered.length >= 9) {
+            const length = buffered.readUInt32BE(5);
+            if (buffered.length < 9 + length) {
+                break;
+            }
+            const id = buffered.readUInt32BE(0);
+            const failed = buffered[4] !== 0;
+            const text = buffered.subarray(9, 9 + length).toString('utf-8');
+            buffered = buffered.subarray(9 + length);
+
+            const request = pending.get(id);
+            if (request) {
+                pending.delete(id);
+                if (failed) {
+                    request.reject(new Error(`ERROR: ${text}`));
+                } else {
+                    request.resolve(text);
+                }
+            }
+        }
+    });
+
+    child.stderr.on('data', (data) => {
+        console.error(`PDF extraction server: ${data}`);
+    });
+
+    child.on('exit', (code) => {
+        console.error(`PDF extraction server exited with code ${code}`);
+        pdfExtractorServer = null;
+        for (const request of pending.values()) {
+            request.reject(new Error('PDF extraction server exited'));
+        }
+        pending.clear();
+    });
+
+    pdfExtractorServer = {
+        extract(buffer) {
+            return new Promise((resolve, reject) => {
+                const id = nextRequestId++;
+                const header = Buffer.alloc(8);
+                header.writeUInt32BE(id, 0);
+                header.writeUInt32BE(buffer.length, 4);
+
+                pending.set(id, { resolve, reject });
+                child.stdin.write(Buffer.concat([header, buffer]));
+            });
+        }
+    };
+
+    return pdfExtractorServer;
+}
+
+/**
+ * Extrahiert Text aus einer PDF-Datei mit einem eigenen Aufruf von `pdf_extractor.py --raw`.
+ * Das PDF wird als 4 Byte Länge (big-endian) + rohe Bytes über stdin übergeben statt Base64-kodiert,
+ * der Text kommt unverändert (inklusive Zeilenumbrüchen) über stdout zurück.
+ * Mit `PDF_EXTRACTOR_PAGE_WORKERS=N` werden große PDFs seitenweise auf N Prozesse verteilt.
+ *
+ * @async
+ * @function runPdfExtractorScript
+ * @param {Buffer} buffer - Der Dateiinhalt als Buffer.
+ * @param {number} attempt - Die Nummer des Versuchs (für das Logging).
+ * @returns {Promise<string>} Der extrahierte Text aus dem PDF.
+ */
+function runPdfExtractorScript(buffer, attempt) {
+    return new Promise((resolve, reject) => {
+        const budget = budgetArgs();
+        const args = ['-u', pythonScriptPath, '--raw', ...budget];
+        // Das Budget liest die Seiten der Reihe nach, die seitenparallele Extraktion entfällt dann
+        if (budget.length === 0 && process.env.PDF_EXTRACTOR_PAGE_WORKERS) {
+            args.push('--parallel', process.env.PDF_EXTRACTOR_PAGE_WORKERS);
+        }
+        const child = spawn('python', args, { stdio: ['pipe', 'pipe', 'pipe'] });
+        const output = [];
+        let errorOutput = '';
+
+        child.stdout.on('data', (chunk) => output.push(chunk));
+        child.stderr.on('data', (chunk) => {
+            errorOutput += chunk;
+        });
+        child.on('error', reject);
+        child.on('close', (code) => {
+            if (code !== 0) {
+                const err = new Error(`pdf_extractor.py exited with code ${code}: ${errorOutput.trim()}`);
+                console.error(`Attempt ${attempt} failed:`, err);
+                reject(err);
+                return;
+            }
+            if (budget.length > 0) {
+                // [INFO] Budget: {"truncated": ..., "pages": ..., ...}
+                console.log(`PDF extractor: ${errorOutput.trim()}`);
+            }
+            resolve(Buffer.concat(output).toString('utf-8'));
+        });
+
+        const header = Buffer.alloc(4);
+        header.writeUInt32BE(buffer.length, 0);
+        // Bricht der Prozess vorzeitig ab, meldet `close` den Fehler
+        child.stdin.on('error', () => {});
+        child.stdin.write(header);
+        child.stdin.end(buffer);
+    });
+}
+
 /**
  * Extrahiert Text aus einer PDF-Datei mithilfe eines externen Python-Skripts.
+ * Mit `PDF_EXTRACTOR_SERVER=true` wird der dauerhaft laufende Extraktionsdienst verwendet,
+ * ansonsten wird `pdf_extractor.py` pro Datei gestartet.
  * Führt mehrere Versuche durch, falls ein Fehler auftritt.
  *
  * @async
  * @function extractTextFromPDF
  * @param {Buffer} buffer - Der Dateiinhalt als Buffer.
+ * @param {string} [filename] - Der Name der Datei (nicht verwendet).
  * @returns {Promise<string>} Der extrahierte Text aus dem PDF.
  * @throws {Error} Falls die Extraktion fehlschlägt oder das Python-Skript einen Fehler zurückgibt.
  * @example
@@ -30,38 +198,19 @@ const pythonScriptPath = path.join(__dirname, 'pdf_extractor.py');
  * const text = await extractTextFromPDF(pdfBuffer);
  * console.log(text);
  */
-async function extractTextFromPDF(buffer) {
+async function extractTextFromPDF(buffer, filename) {
     const maxRetries = 3;
     const retryDelay = 1000;
 
     for (let attempt = 1; attempt <= maxRetries; attempt++) {
         try {
             //console.log(`Attempt ${attempt} to extract text from PDF`);
-            const pyshell = new PythonShell(pythonScriptPath, {
-                mode: 'text',
-                pythonOptions: ['-u'],
-                stdinWithAck: true,
-                encoding: 'utf-8'
-            });
-
-            const extractedText = await new Promise((resolve, reject) => {
-                let textContent = '';
-                pyshell.stdin.write(buffer.toString('base64'));
-                pyshell.stdin.end();
-
-                pyshell.on('message', (message) => {
-                    textContent += message;
-                });
-
-                pyshell.end((err) => {
-                    if (err) {
-                        console.error(`Attempt ${attempt} failed:`, err);
-                        reject(err);
-                    } else {
-                        resolve(textContent);
-                    }
-                });
-            });
+            let extractedText;
+            if (process.env.PDF_EXTRACTOR_SERVER === 'true') {
+                extractedText = await getPdfExtractorServer().extract(buffer);
+            } else {
+                extractedText = await runPdfExtractorScript(buffer, attempt);
+            }
 
             if (extractedText.startsWith('ERROR:')) {
                 throw new Error(extractedText);
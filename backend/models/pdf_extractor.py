@@ -2,31 +2,535 @@
 Diese Datei enthält Funktionen zum Extrahieren von Text aus PDF-Dokumenten.
 Sie ermöglicht die Dekodierung von Base64-kodierten PDF-Dateien und die Textextraktion mithilfe von pdfminer.
 
-@autor Miray. 
+Aufruf als Skript (Ausgabe: der Text auf stdout):
+    python pdf_extractor.py               # PDF Base64-kodiert auf stdin (bisheriges Format)
+    python pdf_extractor.py --raw         # 4 Byte Länge (big-endian) + rohe PDF-Bytes auf stdin
+    python pdf_extractor.py --file PATH   # PDF aus einer Datei, z.B. auch /proc/self/fd/N für ein memfd
+Mit --raw liegt das PDF nur einmal im Speicher (kein Base64-Text, keine dekodierte Kopie), mit --file
+liest pdfminer die Datei nur abschnittsweise. Die übrigen Optionen gelten für alle drei Quellen und
+in beliebiger Reihenfolge. Zusätzlich kann mit --parallel N ein großes PDF
+seitenweise auf N Prozesse verteilt werden (ab --min-pages Seiten, Standard: 40); im Dienst verteilt
+`serve --parallel-min-pages N` große PDFs auf die Worker des Pools. Mit --ndjson wird statt des ganzen
+Textes pro Seite eine JSON-Zeile {"page", "text", "chars", "elapsed_ms"} ausgegeben, sobald die Seite
+fertig ist, damit die Weiterverarbeitung schon während der Extraktion beginnen kann.
+Mit --max-chars N oder --max-tokens N (geschätzt) endet die Extraktion --extra-pages Seiten nach der Seite,
+auf der das Budget erreicht ist (das Embedding-Modell liest ohnehin nur den Anfang); ob gekürzt wurde,
+steht als letzter NDJSON-Datensatz {"summary": ...} bzw. als [INFO]-Zeile auf stderr. Im Dienst gelten
+dieselben Optionen für alle Anfragen.
+
+Mit `python pdf_extractor.py serve` läuft sie als dauerhafter Dienst: Ein Pool vorab gestarteter
+Worker-Prozesse (pdfminer bereits importiert) nimmt Anfragen als Frames (Anfrage-ID + PDF-Bytes) über
+stdin oder einen Unix-Socket entgegen und beantwortet sie in der Reihenfolge ihrer Fertigstellung.
+Jeder Worker wird nach einer einstellbaren Anzahl Dokumente ersetzt, um das Speicherwachstum von
+pdfminer zu begrenzen.
+
+@autor Miray.
 Die Funktionen wurden mit Unterstützung von KI tools angepasst und optimiert
 """
 
 import sys
 import io
+import os
+import re
+import json
+import time
 import base64
-from pdfminer.high_level import extract_text_to_fp
+import signal
+import struct
+import argparse
+import threading
+import socketserver
+import tempfile
+import mmap
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pdfminer.converter import TextConverter
 from pdfminer.layout import LAParams
+from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+from pdfminer.pdfpage import PDFPage
 
-def extract_text_from_pdf(pdf_base64):
-    pdf_buffer = io.BytesIO(base64.b64decode(pdf_base64))
-    output_buffer = io.StringIO()
-    
+# Words and runs of punctuation: every one becomes at least one SentencePiece token of the MPNet
+# tokenizer for ordinary text, so the estimate tends to stay below the real count
+TOKEN_PATTERN = re.compile(r'\w+|[^\w\s]+')
+
+def estimate_tokens(text):
+    return len(TOKEN_PATTERN.findall(text))
+
+class PageBudget:
+    """
+    Early stop for the embedding: extraction ends `extra_pages` pages after the page on which the text
+    reached max_chars characters or (estimated) max_tokens tokens; 0 disables a limit. iter_page_texts
+    records in `truncated` whether the document had further pages.
+    """
+
+    def __init__(self, max_chars=0, max_tokens=0, extra_pages=0):
+        self.max_chars = max_chars
+        self.max_tokens = max_tokens
+        self.extra_pages = extra_pages
+        self.chars = 0
+        self.tokens = 0
+        self.pages = 0
+        self.budget_page = None
+        self.truncated = False
+
+    def add(self, text):
+        """Account for the next page; returns True once no further page is needed."""
+        self.pages += 1
+        self.chars += len(text)
+        if self.max_tokens:
+            self.tokens += estimate_tokens(text)
+        if self.budget_page is None and ((self.max_chars and self.chars >= self.max_chars) or
+                                         (self.max_tokens and self.tokens >= self.max_tokens)):
+            self.budget_page = self.pages
+        return self.budget_page is not None and self.pages >= self.budget_page + self.extra_pages
+
+    def report(self):
+        return {'truncated': self.truncated, 'pages': self.pages, 'budget_page': self.budget_page,
+                'chars': self.chars, 'tokens': self.tokens if self.max_tokens else None}
+
+def iter_page_texts(pdf_stream, page_numbers=None, budget=None):
+    """
+    Yield (page index, text) for every page as soon as it is laid out. This is what
+    pdfminer's extract_text_to_fp does, except that the converter's buffer is drained after every
+    page, so only one page of text is held at a time. Every text ends with the form feed pdfminer
+    writes after a page; the texts joined are exactly the text of the whole document.
+    With a PageBudget, the pages after the budget are neither parsed nor laid out.
+    """
+    resource_manager = PDFResourceManager(caching=True)
+    page_buffer = io.StringIO()
     laparams = LAParams(line_margin=0.5, word_margin=0.1)
-    extract_text_to_fp(pdf_buffer, output_buffer, laparams=laparams, codec='utf-8')
-    
-    return output_buffer.getvalue()
+    device = TextConverter(resource_manager, page_buffer, codec='utf-8', laparams=laparams)
+    interpreter = PDFPageInterpreter(resource_manager, device)
+    pages = PDFPage.get_pages(pdf_stream, caching=True)
+    try:
+        for index, page in enumerate(pages):
+            # Same filter as PDFPage.get_pages, which does not report the index of a page
+            if page_numbers and index not in page_numbers:
+                continue
+            page.rotate %= 360  # as extract_text_to_fp normalizes it
+            interpreter.process_page(page)
+            text = page_buffer.getvalue()
+            stop = budget is not None and budget.add(text)
+            yield index, text
+            if stop:
+                # Only the page tree entry of the next page is read, its content is not interpreted
+                budget.truncated = next(pages, None) is not None
+                return
+            page_buffer.seek(0)
+            page_buffer.truncate()
+    finally:
+        device.close()
 
-if __name__ == "__main__":
-    sys.stdin.reconfigure(encoding='utf-8')
-    sys.stdout.reconfigure(encoding='utf-8')
-    
-    pdf_base64 = sys.stdin.read()
-    extracted_text = extract_text_from_pdf(pdf_base64)
-    
-    sys.stdout.write(extracted_text)
+def extract_text_from_stream(pdf_stream, page_numbers=None, budget=None):
+    return ''.join(text for _, text in iter_page_texts(pdf_stream, page_numbers, budget))
+
+def extract_text_from_bytes(pdf_bytes, budget=None):
+    # BytesIO shares the memory of a bytes object instead of copying it
+    return extract_text_from_stream(io.BytesIO(pdf_bytes), budget=budget)
+
+def extract_text_from_file(path, budget=None):
+    with open(path, 'rb') as pdf_file:
+        return extract_text_from_stream(pdf_file, budget=budget)
+
+def extract_text_from_pdf(pdf_base64):
+    return extract_text_from_bytes(base64.b64decode(pdf_base64))
+
+def extract_bytes_within_budget(pdf_bytes, limits):
+    """Pool worker: extract_text_from_bytes with a PageBudget(**limits), reporting an early stop on stderr."""
+    budget = PageBudget(**limits)
+    text = extract_text_from_bytes(pdf_bytes, budget)
+    if budget.truncated:
+        print(f"[INFO] Stopped after page {budget.pages} (budget reached on page {budget.budget_page})",
+              file=sys.stderr)
+    return text
+
+def _write_record(output, record):
+    output.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+    output.flush()
+
+def write_page_records(pdf_stream, output, budget=None):
+    """
+    Write one NDJSON record per page to the binary stream output and flush it right away:
+    {"page": 1-based number, "text": ..., "chars": len(text), "elapsed_ms": since the start}.
+    With a budget, a last record {"summary": budget.report()} tells whether the text was truncated.
+    Returns the number of pages written.
+    """
+    start = time.perf_counter()
+    pages = 0
+    for index, text in iter_page_texts(pdf_stream, budget=budget):
+        _write_record(output, {'page': index + 1, 'text': text, 'chars': len(text),
+                               'elapsed_ms': round((time.perf_counter() - start) * 1000, 1)})
+        pages += 1
+    if budget is not None:
+        _write_record(output, {'summary': budget.report()})
+    return pages
+
+# ---------------------------------------------------------------------------
+# Page-parallel extraction for large PDFs
+# ---------------------------------------------------------------------------
+
+DEFAULT_MIN_PARALLEL_PAGES = 40
+# Two ranges per worker even out pages of different cost; every range re-parses the page tree
+# (about 0.1 s for 500 pages), so more ranges cost more than they balance
+RANGES_PER_WORKER = 2
+
+def count_pages(pdf_stream):
+    """Number of pages as pdfminer enumerates them (only the page tree is parsed, not the content)."""
+    return sum(1 for _ in PDFPage.get_pages(pdf_stream))
+
+def extract_page_range(path, first_page, end_page):
+    """Worker: text of the pages [first_page, end_page) of the PDF at path, read through a shared mmap."""
+    with open(path, 'rb') as pdf_file, mmap.mmap(pdf_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        return extract_text_from_stream(mapped, page_numbers=set(range(first_page, end_page)))
+
+def page_ranges(page_count, range_count):
+    """Split the pages into range_count contiguous, nearly equal ranges."""
+    bounds = [page_count * index // range_count for index in range(range_count + 1)]
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+def extract_text_parallel(path, workers, min_pages=DEFAULT_MIN_PARALLEL_PAGES):
+    """
+    Extract the PDF at path with `workers` processes: the pages are split into contiguous ranges,
+    every worker maps the file and extracts its ranges with the same LAParams, and the texts are joined
+    in page order. The result is identical to extract_text_from_file. PDFs with fewer than min_pages
+    pages are extracted in this process.
+    """
+    with open(path, 'rb') as pdf_file:
+        page_count = count_pages(pdf_file)
+    if workers <= 1 or page_count < max(2, min_pages):
+        return extract_text_from_file(path)
+
+    ranges = page_ranges(page_count, min(page_count, workers * RANGES_PER_WORKER))
+    # fork: the workers start with pdfminer imported and inherit a memfd passed as /proc/self/fd/N
+    with ProcessPoolExecutor(max_workers=min(workers, len(ranges)),
+                             mp_context=multiprocessing.get_context('fork')) as executor:
+        futures = [executor.submit(extract_page_range, path, start, end) for start, end in ranges]
+        return ''.join(future.result() for future in futures)
+
+def extract_bytes_parallel(pdf_bytes, workers, min_pages=DEFAULT_MIN_PARALLEL_PAGES):
+    """
+    extract_text_parallel for a PDF in memory: it is written once to a memfd (a temporary file where
+    memfd_create is unavailable), which all workers map.
+    """
+    if hasattr(os, 'memfd_create'):
+        fd = os.memfd_create('pdf_extractor')
+        with os.fdopen(fd, 'wb') as shared:
+            shared.write(pdf_bytes)
+            shared.flush()
+            return extract_text_parallel(f'/proc/self/fd/{fd}', workers, min_pages)
+
+    with tempfile.NamedTemporaryFile(suffix='.pdf') as shared:
+        shared.write(pdf_bytes)
+        shared.flush()
+        return extract_text_parallel(shared.name, workers, min_pages)
+
+# ---------------------------------------------------------------------------
+# Binary transport: length-prefixed input (--raw) and server frames
+# ---------------------------------------------------------------------------
+
+RAW_HEADER = struct.Struct('>I')         # PDF length (--raw)
+REQUEST_HEADER = struct.Struct('>II')    # request id, PDF length
+RESPONSE_HEADER = struct.Struct('>IBI')  # request id, status, payload length
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+def _read_exact(stream, size):
+    """
+    Read up to `size` bytes, stopping early only at EOF. A buffered stream returns all of them from
+    one read, and joining a single chunk returns it without a copy.
+    """
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+def read_request(stream):
+    """Read one request frame as (request id, PDF bytes). Returns None on a clean EOF."""
+    header = _read_exact(stream, REQUEST_HEADER.size)
+    if not header:
+        return None
+    if len(header) < REQUEST_HEADER.size:
+        raise EOFError("Connection closed inside a request header")
+    request_id, length = REQUEST_HEADER.unpack(header)
+    pdf_bytes = _read_exact(stream, length)
+    if len(pdf_bytes) < length:
+        raise EOFError(f"Connection closed inside a request of {length} bytes")
+    return request_id, pdf_bytes
+
+def read_raw_pdf(stream):
+    """Read a length-prefixed PDF (--raw) as one bytes object."""
+    header = _read_exact(stream, RAW_HEADER.size)
+    if len(header) < RAW_HEADER.size:
+        raise EOFError("Input ended inside the length header")
+    (length,) = RAW_HEADER.unpack(header)
+    pdf_bytes = _read_exact(stream, length)
+    if len(pdf_bytes) < length:
+        raise EOFError(f"Input ended after {len(pdf_bytes)} of {length} bytes")
+    return pdf_bytes
+
+def response_frame(request_id, status, text):
+    payload = text.encode('utf-8')
+    return RESPONSE_HEADER.pack(request_id, status, len(payload)) + payload
+
+# ---------------------------------------------------------------------------
+# Server mode: resident worker pool, framed requests, out-of-order responses
+# ---------------------------------------------------------------------------
+
+class PageRangeJob:
+    """
+    One request split into page ranges (server mode): collects the range texts, responds once all
+    arrived or at the first error, and removes the shared file after the last range finished.
+    ready() and wait() mirror the AsyncResult of an unsplit request.
+    """
+
+    def __init__(self, path, range_count, on_success, on_error):
+        self.path = path
+        self.texts = [None] * range_count
+        self.remaining = range_count
+        self.failed = False
+        self.on_success = on_success
+        self.on_error = on_error
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def range_finished(self, index, text=None, error=None):
+        with self.lock:
+            self.remaining -= 1
+            first_error = error is not None and not self.failed
+            if error is None:
+                self.texts[index] = text
+            else:
+                self.failed = True
+            finished = self.remaining == 0
+        if first_error:
+            self.on_error(error)
+        if finished:
+            if not self.failed:
+                self.on_success(''.join(self.texts))
+            os.unlink(self.path)
+            self.done.set()
+
+    def ready(self):
+        return self.done.is_set()
+
+    def wait(self):
+        self.done.wait()
+
+class ExtractionPool:
+    """
+    Pool of pre-forked extraction workers. The workers are forked from a fork server that has pdfminer
+    imported already, so neither the start nor the replacement of a worker pays for interpreter start
+    and imports. A worker is replaced after `max_documents` documents. With parallel_min_pages, PDFs
+    with at least that many pages are split into page ranges that are extracted by several workers;
+    with budget_limits (PageBudget arguments), every PDF is only extracted up to the budget.
+    """
+
+    def __init__(self, workers, max_documents, parallel_min_pages=0, budget_limits=None):
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['pdfminer.high_level', 'pdfminer.layout', 'pdfminer.pdfpage'])
+        self.pool = context.Pool(processes=workers, maxtasksperchild=max_documents or None)
+        self.workers = workers
+        self.parallel_min_pages = parallel_min_pages
+        self.budget_limits = budget_limits
+
+    def submit(self, request_id, pdf_bytes, respond):
+        """Extract asynchronously; respond(frame) is called from the pool's result thread."""
+        def on_success(text):
+            respond(response_frame(request_id, STATUS_OK, text))
+
+        def on_error(error):
+            print(f"[ERROR] Request {request_id}: {str(error)}", file=sys.stderr)
+            respond(response_frame(request_id, STATUS_ERROR, str(error)))
+
+        if self.budget_limits:
+            return self.pool.apply_async(extract_bytes_within_budget, (pdf_bytes, self.budget_limits),
+                                         callback=on_success, error_callback=on_error)
+
+        if self.parallel_min_pages and self.workers > 1:
+            try:
+                page_count = count_pages(io.BytesIO(pdf_bytes))
+            except Exception:
+                # Unreadable PDFs take the normal path, which reports the error
+                page_count = 0
+            if page_count >= max(2, self.parallel_min_pages):
+                return self._submit_ranges(pdf_bytes, page_count, on_success, on_error)
+
+        return self.pool.apply_async(extract_text_from_bytes, (pdf_bytes,),
+                                     callback=on_success, error_callback=on_error)
+
+    def _submit_ranges(self, pdf_bytes, page_count, on_success, on_error):
+        # The workers do not share this process's descriptors, so the PDF goes to a (memory backed) file
+        shared_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        with tempfile.NamedTemporaryFile(dir=shared_dir, suffix='.pdf', delete=False) as shared:
+            shared.write(pdf_bytes)
+
+        ranges = page_ranges(page_count, min(page_count, self.workers * RANGES_PER_WORKER))
+        job = PageRangeJob(shared.name, len(ranges), on_success, on_error)
+        for index, (start, end) in enumerate(ranges):
+            self.pool.apply_async(
+                extract_page_range, (shared.name, start, end),
+                callback=lambda text, index=index: job.range_finished(index, text=text),
+                error_callback=lambda error: job.range_finished(None, error=error)
+            )
+        return job
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+def _serve_stream(pool, rfile, wfile):
+    """Answer the requests of one stream, each as soon as it is extracted."""
+    write_lock = threading.Lock()
+
+    def respond(frame):
+        with write_lock:
+            try:
+                wfile.write(frame)
+                wfile.flush()
+            except OSError as e:
+                print(f"[ERROR] Could not send response: {str(e)}", file=sys.stderr)
+
+    pending = []
+    while True:
+        try:
+            request = read_request(rfile)
+        except EOFError as e:
+            print(f"[ERROR] {str(e)}", file=sys.stderr)
+            break
+        if request is None:
+            break
+        pending.append(pool.submit(*request, respond))
+        pending = [result for result in pending if not result.ready()]
+
+    # Input closed: finish outstanding work before returning
+    for result in pending:
+        result.wait()
+
+def serve_socket(pool, socket_path):
+    """Accept connections on a Unix socket; every connection may pipeline several requests."""
+    class ConnectionHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            _serve_stream(pool, self.rfile, self.wfile)
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    server = Server(socket_path, ConnectionHandler)
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    print(f"[INFO] PDF extraction server listening on {socket_path}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+def add_budget_arguments(parser):
+    parser.add_argument('--max-chars', type=int, default=0,
+                        help='Stop extracting once the text has this many characters (0: no limit)')
+    parser.add_argument('--max-tokens', type=int, default=0,
+                        help='Stop extracting once the text has about this many tokens (0: no limit)')
+    parser.add_argument('--extra-pages', type=int, default=0,
+                        help='Pages extracted after the budget is reached, e.g. for keywords')
+
+def budget_limits(args):
+    """PageBudget arguments from the command line, or None without a limit."""
+    if not (args.max_chars or args.max_tokens):
+        return None
+    return {'max_chars': args.max_chars, 'max_tokens': args.max_tokens, 'extra_pages': args.extra_pages}
+
+def serve(argv):
+    """
+    Entry point for `pdf_extractor.py serve [--socket PATH] [--workers N] [--max-docs-per-worker N]
+    [--parallel-min-pages N] [--max-chars N] [--max-tokens N] [--extra-pages N]`.
+    """
+    parser = argparse.ArgumentParser(prog='pdf_extractor.py serve')
+    parser.add_argument('--socket', help='Unix socket path; reads frames from stdin if omitted')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Number of PDFs extracted concurrently (default: number of cores)')
+    parser.add_argument('--max-docs-per-worker', type=int, default=50,
+                        help='Replace a worker after this many documents (0: never)')
+    parser.add_argument('--parallel-min-pages', type=int, default=0,
+                        help='Split PDFs with at least this many pages across the workers (0: never)')
+    add_budget_arguments(parser)
+    args = parser.parse_args(argv)
+
+    pool = ExtractionPool(max(1, args.workers), args.max_docs_per_worker, args.parallel_min_pages,
+                          budget_limits(args))
+    print(f"[INFO] PDF extraction server ready (workers: {args.workers})", file=sys.stderr)
+    try:
+        if args.socket:
+            serve_socket(pool, args.socket)
+        else:
+            _serve_stream(pool, sys.stdin.buffer, sys.stdout.buffer)
+    finally:
+        pool.close()
+
+def read_input_pdf(args):
+    """PDF bytes from stdin: length-prefixed with --raw, otherwise Base64 text (the original format)."""
+    if args.raw:
+        return read_raw_pdf(sys.stdin.buffer)
+    return base64.b64decode(sys.stdin.buffer.read())
+
+def main(argv):
+    """
+    Entry point for `pdf_extractor.py [--raw | --file PATH] [--parallel N] [--min-pages N] [--ndjson]
+    [--max-chars N] [--max-tokens N] [--extra-pages N]`; without --raw or --file the PDF is read
+    Base64-encoded from stdin. All options apply to every source.
+    """
+    parser = argparse.ArgumentParser(prog='pdf_extractor.py')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--raw', action='store_true', help='Length-prefixed PDF bytes on stdin')
+    source.add_argument('--file', help='Path of the PDF')
+    parser.add_argument('--parallel', type=int, default=1,
+                        help='Extract large PDFs page-parallel with this many processes')
+    parser.add_argument('--min-pages', type=int, default=DEFAULT_MIN_PARALLEL_PAGES,
+                        help='Minimum page count for page-parallel extraction')
+    parser.add_argument('--ndjson', action='store_true',
+                        help='Stream one JSON record per page instead of the whole text')
+    add_budget_arguments(parser)
+    args = parser.parse_args(argv)
+    limits = budget_limits(args)
+    if args.ndjson and args.parallel > 1:
+        parser.error('--ndjson streams pages in order and cannot be combined with --parallel')
+    if limits and args.parallel > 1:
+        parser.error('--max-chars/--max-tokens read pages in order and cannot be combined with --parallel')
+    budget = PageBudget(**limits) if limits else None
+
+    if args.ndjson:
+        if args.file:
+            with open(args.file, 'rb') as pdf_file:
+                write_page_records(pdf_file, sys.stdout.buffer, budget)
+        else:
+            write_page_records(io.BytesIO(read_input_pdf(args)), sys.stdout.buffer, budget)
+        return
+
+    if args.file:
+        if args.parallel > 1:
+            extracted_text = extract_text_parallel(args.file, args.parallel, args.min_pages)
+        else:
+            extracted_text = extract_text_from_file(args.file, budget)
+    else:
+        pdf_bytes = read_input_pdf(args)
+        if args.parallel > 1:
+            extracted_text = extract_bytes_parallel(pdf_bytes, args.parallel, args.min_pages)
+        else:
+            extracted_text = extract_text_from_bytes(pdf_bytes, budget)
+    sys.stdout.buffer.write(extracted_text.encode('utf-8'))
     sys.stdout.flush()
+    if budget is not None:
+        print(f"[INFO] Budget: {json.dumps(budget.report())}", file=sys.stderr)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        serve(sys.argv[2:])
+    else:
+        main(sys.argv[1:])
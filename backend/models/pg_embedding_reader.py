@@ -0,0 +1,237 @@
+"""
+Diese Datei enthält Funktionen zum direkten Einlesen der Datei- und Ordner-Embeddings eines Benutzers
+aus PostgreSQL für cluster.py. Die Daten werden per `COPY ... TO STDOUT (FORMAT binary)` gestreamt und
+das pgvector-Binärformat wird direkt in eine vorab allozierte float32-Matrix dekodiert, ohne Umweg
+über Text oder JSON.
+
+Außerdem können die Cluster-Labels geänderter Dateien mit einer einzigen UPDATE-Abfrage zurückgeschrieben werden.
+
+Verbindungsdaten kommen aus CLUSTERING_DATABASE_URL bzw. den libpq-Variablen (PGHOST, PGUSER, ...),
+das Schema aus POSTGRES_SCHEMA (Standard: main).
+
+Manueller Test gegen eine lokale Datenbank mit dem Schema aus database/01-init.sql:
+    PGHOST=localhost PGUSER=postgres PGPASSWORD=pgres python pg_embedding_reader.py <user_id>
+
+@author Lennart
+"""
+
+import os
+import re
+import struct
+import sys
+
+import numpy as np
+
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+COPY_HEADER = struct.Struct('>11sii')  # signature, flags, header extension length
+INT16 = struct.Struct('>h')
+INT32 = struct.Struct('>i')
+VECTOR_HEADER = struct.Struct('>hh')  # dimensions, unused
+
+class CopyBinaryDecoder:
+    """
+    Incremental decoder for PostgreSQL's binary COPY format. Chunks can be fed with arbitrary
+    boundaries; every complete tuple is passed to `on_row` as a list of memoryviews into the buffer
+    (None for NULL). They are only valid during the call: on_row must decode or copy what it keeps.
+    """
+
+    def __init__(self, on_row):
+        self.on_row = on_row
+        self.buffer = bytearray()
+        self.header_done = False
+        self.finished = False
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        offset = 0
+        if not self.header_done:
+            if len(self.buffer) < COPY_HEADER.size:
+                return
+            signature, _, extension_length = COPY_HEADER.unpack_from(self.buffer, 0)
+            if signature != COPY_SIGNATURE:
+                raise ValueError("Invalid COPY BINARY signature")
+            if len(self.buffer) < COPY_HEADER.size + extension_length:
+                return
+            offset = COPY_HEADER.size + extension_length
+            self.header_done = True
+
+        view = memoryview(self.buffer)
+        try:
+            while not self.finished:
+                row_end, fields = self._parse_tuple(view, offset)
+                if row_end is None:
+                    break
+                offset = row_end
+                if fields is None:
+                    self.finished = True
+                else:
+                    self.on_row(fields)
+                    # The slices pin the buffer, which is resized below
+                    for field in fields:
+                        if field is not None:
+                            field.release()
+                    fields = None
+        finally:
+            view.release()
+        del self.buffer[:offset]
+
+    def _parse_tuple(self, view, offset):
+        """Return (end offset, fields) of the tuple at offset, (None, None) if incomplete."""
+        if len(view) < offset + INT16.size:
+            return None, None
+        (field_count,) = INT16.unpack_from(view, offset)
+        position = offset + INT16.size
+        if field_count == -1:
+            return position, None
+
+        fields = []
+        for _ in range(field_count):
+            if len(view) < position + INT32.size:
+                return None, None
+            (length,) = INT32.unpack_from(view, position)
+            position += INT32.size
+            if length == -1:
+                fields.append(None)
+                continue
+            if len(view) < position + length:
+                return None, None
+            fields.append(view[position:position + length])
+            position += length
+        return position, fields
+
+def decode_vector_into(field, target_row):
+    """Decode a pgvector binary value (int16 dim, int16 unused, float4[dim] big-endian) into a row."""
+    dim, _ = VECTOR_HEADER.unpack_from(field, 0)
+    if dim != len(target_row):
+        raise ValueError(f"Embedding has {dim} dimensions, expected {len(target_row)}")
+    target_row[:] = np.frombuffer(field, dtype='>f4', count=dim, offset=VECTOR_HEADER.size)
+
+def _schema():
+    schema = os.environ.get('POSTGRES_SCHEMA', 'main')
+    if not re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', schema):
+        raise ValueError(f"Invalid schema name '{schema}'")
+    return schema
+
+def _copy_rows(cursor, query, on_row):
+    decoder = CopyBinaryDecoder(on_row)
+    with cursor.copy(query) as copy:
+        for chunk in copy:
+            decoder.feed(chunk)
+    if not decoder.finished:
+        raise ValueError("COPY stream ended without trailer")
+
+def list_user_ids(database_url=None):
+    """
+    Ids of all users with embedded files, largest corpus first (so a batch run starts the
+    longest jobs early).
+    """
+    import psycopg
+
+    schema = _schema()
+    database_url = database_url or os.environ.get('CLUSTERING_DATABASE_URL', '')
+    with psycopg.connect(database_url) as connection, connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT user_id FROM {schema}.files WHERE embedding IS NOT NULL "
+            f"GROUP BY user_id ORDER BY count(*) DESC, user_id"
+        )
+        return [user_id for (user_id,) in cursor.fetchall()]
+
+def read_user_embeddings(user_id, dim=768, database_url=None):
+    """
+    Read all embedded files and folders of a user and return the embeddings_data structure of
+    cluster.py plus 'file_ids' (the file id of every matrix row, ordered by file id) and
+    'previous_labels' (the stored cluster_label of every row, None if not clustered yet).
+    Count and COPY run in one REPEATABLE READ transaction, so the preallocated matrix always fits.
+    """
+    import psycopg
+
+    user_id = int(user_id)
+    schema = _schema()
+    database_url = database_url or os.environ.get('CLUSTERING_DATABASE_URL', '')
+
+    with psycopg.connect(database_url) as connection:
+        connection.isolation_level = psycopg.IsolationLevel.REPEATABLE_READ
+        with connection.transaction(), connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT count(*) FROM {schema}.files WHERE user_id = %s AND embedding IS NOT NULL",
+                (user_id,)
+            )
+            (file_count,) = cursor.fetchone()
+            cursor.execute(
+                f"SELECT count(*) FROM {schema}.folders WHERE user_id = %s AND embedding IS NOT NULL",
+                (user_id,)
+            )
+            (folder_count,) = cursor.fetchone()
+
+            doc_matrix = np.empty((file_count, dim), dtype=np.float32)
+            file_ids = []
+            file_folders = []
+            previous_labels = []
+
+            def on_file_row(fields):
+                file_id, folder_id, cluster_label, embedding = fields
+                decode_vector_into(embedding, doc_matrix[len(file_ids)])
+                file_ids.append(INT32.unpack(file_id)[0])
+                file_folders.append(None if folder_id is None else INT32.unpack(folder_id)[0])
+                previous_labels.append(None if cluster_label is None else INT32.unpack(cluster_label)[0])
+
+            _copy_rows(cursor, (
+                f"COPY (SELECT file_id, folder_id, cluster_label, embedding FROM {schema}.files "
+                f"WHERE user_id = {user_id} AND embedding IS NOT NULL ORDER BY file_id) "
+                f"TO STDOUT (FORMAT binary)"
+            ), on_file_row)
+
+            folder_matrix = np.empty((folder_count, dim), dtype=np.float32)
+            folder_ids = []
+
+            def on_folder_row(fields):
+                folder_id, embedding = fields
+                decode_vector_into(embedding, folder_matrix[len(folder_ids)])
+                folder_ids.append(str(INT32.unpack(folder_id)[0]))
+
+            _copy_rows(cursor, (
+                f"COPY (SELECT folder_id, embedding FROM {schema}.folders "
+                f"WHERE user_id = {user_id} AND embedding IS NOT NULL ORDER BY folder_id) "
+                f"TO STDOUT (FORMAT binary)"
+            ), on_folder_row)
+
+    # Only folders with an embedding can guide the clustering
+    known_folders = set(folder_ids)
+    doc_to_folder_map = {
+        str(row): str(folder_id)
+        for row, folder_id in enumerate(file_folders)
+        if folder_id is not None and str(folder_id) in known_folders
+    }
+
+    return {
+        'doc_embeddings': doc_matrix,
+        'folder_embeddings': dict(zip(folder_ids, folder_matrix)),
+        'doc_to_folder_map': doc_to_folder_map,
+        'file_ids': file_ids,
+        'previous_labels': previous_labels
+    }
+
+def write_cluster_labels(user_id, file_ids, labels, database_url=None):
+    """
+    Store the cluster labels of the given files of a user with one UPDATE (the counterpart of
+    writeClusterLabels in modelClustering.js). Returns the number of updated rows.
+    """
+    if not file_ids:
+        return 0
+    import psycopg
+
+    schema = _schema()
+    database_url = database_url or os.environ.get('CLUSTERING_DATABASE_URL', '')
+    with psycopg.connect(database_url) as connection, connection.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {schema}.files AS f SET cluster_label = u.label "
+            f"FROM unnest(%s::int[], %s::int[]) AS u(file_id, label) "
+            f"WHERE f.file_id = u.file_id AND f.user_id = %s",
+            (list(file_ids), list(labels), int(user_id))
+        )
+        return cursor.rowcount
+
+if __name__ == "__main__":
+    data = read_user_embeddings(sys.argv[1])
+    print(f"[INFO] Files: {data['doc_embeddings'].shape}, folders: {len(data['folder_embeddings'])}, "
+          f"assigned documents: {len(data['doc_to_folder_map'])}", file=sys.stderr)
@@ -0,0 +1,48 @@
+"""
+Gemeinsame Fixtures für die Tests der Python-Module in backend/models.
+
+@author Lennart
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+# cluster.py and its helpers import each other as top-level modules
+sys.path.insert(0, os.path.join(TESTS_DIR, '..'))
+# Synthetic PDFs come from the PDF benchmark
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', '..', '..', 'benchmarks'))
+
+def make_corpus(doc_count, dim=32, centers=4, seed=0, file_ids=False):
+    """Embeddings around `centers` well separated directions, without folders (file ids 1000, 1001, ...)."""
+    rng = np.random.default_rng(seed)
+    directions = rng.normal(size=(centers, dim))
+    members = np.arange(doc_count) % centers
+    docs = directions[members] + 0.05 * rng.normal(size=(doc_count, dim))
+    corpus = {
+        'doc_embeddings': docs.tolist(),
+        'folder_embeddings': {},
+        'doc_to_folder_map': {}
+    }
+    if file_ids:
+        corpus['file_ids'] = list(range(1000, 1000 + doc_count))
+    return corpus
+
+@pytest.fixture
+def model_dir(tmp_path):
+    """Isolated per-user model store."""
+    return str(tmp_path / 'models')
+
+@pytest.fixture
+def make_pdf(tmp_path):
+    """Factory for synthetic text PDFs: make_pdf(pages, lines_per_page=20) returns the path."""
+    from pdf_benchmark import build_pdf
+
+    def make(pages, lines_per_page=20):
+        path = str(tmp_path / f'document_{pages}x{lines_per_page}.pdf')
+        build_pdf(path, pages, lines_per_page)
+        return path
+    return make
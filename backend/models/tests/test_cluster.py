@@ -0,0 +1,480 @@
+"""
+Tests für backend/models/cluster.py.
+
+@author Lennart
+"""
+
+import json
+import os
+import struct
+import subprocess
+import sys
+
+import hdbscan
+import numpy as np
+import pytest
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial.distance import cdist
+from sklearn.metrics import adjusted_rand_score
+from sklearn.preprocessing import normalize
+
+from cluster import (PROBABILITY_SCALE, GuidedClustering, _anchor_features, as_features, cosine_similarities, fit_hdbscan, knn_search,
+                     knn_spanning_tree, load_user_model, make_clusterer, relative_validity, run_assign, run_clustering,
+                     read_compact_result, run_recut, save_user_model, select_clusters, sparse_affinities, user_knn_graph,
+                     user_model_path, write_compact_result)
+from conftest import make_corpus
+
+def reference_affinities(folder_similarities, folder_ids, semantic_threshold, start_index):
+    """Nested-loop folder affinities as computed before sparse_affinities."""
+    folder_affinities = {}
+    for i, similarities in enumerate(folder_similarities):
+        significant_folders = {}
+        for j, sim in enumerate(similarities):
+            if sim >= semantic_threshold:
+                significant_folders[folder_ids[j]] = float(sim)
+        if significant_folders:
+            folder_affinities[str(start_index + i)] = significant_folders
+    return folder_affinities
+
+def reference_anchor_features(normalized_docs, folder_similarities, folder_ids, doc_to_folder_map, config,
+                              start_index):
+    """Per-document boost loop as computed before _anchor_features."""
+    anchor_influence = config.get('anchorInfluence', 0.45)
+    semantic_threshold = config.get('semanticThreshold', 0.7)
+    transformed_embeddings = np.hstack([
+        normalized_docs * (1 - anchor_influence),
+        folder_similarities * anchor_influence
+    ])
+    for doc_idx, folder_id in doc_to_folder_map.items():
+        doc_idx = int(doc_idx) - start_index
+        if 0 <= doc_idx < len(transformed_embeddings):
+            folder_idx = folder_ids.index(folder_id)
+            folder_vec = folder_similarities[doc_idx]
+            boost = np.zeros_like(folder_vec)
+            boost[folder_idx] = 1.0
+            for other_idx, sim in enumerate(folder_vec):
+                if sim >= semantic_threshold and other_idx != folder_idx:
+                    boost[other_idx] = sim
+            transformed_embeddings[doc_idx, -len(folder_vec):] *= (1 + boost * 0.5)
+    return normalize(transformed_embeddings)
+
+def reference_folder_similarity_distances(guided):
+    """Pairwise loop over the upper triangle as computed before the tiled version."""
+    distances = cdist(guided.doc_embeddings, guided.doc_embeddings, metric='cosine')
+    for i in range(len(guided.doc_embeddings)):
+        for j in range(i + 1, len(guided.doc_embeddings)):
+            folder_i = guided.doc_to_folder.get(str(i))
+            folder_j = guided.doc_to_folder.get(str(j))
+            if folder_i is not None and folder_j is not None:
+                folder_similarity = guided.get_folder_similarity(folder_i, folder_j)
+                if folder_similarity >= guided.semantic_similarity_threshold:
+                    distances[i, j] *= (1 - guided.folder_weight * folder_similarity)
+                else:
+                    distances[i, j] *= (1 + guided.folder_weight * (1 - folder_similarity) * 0.5)
+                distances[j, i] = distances[i, j]
+    return distances
+
+@pytest.mark.parametrize('tile_size', [1, 16, 53, 4096])
+def test_tiled_folder_distances_match_pairwise_loop(tile_size):
+    rng = np.random.default_rng(3)
+    folder_matrix = rng.normal(size=(5, 16))
+    # Two nearly identical folders, so that some folder pairs pass the similarity threshold
+    folder_matrix[1] = folder_matrix[0] + 0.05 * rng.normal(size=16)
+    docs = folder_matrix[rng.integers(0, 5, size=53)] + 0.8 * rng.normal(size=(53, 16))
+    folder_embeddings = {f'f{index}': row.tolist() for index, row in enumerate(folder_matrix)}
+    # Unassigned documents and a folder id without embedding
+    doc_to_folder_map = {str(index): f'f{index % 6}' for index in range(53) if index % 7}
+
+    guided = GuidedClustering(strategy='folder_similarity', tile_size=tile_size)
+    guided.prepare_data(docs.tolist(), folder_embeddings, doc_to_folder_map)
+    reference = reference_folder_similarity_distances(guided)
+    assert np.count_nonzero(guided.similar_folders & ~np.eye(5, dtype=bool))
+
+    distances = guided.compute_distances()
+    np.testing.assert_allclose(distances, reference, rtol=1e-5, atol=1e-6)
+    np.testing.assert_array_equal(distances, distances.T)
+    np.testing.assert_allclose(np.diag(distances), 0, atol=1e-6)
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+@pytest.mark.parametrize('start_index', [0, 7])
+def test_vectorized_folder_features_match_nested_loops(dtype, start_index):
+    rng = np.random.default_rng(5)
+    folder_matrix = normalize(rng.normal(size=(12, 16))).astype(dtype)
+    # Documents near the folders, so that many similarities pass the threshold
+    docs = folder_matrix[rng.integers(0, 12, size=300)] + 0.6 * rng.normal(size=(300, 16))
+    normalized_docs = normalize(docs).astype(dtype)
+    folder_ids = [str(100 + index) for index in range(12)]
+    # Includes indices before start_index and beyond the last row, which must be skipped
+    doc_to_folder_map = {str(index): folder_ids[index % 12] for index in range(0, 320, 3)}
+    config = {'anchorInfluence': 0.36, 'semanticThreshold': 0.52}
+    similarities = cosine_similarities(normalized_docs, folder_matrix)
+
+    affinities = sparse_affinities(similarities, folder_ids, config['semanticThreshold'], start_index)
+    expected = reference_affinities(similarities, folder_ids, config['semanticThreshold'], start_index)
+    assert json.dumps(affinities) == json.dumps(expected)
+    assert len(expected) > 100
+
+    features = _anchor_features(normalized_docs, similarities, folder_ids, doc_to_folder_map, config, start_index)
+    reference = reference_anchor_features(normalized_docs, similarities, folder_ids, doc_to_folder_map, config,
+                                          start_index)
+    assert features.dtype == reference.dtype
+    assert np.array_equal(features, reference)
+
+def test_incremental_clustering_refits_then_assigns(model_dir):
+    config = {'incremental': True, 'userId': 1, 'modelDir': model_dir, 'minClusterSize': 3}
+    corpus = make_corpus(80)
+
+    first = run_clustering(corpus, config)
+    assert first['clustering_stats']['mode'] == 'refit'
+    assert len(first['labels']) == 80
+
+    grown = make_corpus(90)
+    second = run_clustering(grown, config)
+    assert second['clustering_stats']['mode'] == 'incremental'
+    assert second['clustering_stats']['assigned_documents'] == 10
+    assert second['labels'][:80] == first['labels']
+
+def test_incremental_results_are_aligned_with_previous_labels(model_dir):
+    config = {'incremental': True, 'userId': 1, 'modelDir': model_dir, 'minClusterSize': 3}
+    first = run_clustering(make_corpus(80), config)
+    # Renumber the clusters as a previous run might have: the alignment has to undo it
+    renumbered = [label + 10 if label >= 0 else label for label in first['labels']]
+
+    second = run_clustering(make_corpus(90), {**config, 'previousLabels': renumbered + [None] * 10,
+                                              'labelDelta': True})
+    assert second['clustering_stats']['mode'] == 'incremental'
+    assert 'labels' not in second
+    assert second['label_changes']['rows'] == list(range(80, 90))
+    assert all(label >= 10 for label in second['label_changes']['labels'])
+
+def test_cache_hit_does_not_leave_stale_user_state(model_dir, tmp_path):
+    config = {'userId': 1, 'persistState': True, 'modelDir': model_dir, 'minClusterSize': 3,
+              'cache': True, 'cacheDir': str(tmp_path / 'cache')}
+    full, reduced = make_corpus(400, file_ids=True), make_corpus(380, file_ids=True)
+
+    run_clustering(full, config)
+    run_clustering(reduced, config)
+    # Same input as the first run, but the stored tree and summary now describe the 380 documents
+    third = run_clustering(full, config)
+    assert third['clustering_stats']['cache_hit'] is False
+    assert load_user_model(config, 'cluster_summary.pkl')['doc_count'] == 400
+    recut = run_recut({}, {'userId': 1, 'modelDir': model_dir})
+    assert recut['file_ids'] == full['file_ids']
+    assert recut['labels'] == third['labels']
+
+    # Now the stored state belongs to this input and the cached result can be returned
+    fourth = run_clustering(full, config)
+    assert fourth['clustering_stats']['cache_hit'] is True
+    assert fourth['labels'] == third['labels']
+
+def stored_state(config):
+    """What identifies the persisted tree, cluster summary, reducer and k-NN graph of a user."""
+    return (
+        load_user_model(config, 'linkage_tree.pkl')['corpus_key'],
+        load_user_model(config, 'cluster_summary.pkl')['corpus_key'],
+        load_user_model(config, 'reducer.pkl')['fitted_count'],
+        load_user_model(config, 'knn_graph.pkl')['count']
+    )
+
+def test_clustering_without_persist_state_keeps_user_state(model_dir):
+    config = {'userId': 1, 'modelDir': model_dir, 'minClusterSize': 3, 'reduction': 'pca', 'reductionDim': 8,
+              'knnGraph': True}
+    run_clustering(make_corpus(200, file_ids=True), {**config, 'persistState': True})
+    before = stored_state(config)
+
+    # E.g. the search clustering of a query and its hits
+    run_clustering(make_corpus(12, seed=3), config)
+
+    assert stored_state(config) == before
+    assert len(run_recut({}, config)['labels']) == 200
+
+def test_assign_reports_labels_of_the_corpus_clustering(model_dir, tmp_path):
+    config = {'userId': 1, 'modelDir': model_dir, 'minClusterSize': 3, 'cache': True,
+              'cacheDir': str(tmp_path / 'cache')}
+    corpus = make_corpus(120, file_ids=True)
+    first = run_clustering(corpus, {**config, 'persistState': True})
+    # The upload path aligns with the labels stored so far, here renumbered by 10
+    renumbered = [label + 10 if label >= 0 else label for label in first['labels']]
+    run_clustering(corpus, {**config, 'persistState': True, 'previousLabels': renumbered})
+
+    # Search clusterings, a fresh one and a cache hit, must not replace the summary
+    search = make_corpus(12, seed=3)
+    run_clustering(search, config)
+    assert run_clustering(search, config)['clustering_stats']['cache_hit'] is True
+
+    result = run_assign({'doc_embeddings': corpus['doc_embeddings'][:1]}, config)
+    assert result['label'] == renumbered[0]
+    assert set(result['exemplars']) <= set(corpus['file_ids'])
+    assert result['clustering_stats']['corpus_key'] == load_user_model(config, 'linkage_tree.pkl')['corpus_key']
+
+def test_assign_accepts_incremental_summaries_only_with_corpus_key(model_dir):
+    config = {'incremental': True, 'userId': 1, 'persistState': True, 'modelDir': model_dir, 'minClusterSize': 3}
+    corpus = make_corpus(80)
+    first = run_clustering(corpus, config)
+    assert run_assign({'doc_embeddings': corpus['doc_embeddings'][:1]}, config)['label'] == first['labels'][0]
+
+    # A summary written without corpus key may stem from a search clustering
+    summary = load_user_model(config, 'cluster_summary.pkl')
+    del summary['corpus_key']
+    save_user_model(config, 'cluster_summary.pkl', summary)
+    with pytest.raises(ValueError, match='persistState'):
+        run_assign({'doc_embeddings': corpus['doc_embeddings'][:1]}, config)
+
+def test_cache_ignores_result_neutral_options(tmp_path):
+    config = {'minClusterSize': 3, 'cache': True, 'cacheDir': str(tmp_path / 'cache')}
+    corpus = make_corpus(120)
+    first = run_clustering(corpus, config)
+    assert first['clustering_stats']['cache_hit'] is False
+
+    timed = run_clustering(corpus, {**config, 'timings': True, 'traceMemory': True})
+    assert timed['clustering_stats']['cache_hit'] is True
+    assert 'timings' in timed['clustering_stats']
+    assert timed['labels'] == first['labels']
+
+    # The entry has no cluster summary yet, the one with summary serves both requests afterwards
+    summarized = run_clustering(corpus, {**config, 'clusterSummary': True, 'exemplarCount': 2})
+    assert summarized['clustering_stats']['cache_hit'] is False
+    again = run_clustering(corpus, {**config, 'clusterSummary': True, 'exemplarCount': 2})
+    assert again['clustering_stats']['cache_hit'] is True
+    assert again['cluster_summary'] == summarized['cluster_summary']
+    assert run_clustering(corpus, {**config, 'clusterSummary': True})['clustering_stats']['cache_hit'] is False
+    plain = run_clustering(corpus, config)
+    assert plain['clustering_stats']['cache_hit'] is True
+    assert 'cluster_summary' not in plain
+
+def test_results_with_reused_reducer_are_not_cached(model_dir, tmp_path):
+    config = {'userId': 1, 'persistState': True, 'modelDir': model_dir, 'minClusterSize': 3, 'reduction': 'pca',
+              'reductionDim': 8, 'cache': True, 'cacheDir': str(tmp_path / 'cache')}
+    run_clustering(make_corpus(200, seed=1), config)
+    # The reducer fitted on the first corpus is reused for the second one
+    second = run_clustering(make_corpus(200), config)
+    assert second['clustering_stats']['reduction']['reused'] is True
+
+    # A run without user state fits its own reducer and must not get the result of the one above
+    fresh = run_clustering(make_corpus(200), {**config, 'persistState': False})
+    assert fresh['clustering_stats']['cache_hit'] is False
+    assert fresh['clustering_stats']['reduction']['reused'] is False
+
+@pytest.mark.parametrize('label_delta', [False, True])
+def test_alignment_of_an_all_noise_result(label_delta):
+    rng = np.random.default_rng(0)
+    config = {'minClusterSize': 8, 'previousLabels': [0] * 10, 'labelDelta': label_delta}
+    result = run_clustering({'doc_embeddings': rng.normal(size=(10, 8)).tolist()}, config)
+    assert result['label_changes'] == {'rows': list(range(10)), 'labels': [-1] * 10}
+    assert result['clustering_stats']['matched_clusters'] == 0
+
+@pytest.mark.parametrize('config', [
+    {'minClusterSize': 5},
+    {'minClusterSize': 4, 'minSamples': 3, 'clusterSelectionMethod': 'leaf', 'clusterSelectionEpsilon': 0.0},
+])
+def test_fit_matches_hdbscan_and_stored_tree(config):
+    rng = np.random.default_rng(11)
+    features = np.vstack([center + 0.3 * rng.normal(size=(40, 6)) for center in 3 * rng.normal(size=(4, 6))])
+    features = np.vstack([features, 4 * rng.normal(size=(15, 6))])
+
+    labels, probabilities, single_linkage_tree = fit_hdbscan(features, config)
+    reference = make_clusterer(config).fit(features)
+    np.testing.assert_array_equal(labels, reference.labels_)
+    np.testing.assert_allclose(probabilities, reference.probabilities_)
+
+    # recut selects from the stored tree with the same parameters
+    recut_labels, recut_probabilities, _ = select_clusters(single_linkage_tree, config)
+    np.testing.assert_array_equal(recut_labels, labels)
+    np.testing.assert_allclose(recut_probabilities, probabilities)
+
+def test_recut_is_aligned_and_keeps_assign_in_sync(model_dir):
+    rng = np.random.default_rng(2)
+    # Two groups of two clusters each: a larger minClusterSize merges every pair
+    groups = 3 * rng.normal(size=(2, 16))
+    centers = np.vstack([group + 0.8 * rng.normal(size=(2, 16)) for group in groups])
+    docs = np.vstack([center + 0.1 * rng.normal(size=(30, 16)) for center in centers])
+    corpus = {'doc_embeddings': docs.tolist(), 'file_ids': list(range(1000, 1120))}
+    config = {'userId': 1, 'modelDir': model_dir}
+
+    # The labels stored so far are numbered from 10 on
+    first = run_clustering(corpus, {**config, 'persistState': True, 'minClusterSize': 5,
+                                    'previousLabels': [row // 30 + 10 for row in range(120)]})
+    stored = dict(zip(corpus['file_ids'], first['labels']))
+    assert sorted(set(stored.values())) == [10, 11, 12, 13]
+
+    recut = run_recut({}, {**config, 'minClusterSize': 35, 'labelDelta': True,
+                           'previousLabels': {str(file_id): label for file_id, label in stored.items()}})
+    changes = recut['label_changes']
+    assert 'labels' not in recut
+    # Each merged cluster keeps the label of one of its halves, only the other half changes
+    assert len(changes['rows']) == 60
+    stored.update(zip(changes['file_ids'], changes['labels']))
+    assert len(set(stored.values())) == 2
+
+    for row in range(0, 120, 15):
+        assigned = run_assign({'doc_embeddings': corpus['doc_embeddings'][row:row + 1]}, config)
+        assert assigned['label'] == stored[corpus['file_ids'][row]]
+
+def test_incremental_runs_save_only_their_progress(model_dir):
+    config = {'incremental': True, 'userId': 1, 'modelDir': model_dir, 'minClusterSize': 3}
+    first = run_clustering(make_corpus(80), config)
+    fitted = user_model_path(config, 'clusterer.pkl')
+    fitted_mtime = os.stat(fitted).st_mtime_ns
+
+    run_clustering(make_corpus(85), config)
+    third = run_clustering(make_corpus(90), config)
+    assert os.stat(fitted).st_mtime_ns == fitted_mtime
+    # The third run continues from the progress of the second one
+    assert third['clustering_stats']['mode'] == 'incremental'
+    assert third['clustering_stats']['assigned_documents'] == 5
+    assert third['labels'][:80] == first['labels']
+
+def test_changed_folder_embeddings_trigger_a_refit(model_dir):
+    config = {'incremental': True, 'userId': 1, 'modelDir': model_dir, 'minClusterSize': 3}
+    rng = np.random.default_rng(4)
+    corpus = make_corpus(80)
+    folders = {'7': rng.normal(size=32).tolist(), '8': rng.normal(size=32).tolist()}
+    run_clustering({**corpus, 'folder_embeddings': folders}, config)
+
+    grown = make_corpus(85)
+    same = run_clustering({**grown, 'folder_embeddings': folders}, config)
+    assert same['clustering_stats']['mode'] == 'incremental'
+
+    moved = {**folders, '8': rng.normal(size=32).tolist()}
+    changed = run_clustering({**make_corpus(90), 'folder_embeddings': moved}, config)
+    assert changed['clustering_stats']['mode'] == 'refit'
+    assert changed['clustering_stats']['refit_reason'] == 'folders changed'
+
+def test_extended_knn_graph_matches_a_fresh_search(model_dir, capsys):
+    config = {'userId': 1, 'modelDir': model_dir, 'persistState': True}
+    features = as_features(np.random.default_rng(5).normal(size=(230, 16)))
+    user_knn_graph(features[:170], config, 8)
+    indices, distances = user_knn_graph(features, config, 8)
+    assert 'Extending k-NN graph from 170 to 230 documents' in capsys.readouterr().err
+
+    fresh_indices, fresh_distances = knn_search(features, features, 8)
+    np.testing.assert_array_equal(indices, fresh_indices)
+    np.testing.assert_allclose(distances, fresh_distances, rtol=1e-5, atol=1e-5)
+    # A changed prefix is searched from scratch
+    moved = features.copy()
+    moved[0] += 1
+    user_knn_graph(moved, config, 8)
+    assert 'Extending' not in capsys.readouterr().err
+
+def test_knn_spanning_tree_links_disconnected_components():
+    rng = np.random.default_rng(6)
+    groups = np.repeat(np.arange(3), 40)
+    features = as_features(10 * rng.normal(size=(3, 8))[groups] + 0.1 * rng.normal(size=(120, 8)))
+    indices, distances = knn_search(features, features, 5)
+    core_distances = distances[:, 4].astype(np.float64)
+    edges = knn_spanning_tree(features, indices, distances, core_distances)
+
+    assert len(edges) == len(features) - 1
+    assert np.all(np.diff(edges[:, 2]) >= 0)
+    a, b = edges[:, 0].astype(int), edges[:, 1].astype(int)
+    tree = coo_matrix((np.ones(len(edges)), (a, b)), shape=(120, 120))
+    assert connected_components(tree, directed=False)[0] == 1
+    # The k-NN edges stay inside the groups; exactly two links join them, as the last merges
+    links = groups[a] != groups[b]
+    assert links.sum() == 2 and links[-2:].all()
+    assert edges[-2, 2] > edges[:-2, 2].max()
+    assert np.all(edges[-2:, 2] >= cdist(features[a[-2:]], features[b[-2:]]).diagonal() - 1e-6)
+
+def test_knn_graph_labels_match_the_exact_tree_on_separated_data():
+    features = as_features(make_corpus(400, centers=5)['doc_embeddings'])
+    config = {'minClusterSize': 10}
+    exact_labels, exact_probabilities, _ = fit_hdbscan(features, config)
+    knn_labels, knn_probabilities, _ = fit_hdbscan(features, {**config, 'knnGraph': True})
+
+    assert len(set(exact_labels)) == 5
+    assert adjusted_rand_score(exact_labels, knn_labels) == 1.0
+    np.testing.assert_array_equal(exact_labels < 0, knn_labels < 0)
+
+@pytest.mark.parametrize('seed,min_cluster_size,single', [(0, 5, False), (1, 15, False), (3, 15, False), (0, 5, True)])
+def test_relative_validity_matches_hdbscan(seed, min_cluster_size, single):
+    rng = np.random.default_rng(seed)
+    docs = np.array(make_corpus(200, dim=8, centers=1 if single else 3, seed=seed)['doc_embeddings'])
+    features = np.concatenate([docs, rng.uniform(-3, 3, size=(30, 8))])
+    clusterer = hdbscan.HDBSCAN(min_cluster_size=min_cluster_size, gen_min_span_tree=True,
+                                allow_single_cluster=single).fit(features)
+
+    validity = relative_validity(clusterer.labels_, clusterer.minimum_spanning_tree_.to_numpy())
+    assert validity == pytest.approx(clusterer.relative_validity_, rel=1e-9)
+
+def expand_like_node(result):
+    """The reads of expandCompactResult in modelClustering.js: readInt32LE and byte / scale at the given offsets."""
+    compact = result['compact_output']
+    with open(compact['path'], 'rb') as f:
+        data = f.read()
+    labels = [struct.unpack_from('<i', data, compact['labels_offset'] + 4 * i)[0] for i in range(compact['count'])]
+    probabilities = [data[compact['probabilities_offset'] + i] / compact['probability_scale'] for i in range(compact['count'])]
+    return data, labels, probabilities
+
+@pytest.mark.parametrize('labels,probabilities', [
+    ([0, -1, 2, 2**31 - 1, -2**31, 1], [1.0, 0.0, 0.5, 0.996, 1e-9, 0.25]),
+    ([-1] * 7, [0.0] * 7),
+    ([], [])
+])
+def test_compact_result_round_trip(tmp_path, labels, probabilities):
+    result = {'labels': labels, 'probabilities': probabilities, 'clustering_stats': {'documents': len(labels)}}
+    compact = write_compact_result(result, tmp_path / 'result.bin')
+    assert 'labels' not in compact and 'probabilities' not in compact
+    assert compact['clustering_stats'] == result['clustering_stats']
+    json.dumps(compact)
+
+    read_labels, read_probabilities = read_compact_result(compact['compact_output']['path'])
+    assert read_labels.dtype == np.int32 and read_labels.tolist() == labels
+    np.testing.assert_allclose(read_probabilities, probabilities, atol=0.5 / PROBABILITY_SCALE)
+
+    data, node_labels, node_probabilities = expand_like_node(compact)
+    assert len(data) == compact['compact_output']['probabilities_offset'] + len(labels)
+    assert node_labels == labels
+    assert node_probabilities == read_probabilities.tolist()
+
+def test_compact_output_of_a_clustering_run(tmp_path):
+    corpus = make_corpus(60)
+    config = {'minClusterSize': 3}
+    full = run_clustering(corpus, config)
+    compact = run_clustering(corpus, {**config, 'compactOutput': str(tmp_path / 'result.bin')})
+
+    labels, probabilities = read_compact_result(compact['compact_output']['path'])
+    assert labels.tolist() == full['labels']
+    np.testing.assert_allclose(probabilities, full['probabilities'], atol=0.5 / PROBABILITY_SCALE)
+
+def run_batch(tmp_path, *args):
+    """Run `cluster.py batch` as the Node job does and return (exit code, records by user id)."""
+    config_path = tmp_path / 'batch_config.json'
+    config_path.write_text(json.dumps({'minClusterSize': 3, 'labelDelta': True, 'modelDir': str(tmp_path / 'models')}))
+    models = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    completed = subprocess.run(
+        [sys.executable, os.path.join(models, 'cluster.py'), 'batch', str(config_path), *args],
+        capture_output=True, text=True, timeout=120
+    )
+    records = [json.loads(line) for line in completed.stdout.splitlines() if line.strip()]
+    return completed.returncode, {record['userId']: record for record in records}
+
+def test_batch_clusters_every_user_separately(tmp_path):
+    inputs = tmp_path / 'inputs'
+    inputs.mkdir()
+    corpora = {1: make_corpus(60, seed=1, file_ids=True), 2: make_corpus(90, centers=3, seed=2, file_ids=True)}
+    for user_id, corpus in corpora.items():
+        (inputs / f'user_{user_id}.json').write_text(json.dumps(corpus))
+    (inputs / 'notes.txt').write_text('not an input')
+
+    code, records = run_batch(tmp_path, '--input-dir', str(inputs), '--workers', '2')
+    assert code == 0
+    assert sorted(records) == [1, 2]
+    for user_id, corpus in corpora.items():
+        record = records[user_id]
+        assert record['status'] == 'ok'
+        # Without stored labels every row is a change, with the file ids runBatchClustering writes
+        expected = run_clustering(corpus, {'minClusterSize': 3, 'labelDelta': True})
+        changes = record['result']['label_changes']
+        assert changes == expected['label_changes']
+        assert changes['file_ids'] == corpus['file_ids']
+        # Each user's state is persisted under its own id
+        config = {'userId': user_id, 'modelDir': str(tmp_path / 'models')}
+        assert load_user_model(config, 'linkage_tree.pkl')['file_ids'] == corpus['file_ids']
+
+    # A failing user is reported without stopping the others
+    (inputs / 'user_3.json').write_text('{"doc_embeddings": [[1, 2], [3]]}')
+    code, records = run_batch(tmp_path, '--input-dir', str(inputs), '--users', '2', '3', '--workers', '2')
+    assert code == 1
+    assert records[2]['status'] == 'ok' and records[3]['status'] == 'error'
+    assert 1 not in records
@@ -0,0 +1,213 @@
+"""
+Tests für den Server-Modus von backend/models/cluster.py (Framing, Scheduler).
+
+@author Lennart
+"""
+
+import json
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+import cluster
+import pg_embedding_reader
+from cluster import FRAME_HEADER, read_frame, serve_stream
+
+def frame(request):
+    payload = json.dumps(request).encode('utf-8')
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+@pytest.fixture
+def connection():
+    """A client socket connected to serve_stream running in a thread."""
+    client, server = socket.socketpair()
+    executor = ThreadPoolExecutor(max_workers=4)
+    thread = threading.Thread(
+        target=serve_stream, args=(executor, server.makefile('rb'), server.makefile('wb')), daemon=True
+    )
+    thread.start()
+    yield client, thread
+    client.close()
+    thread.join(5)
+    executor.shutdown()
+    server.close()
+
+def test_framing_partial_frames_and_completion_order(connection, monkeypatch):
+    client, thread = connection
+    released = threading.Event()
+
+    def wait(embeddings_data, config, timer):
+        assert released.wait(5)
+        return {'mode': 'wait'}
+
+    def release(embeddings_data, config, timer):
+        released.set()
+        return {'mode': 'release'}
+
+    monkeypatch.setitem(cluster.REQUEST_HANDLERS, 'wait', wait)
+    monkeypatch.setitem(cluster.REQUEST_HANDLERS, 'release', release)
+    monkeypatch.setitem(cluster.REQUEST_HANDLERS, 'unencodable', lambda *args: {'value': object()})
+
+    # The first frame arrives byte by byte, split inside the header and the payload
+    for byte in frame({'id': 1, 'mode': 'wait'}):
+        client.sendall(bytes([byte]))
+        time.sleep(0.001)
+    client.sendall(frame({'id': 2, 'mode': 'no-such-mode'}) + frame({'id': 3, 'mode': 'unencodable'}))
+    time.sleep(0.05)
+    client.sendall(frame({'id': 4, 'mode': 'release'}))
+    client.shutdown(socket.SHUT_WR)
+
+    client.settimeout(5)
+    responses = client.makefile('rb')
+    received = [json.loads(read_frame(responses)) for _ in range(4)]
+    thread.join(5)
+    assert not thread.is_alive()
+
+    by_id = {response['id']: response for response in received}
+    assert "Unknown request mode 'no-such-mode'" in by_id[2]['error']
+    assert 'not JSON serializable' in by_id[3]['error']
+    assert by_id[4]['mode'] == 'release'
+    # The blocked request is answered last, after the one that released it
+    assert received[-1] == {'id': 1, 'mode': 'wait'}
+
+def test_connection_closed_inside_a_frame(connection):
+    client, thread = connection
+    client.sendall(frame({'id': 1, 'mode': 'status'})[:6])
+    client.shutdown(socket.SHUT_WR)
+    thread.join(5)
+    assert not thread.is_alive()
+
+class FakeClock:
+    """Replaces time.monotonic and threading.Timer of ClusteringScheduler; timers fire in advance()."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.timers = []
+
+    def __call__(self):
+        return self.now
+
+    def timer(self, interval, function, args):
+        return FakeTimer(self, self.now + interval, function, args)
+
+    def advance(self, seconds):
+        """Move the clock and fire the due timers; returns the futures of the jobs they submitted."""
+        self.now += seconds
+        due = sorted((timer for timer in self.timers if timer.due <= self.now), key=lambda timer: timer.due)
+        self.timers = [timer for timer in self.timers if timer.due > self.now]
+        return [timer.function(*timer.args) for timer in due if not timer.cancelled]
+
+class FakeTimer:
+    def __init__(self, clock, due, function, args):
+        self.clock, self.due, self.function, self.args = clock, due, function, args
+        self.cancelled = False
+        self.daemon = False
+
+    def start(self):
+        self.clock.timers.append(self)
+
+    def cancel(self):
+        self.cancelled = True
+
+@pytest.fixture
+def jobs(monkeypatch):
+    """
+    A scheduler on a fake clock (debounce 2 s, max delay 5 s). Its jobs record their configs in runs,
+    wait for gate and record the label writes in written.
+    """
+    clock = FakeClock()
+    jobs = SimpleNamespace(
+        clock=clock, runs=[], written=[], gate=threading.Event(),
+        scheduler=cluster.ClusteringScheduler(debounce=2.0, max_delay=5.0, clock=clock, timer=clock.timer)
+    )
+    jobs.gate.set()
+
+    def run_clustering(embeddings_data, config):
+        jobs.runs.append(config)
+        assert jobs.gate.wait(5)
+        if config.get('fail'):
+            raise ValueError('database unavailable')
+        return {'label_changes': {'rows': [0], 'labels': [len(jobs.runs)], 'file_ids': [1000]}}
+
+    monkeypatch.setattr(cluster, 'run_clustering', run_clustering)
+    monkeypatch.setattr(pg_embedding_reader, 'write_cluster_labels', lambda *args: jobs.written.append(args))
+    yield jobs
+    jobs.scheduler.executor.shutdown()
+
+def user_config(model_dir, **options):
+    return {'userId': 7, 'modelDir': model_dir, **options}
+
+def test_scheduler_coalesces_requests_within_the_debounce(jobs, model_dir):
+    clock, scheduler = jobs.clock, jobs.scheduler
+    for step in range(3):
+        response = scheduler.submit({}, user_config(model_dir, minClusterSize=step + 2))
+        assert response == {'generation': step + 1, 'state': 'waiting'}
+        assert clock.advance(1.5) == []
+
+    # Debounced from the newest request: 2 s after t = 3
+    assert clock.advance(0.4) == []
+    [job] = clock.advance(0.1)
+    job.result(5)
+
+    assert len(jobs.runs) == 1
+    run = jobs.runs[0]
+    assert run['minClusterSize'] == 4
+    assert (run['source'], run['labelDelta'], run['persistState']) == ('database', True, True)
+    assert jobs.written == [(7, [1000], [1], None)]
+    status = scheduler.status({}, user_config(model_dir))
+    assert status['state'] == 'idle' and status['generation'] == 3
+    assert status['latest']['coalesced_requests'] == 3
+
+def test_scheduler_runs_after_max_delay_under_steady_requests(jobs, model_dir):
+    clock, scheduler = jobs.clock, jobs.scheduler
+    fired = []
+    for _ in range(6):
+        scheduler.submit({}, user_config(model_dir))
+        fired += clock.advance(1.0)
+    # The debounce would postpone the job forever; max_delay fires it 5 s after the first request
+    assert len(fired) == 1 and clock.now == 6.0
+    fired[0].result(5)
+    assert scheduler.status({}, user_config(model_dir))['latest']['coalesced_requests'] == 5
+
+def test_scheduler_status_transitions(jobs, model_dir):
+    clock, scheduler = jobs.clock, jobs.scheduler
+    config = user_config(model_dir)
+    assert scheduler.status({}, config) == {'generation': 0, 'state': 'idle', 'latest': None}
+
+    scheduler.submit({}, config)
+    assert scheduler.status({}, config)['state'] == 'waiting'
+
+    jobs.gate.clear()
+    [first] = clock.advance(2.0)
+    while not jobs.runs:
+        time.sleep(0.001)
+    assert scheduler.status({}, config)['state'] == 'running'
+
+    # Requests during a run are coalesced into one follow-up run, armed when the running job ends
+    scheduler.submit({}, user_config(model_dir, fail=True))
+    assert scheduler.submit({}, user_config(model_dir, fail=True))['state'] == 'running'
+    assert clock.timers == []
+    jobs.gate.set()
+    first.result(5)
+
+    status = scheduler.status({}, config)
+    assert (status['state'], status['generation'], status['completed_generation']) == ('waiting', 3, 1)
+    assert status['latest']['status'] == 'ok'
+    assert scheduler.status({}, {**config, 'sinceGeneration': 1})['latest'] is None
+
+    [second] = clock.advance(2.0)
+    second.result(5)
+    status = scheduler.status({}, {**config, 'sinceGeneration': 1})
+    assert (status['state'], status['completed_generation']) == ('idle', 3)
+    assert status['latest']['status'] == 'error' and status['latest']['error'] == 'database unavailable'
+    assert status['latest']['coalesced_requests'] == 2
+
+    # A restarted server continues the published generations
+    restarted = cluster.ClusteringScheduler(clock=clock, timer=clock.timer)
+    assert restarted.status({}, config)['completed_generation'] == 3
+    assert restarted.submit({}, config)['generation'] == 4
+    restarted.executor.shutdown()
@@ -0,0 +1,199 @@
+"""
+Tests für backend/models/pdf_extractor.py.
+
+@author Lennart
+"""
+
+import io
+import json
+import os
+import struct
+import subprocess
+import sys
+
+import pytest
+from pdfminer.high_level import extract_text_to_fp
+from pdfminer.pdfinterp import PDFPageInterpreter
+from pdfminer.layout import LAParams
+
+from pdf_extractor import (REQUEST_HEADER, RESPONSE_HEADER, STATUS_ERROR, STATUS_OK, ExtractionPool, PageBudget,
+                           PageRangeJob, _serve_stream, estimate_tokens, extract_bytes_parallel, extract_text_from_bytes,
+                           extract_text_from_file, extract_text_parallel, iter_page_texts, page_ranges)
+
+EXTRACTOR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'pdf_extractor.py')
+
+def run_extractor(*args, stdin=b''):
+    completed = subprocess.run([sys.executable, EXTRACTOR, *args], input=stdin, capture_output=True, timeout=60)
+    assert completed.returncode == 0, completed.stderr.decode('utf-8')
+    return completed.stdout.decode('utf-8')
+
+def reference_text(path):
+    """pdfminer's own extract_text_to_fp with the extractor's layout parameters."""
+    output = io.StringIO()
+    with open(path, 'rb') as pdf_file:
+        extract_text_to_fp(pdf_file, output, laparams=LAParams(line_margin=0.5, word_margin=0.1))
+    return output.getvalue()
+
+def test_page_texts_join_to_the_whole_text(make_pdf):
+    path = make_pdf(6)
+    with open(path, 'rb') as pdf_file:
+        pages = list(iter_page_texts(pdf_file))
+
+    assert [index for index, _ in pages] == list(range(6))
+    assert all(text.endswith('\f') and f'Page {index + 1} line 20' in text for index, text in pages)
+    assert ''.join(text for _, text in pages) == reference_text(path) == extract_text_from_file(path)
+
+    with open(path, 'rb') as pdf_file:
+        assert [index for index, _ in iter_page_texts(pdf_file, page_numbers={1, 4})] == [1, 4]
+
+def test_ndjson_output_matches_the_buffered_output(make_pdf):
+    path = make_pdf(5)
+    whole = run_extractor('--file', path)
+    assert whole == reference_text(path)
+
+    with open(path, 'rb') as pdf_file:
+        pdf_bytes = pdf_file.read()
+    for output in (run_extractor('--file', path, '--ndjson'),
+                   run_extractor('--raw', '--ndjson', stdin=struct.pack('>I', len(pdf_bytes)) + pdf_bytes)):
+        records = [json.loads(line) for line in output.splitlines()]
+        assert [record['page'] for record in records] == [1, 2, 3, 4, 5]
+        assert all(record['chars'] == len(record['text']) for record in records)
+        assert [record['elapsed_ms'] for record in records] == sorted(record['elapsed_ms'] for record in records)
+        assert ''.join(record['text'] for record in records) == whole
+
+def test_page_parallel_extraction_equals_serial(make_pdf):
+    path = make_pdf(9)
+    with open(path, 'rb') as pdf_file:
+        pdf_bytes = pdf_file.read()
+    serial = extract_text_from_bytes(pdf_bytes)
+
+    assert page_ranges(9, 4) == [(0, 2), (2, 4), (4, 6), (6, 9)]
+    assert extract_text_parallel(path, 3, min_pages=2) == serial
+    assert extract_bytes_parallel(pdf_bytes, 2, min_pages=2) == serial
+    # Below min_pages the document is extracted in this process
+    assert extract_bytes_parallel(pdf_bytes, 2, min_pages=10) == serial
+
+def read_responses(frames):
+    responses = {}
+    for frame in frames:
+        request_id, status, length = RESPONSE_HEADER.unpack_from(frame)
+        assert len(frame) == RESPONSE_HEADER.size + length
+        responses[request_id] = (status, frame[RESPONSE_HEADER.size:].decode('utf-8'))
+    return responses
+
+def test_extraction_pool_splits_large_documents_and_reports_errors(make_pdf):
+    documents = {}
+    for request_id, pages in ((1, 8), (2, 2)):
+        with open(make_pdf(pages), 'rb') as pdf_file:
+            documents[request_id] = pdf_file.read()
+    documents[3] = b'%PDF-1.4\nnot a document'
+
+    pool = ExtractionPool(workers=2, max_documents=1, parallel_min_pages=4)
+    frames = []
+    try:
+        jobs = [pool.submit(request_id, pdf_bytes, frames.append) for request_id, pdf_bytes in documents.items()]
+        assert isinstance(jobs[0], PageRangeJob) and not isinstance(jobs[1], PageRangeJob)
+        # Both kinds of job respond before they are marked as done
+        for job in jobs:
+            job.wait()
+        pool.close()
+    finally:
+        pool.pool.terminate()
+
+    responses = read_responses(frames)
+    assert responses[1] == (STATUS_OK, extract_text_from_bytes(documents[1]))
+    assert responses[2] == (STATUS_OK, extract_text_from_bytes(documents[2]))
+    assert responses[3][0] == STATUS_ERROR and responses[3][1]
+    assert not os.path.exists(jobs[0].path)
+
+def test_page_range_job_reports_the_first_error_once(tmp_path):
+    shared = tmp_path / 'shared.pdf'
+    shared.write_bytes(b'%PDF')
+    successes, errors = [], []
+    job = PageRangeJob(str(shared), 3, successes.append, errors.append)
+
+    job.range_finished(0, text='first\f')
+    job.range_finished(None, error=ValueError('broken page'))
+    assert not job.ready() and shared.exists()
+    job.range_finished(None, error=ValueError('second error'))
+
+    assert job.ready()
+    assert [str(error) for error in errors] == ['broken page'] and successes == []
+    assert not shared.exists()
+
+def test_serve_stream_answers_pipelined_requests(make_pdf):
+    with open(make_pdf(3), 'rb') as pdf_file:
+        pdf_bytes = pdf_file.read()
+    requests = b''.join(
+        REQUEST_HEADER.pack(request_id, len(payload)) + payload
+        for request_id, payload in ((7, pdf_bytes), (8, b'garbage'), (9, pdf_bytes))
+    )
+    output = io.BytesIO()
+    pool = ExtractionPool(workers=2, max_documents=0)
+    try:
+        # The last request is cut off: the stream stops, the complete ones are still answered
+        _serve_stream(pool, io.BytesIO(requests[:-10]), output)
+        pool.close()
+    finally:
+        pool.pool.terminate()
+
+    data = output.getvalue()
+    frames = []
+    while data:
+        _, _, length = RESPONSE_HEADER.unpack_from(data)
+        frames.append(data[:RESPONSE_HEADER.size + length])
+        data = data[RESPONSE_HEADER.size + length:]
+    responses = read_responses(frames)
+    assert sorted(responses) == [7, 8]
+    assert responses[7] == (STATUS_OK, extract_text_from_bytes(pdf_bytes))
+    assert responses[8][0] == STATUS_ERROR
+
+def expected_stop(page_texts, size, limit, extra_pages):
+    """Number of pages a budget keeps: up to the page on which size() of the text reaches limit, plus extra_pages."""
+    total = 0
+    for pages, text in enumerate(page_texts, start=1):
+        total += size(text)
+        if total >= limit:
+            return min(pages + extra_pages, len(page_texts))
+    return len(page_texts)
+
+@pytest.mark.parametrize('limit_name,size', [('max_chars', len), ('max_tokens', estimate_tokens)])
+@pytest.mark.parametrize('extra_pages', [0, 2])
+def test_budget_output_is_a_prefix_that_stops_at_the_limit(make_pdf, monkeypatch, limit_name, size, extra_pages):
+    path = make_pdf(8, lines_per_page=5)
+    with open(path, 'rb') as pdf_file:
+        page_texts = [text for _, text in iter_page_texts(pdf_file)]
+    full_text = ''.join(page_texts)
+    processed = []
+    process_page = PDFPageInterpreter.process_page
+    monkeypatch.setattr(PDFPageInterpreter, 'process_page',
+                        lambda interpreter, page: processed.append(page) or process_page(interpreter, page))
+
+    page_size = size(page_texts[0])
+    for limit in (1, page_size, page_size + 1, 3 * page_size + 5, size(full_text), size(full_text) + 1):
+        budget = PageBudget(**{limit_name: limit, 'extra_pages': extra_pages})
+        processed.clear()
+        text = extract_text_from_file(path, budget)
+
+        kept = expected_stop(page_texts, size, limit, extra_pages)
+        assert text == ''.join(page_texts[:kept]) and full_text.startswith(text)
+        # Pages after the budget are not laid out
+        assert len(processed) == budget.pages == kept
+        assert budget.truncated == (kept < len(page_texts))
+        reached = expected_stop(page_texts, size, limit, 0) if limit <= size(full_text) else None
+        assert budget.report()['budget_page'] == reached
+        assert budget.report()['chars'] == len(text)
+
+def test_budget_on_the_command_line(make_pdf):
+    path = make_pdf(6)
+    full_text = run_extractor('--file', path)
+    first_page = full_text.split('\f')[0] + '\f'
+
+    text = run_extractor('--file', path, '--max-chars', str(len(first_page) + 1), '--extra-pages', '1')
+    assert text == full_text[:3 * len(first_page)] and full_text.startswith(text)
+
+    records = [json.loads(line) for line in
+               run_extractor('--file', path, '--ndjson', '--max-chars', str(len(first_page))).splitlines()]
+    assert [record['page'] for record in records[:-1]] == [1]
+    assert records[-1] == {'summary': {'truncated': True, 'pages': 1, 'budget_page': 1,
+                                       'chars': len(first_page), 'tokens': None}}
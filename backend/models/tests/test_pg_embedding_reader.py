@@ -0,0 +1,70 @@
+"""
+Tests für backend/models/pg_embedding_reader.py (ohne Datenbank).
+
+@author Lennart
+"""
+
+import struct
+
+import numpy as np
+import pytest
+
+from pg_embedding_reader import COPY_SIGNATURE, INT32, CopyBinaryDecoder, decode_vector_into
+
+def copy_stream(rows, extension=b''):
+    """A binary COPY stream of rows of int4 / float4-vector / None fields, with trailer."""
+    parts = [COPY_SIGNATURE, struct.pack('>ii', 0, len(extension)), extension]
+    for row in rows:
+        parts.append(struct.pack('>h', len(row)))
+        for value in row:
+            if value is None:
+                parts.append(struct.pack('>i', -1))
+                continue
+            if isinstance(value, int):
+                data = INT32.pack(value)
+            else:
+                data = struct.pack('>hh', len(value), 0) + np.asarray(value, dtype='>f4').tobytes()
+            parts.append(struct.pack('>i', len(data)) + data)
+    parts.append(struct.pack('>h', -1))
+    return b''.join(parts)
+
+def decode(stream, chunk_sizes):
+    decoded = []
+
+    def on_row(fields):
+        file_id, folder_id, embedding = fields
+        vector = np.empty(4, dtype=np.float32)
+        decode_vector_into(embedding, vector)
+        decoded.append((INT32.unpack(file_id)[0], None if folder_id is None else INT32.unpack(folder_id)[0],
+                        vector.tolist()))
+
+    decoder = CopyBinaryDecoder(on_row)
+    offset = 0
+    for size in chunk_sizes:
+        decoder.feed(stream[offset:offset + size])
+        offset += size
+        if offset >= len(stream):
+            break
+    return decoder, decoded
+
+@pytest.mark.parametrize('seed', range(5))
+def test_decoder_handles_arbitrary_chunk_boundaries(seed):
+    rng = np.random.default_rng(seed)
+    rows = [(1000 + index, None if index % 3 else index, rng.normal(size=4).astype(np.float32).tolist())
+            for index in range(40)]
+    stream = copy_stream(rows, extension=b'ext!')
+    # Sizes from a single byte up to several tuples, so headers, fields and tuples span chunks
+    chunk_sizes = rng.integers(1, 120, size=len(stream))
+
+    decoder, decoded = decode(stream, chunk_sizes)
+    assert decoder.finished
+    assert decoded == [(file_id, folder_id, vector) for file_id, folder_id, vector in rows]
+    assert not decoder.buffer
+
+def test_decoder_waits_for_the_trailer_and_checks_the_signature():
+    stream = copy_stream([(1, None, [0.5, 0.0, 1.0, -1.0])])
+    decoder, decoded = decode(stream[:-2], [len(stream)])
+    assert len(decoded) == 1 and not decoder.finished
+
+    with pytest.raises(ValueError, match='signature'):
+        CopyBinaryDecoder(lambda fields: None).feed(b'NOTPGCOPY' + stream[9:])
@@ -12,6 +12,10 @@ const adminMiddleware = require('../models/modelAdmin');
 const User = require('../../database/User');
 const UserRoleMapping = require('../../database/UserRoleMapping');
 const bcrypt = require('bcrypt');
+const modelClustering = require('../models/modelClustering');
+
+// Laufender Batch-Job (höchstens einer gleichzeitig)
+let runningBatch = null;
 
 /**
  * Gibt eine Liste aller registrierten Benutzer zurück.
@@ -173,5 +177,40 @@ router.get('/admin-roles', adminMiddleware, async (req, res) => {
   }
 });
 
+/**
+ * Startet das Neu-Clustering aller (oder der angegebenen) Benutzer im Hintergrund, z.B. nach einem
+ * Modellwechsel. Die geänderten Labels werden pro Benutzer geschrieben, sobald sein Ergebnis vorliegt.
+ * 
+ * @async
+ * @function
+ * @route POST /clustering/batch
+ * @param {Object} req - Das Request-Objekt mit optional `body.userIds` und `body.config`.
+ * @param {Object} res - Das Response-Objekt.
+ * @returns {Promise<void>} 202, sobald der Job gestartet ist, bzw. 409, wenn bereits ein Job läuft.
+ */
+router.post('/clustering/batch', adminMiddleware, async (req, res) => {
+  if (runningBatch) {
+    return res.status(409).json({ message: 'Es läuft bereits ein Batch-Clustering.' });
+  }
+
+  const userIds = Array.isArray(req.body.userIds) ? req.body.userIds.map(Number) : [];
+  if (userIds.some((userId) => !Number.isInteger(userId))) {
+    return res.status(400).json({ message: 'Ungültige Benutzer-ID.' });
+  }
+
+  runningBatch = modelClustering.runBatchClustering(req.body.config || {}, userIds)
+    .then((summary) => {
+      console.log(`Batch-Clustering abgeschlossen: ${summary.succeeded.length} erfolgreich, ${summary.failed.length} fehlgeschlagen`);
+    })
+    .catch((error) => {
+      console.error('Fehler beim Batch-Clustering:', error);
+    })
+    .finally(() => {
+      runningBatch = null;
+    });
+
+  res.status(202).json({ message: 'Batch-Clustering gestartet.', userIds });
+});
+
 
 module.exports = router;
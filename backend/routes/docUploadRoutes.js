@@ -136,4 +136,30 @@ router.post('/folder-suggestions', docUploadController.getFolderSuggestions);
  */
 router.post('/assign-folder', docUploadController.assignFolder);
 
+/**
+ * Wählt die Cluster mit neuen Parametern aus dem gespeicherten Clustering-Baum neu aus.
+ * 
+ * @async
+ * @function
+ * @route POST /recut-clusters
+ * @param {Object} req - Das Request-Objekt mit den Auswahlparametern.
+ * @param {Object} res - Das Response-Objekt.
+ * @returns {Promise<void>} Antwort mit den neuen Clustering-Ergebnissen.
+ * @throws {Error} Falls kein gespeicherter Baum vorhanden ist.
+ */
+router.post('/recut-clusters', docUploadController.recutClusters);
+
+/**
+ * Liefert den Stand der eingeplanten Clusterings des Benutzers.
+ * 
+ * @async
+ * @function
+ * @route GET /clustering-status
+ * @param {Object} req - Das Request-Objekt, optional mit der zuletzt bekannten Generation in `query.since`.
+ * @param {Object} res - Das Response-Objekt.
+ * @returns {Promise<void>} Antwort mit dem Stand und ggf. dem neuesten Clustering-Ergebnis.
+ * @throws {Error} Falls der Clustering-Server nicht aktiviert ist.
+ */
+router.get('/clustering-status', docUploadController.clusteringStatus);
+
 module.exports = router;
@@ -0,0 +1,373 @@
+"""
+Benchmark für backend/models/cluster.py über verschiedene Korpusgrößen.
+Misst pro Fall die Laufzeit der einzelnen Pipeline-Phasen, die Gesamtlaufzeit und den
+maximalen Speicherverbrauch (Peak RSS) und schreibt die Ergebnisse als JSON, das sich
+zwischen Commits vergleichen lässt.
+
+Jeder Fall läuft in einem eigenen Python-Prozess, damit Peak RSS nicht von vorherigen
+Fällen beeinflusst wird.
+
+@author Lennart
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stderr
+from datetime import datetime, timezone
+
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+MODELS_DIR = os.path.join(BENCHMARK_DIR, '..', 'backend', 'models')
+
+# Same defaults as docUploadController.uploadFile
+DEFAULT_CONFIG = {
+    'minClusterSize': 3,
+    'minSamples': 2,
+    'clusterSelectionMethod': 'eom',
+    'clusterSelectionEpsilon': 0.18,
+    'anchorInfluence': 0.36,
+    'semanticThreshold': 0.52,
+}
+
+TARGETS = ('pipeline', 'pipeline_reduced', 'pipeline_knn', 'guided_folder_similarity', 'guided_enhanced_features')
+
+PRESETS = {
+    'quick': {'docs': [1000, 5000], 'folders': [10, 100]},
+    'full': {'docs': [1000, 10000, 50000, 100000], 'folders': [10, 500, 5000]},
+}
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB (ru_maxrss is in KB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def labels_digest(labels):
+    return hashlib.sha1(json.dumps([int(label) for label in labels]).encode('utf-8')).hexdigest()
+
+def run_pipeline(cluster, embeddings_data, config, phases):
+    """Run the main() pipeline and record the per-phase timings reported by cluster.PhaseTimer."""
+    timer = cluster.PhaseTimer()
+    result = cluster.run_clustering(embeddings_data, config, timer)
+    with timer.phase('serialize'):
+        json.dumps(result)
+    phases.update({name: ms / 1000 for name, ms in timer.timings.items()})
+    return np.asarray(result['labels'])
+
+def run_guided(cluster, embeddings_data, config, strategy, phases):
+    """Run GuidedClustering end to end with the given strategy."""
+    guided = cluster.GuidedClustering(
+        folder_weight=config['anchorInfluence'],
+        semantic_similarity_threshold=config['semanticThreshold'],
+        strategy=strategy
+    )
+    start = time.perf_counter()
+    guided.prepare_data(
+        embeddings_data['doc_embeddings'],
+        embeddings_data['folder_embeddings'],
+        embeddings_data['doc_to_folder_map']
+    )
+    phases['prepare_data'] = time.perf_counter() - start
+    start = time.perf_counter()
+    labels, _ = guided.fit_predict(config)
+    phases['distances_and_fit'] = time.perf_counter() - start
+    return labels
+
+def run_case(case):
+    """Execute one benchmark case in the current process and return its record."""
+    sys.path.insert(0, BENCHMARK_DIR)
+    sys.path.insert(0, MODELS_DIR)
+    from sklearn.metrics import adjusted_rand_score
+    from synthetic_data import generate_corpus
+    import cluster
+
+    start = time.perf_counter()
+    embeddings_data, topics = generate_corpus(
+        case['docs'], case['folders'], dim=case['dim'], seed=case['seed']
+    )
+    generate_time = time.perf_counter() - start
+
+    phases = {}
+    log = io.StringIO()
+    start = time.perf_counter()
+    with redirect_stderr(log):
+        if case['target'] == 'pipeline':
+            labels = run_pipeline(cluster, embeddings_data, case['config'], phases)
+        elif case['target'] == 'pipeline_reduced':
+            config = {**case['config'], 'reduction': case['reduction'], 'reductionDim': case['reduction_dim']}
+            labels = run_pipeline(cluster, embeddings_data, config, phases)
+        elif case['target'] == 'pipeline_knn':
+            config = {**case['config'], 'knnGraph': True}
+            labels = run_pipeline(cluster, embeddings_data, config, phases)
+        else:
+            strategy = case['target'][len('guided_'):]
+            labels = run_guided(cluster, embeddings_data, case['config'], strategy, phases)
+    wall_time = time.perf_counter() - start
+
+    record = {
+        'status': 'ok',
+        'generate_time_s': generate_time,
+        'wall_time_s': wall_time,
+        'phases': phases,
+        'peak_rss_mb': peak_rss_mb(),
+        'num_clusters': int(len(set(labels.tolist()) - {-1})),
+        'noise_points': int((labels == -1).sum()),
+        'labels_sha1': labels_digest(labels),
+        'ari_vs_topics': float(adjusted_rand_score(topics, labels)),
+    }
+    # Pipeline labels are always returned so the parent can compute the reduced/full agreement
+    if case.get('store_labels') or case['target'].startswith('pipeline'):
+        record['labels'] = labels.tolist()
+    return record
+
+def run_case_subprocess(case, timeout, verbose):
+    """Run a case in a fresh interpreter so peak RSS is measured per case."""
+    command = [sys.executable, os.path.abspath(__file__), 'case', json.dumps(case)]
+    try:
+        completed = subprocess.run(
+            command, capture_output=True, text=True, timeout=timeout
+        )
+    except subprocess.TimeoutExpired:
+        return {'status': 'timeout', 'timeout_s': timeout}
+
+    if verbose and completed.stderr:
+        print(completed.stderr, file=sys.stderr)
+    if completed.returncode != 0:
+        return {'status': 'failed', 'error': completed.stderr.strip().splitlines()[-1:]}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def environment_info():
+    """Versions and hardware facts needed to compare results across machines and commits."""
+    info = {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+    try:
+        info['commit'] = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=BENCHMARK_DIR, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        info['commit'] = None
+    for module in ('numpy', 'scipy', 'sklearn', 'hdbscan'):
+        try:
+            info[module] = __import__(module).__version__
+        except (ImportError, AttributeError):
+            info[module] = None
+    return info
+
+def add_reduction_agreement(cases):
+    """Adjusted Rand index between each reduced/k-NN run and the exact full-dimensional run of the same size."""
+    from sklearn.metrics import adjusted_rand_score
+
+    full_labels = {
+        (case['docs'], case['folders']): case['labels']
+        for case in cases if case['target'] == 'pipeline' and 'labels' in case
+    }
+    for case in cases:
+        reference = full_labels.get((case['docs'], case['folders']))
+        if case['target'] in ('pipeline_reduced', 'pipeline_knn') and 'labels' in case and reference is not None:
+            case['ari_vs_full'] = float(adjusted_rand_score(reference, case['labels']))
+
+def command_run(args):
+    config = {**DEFAULT_CONFIG, **json.loads(args.config)}
+    docs = args.docs or PRESETS[args.preset]['docs']
+    folders = args.folders or PRESETS[args.preset]['folders']
+
+    cases = []
+    for doc_count in docs:
+        for folder_count in folders:
+            for target in args.targets:
+                case = {
+                    'target': target,
+                    'docs': doc_count,
+                    'folders': folder_count,
+                    'dim': args.dim,
+                    'seed': args.seed,
+                    'config': config,
+                    'store_labels': args.store_labels,
+                }
+                if target == 'pipeline_reduced':
+                    case.update(reduction=args.reduction, reduction_dim=args.reduction_dim)
+                # The guided variants hold dense n x n distance matrices
+                if target.startswith('guided_') and doc_count > args.guided_max_docs:
+                    record = {'status': 'skipped', 'reason': f'more than {args.guided_max_docs} documents'}
+                else:
+                    print(f"[INFO] {target}: {doc_count} documents, {folder_count} folders", file=sys.stderr)
+                    record = run_case_subprocess(case, args.timeout, args.verbose)
+                case.pop('store_labels')
+                cases.append({**case, **record})
+                print(f"[INFO]   -> {record['status']} {record.get('wall_time_s', 0):.3f}s "
+                      f"{record.get('peak_rss_mb', 0):.0f} MB", file=sys.stderr)
+
+    add_reduction_agreement(cases)
+    if not args.store_labels:
+        for case in cases:
+            case.pop('labels', None)
+
+    report = {'environment': environment_info(), 'cases': cases}
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+def case_key(case):
+    return case['target'], case['docs'], case['folders']
+
+def command_compare(args):
+    """Print wall time and peak RSS ratios (new / baseline) for the cases present in both reports."""
+    with open(args.baseline) as f:
+        baseline = {case_key(case): case for case in json.load(f)['cases']}
+    with open(args.candidate) as f:
+        candidate = json.load(f)['cases']
+
+    print(f"{'target':<28}{'docs':>8}{'folders':>9}{'time':>10}{'ratio':>8}{'rss MB':>9}{'ratio':>8}  labels")
+    for case in candidate:
+        base = baseline.get(case_key(case))
+        if base is None or case['status'] != 'ok' or base['status'] != 'ok':
+            continue
+        time_ratio = case['wall_time_s'] / base['wall_time_s'] if base['wall_time_s'] else float('nan')
+        rss_ratio = case['peak_rss_mb'] / base['peak_rss_mb'] if base['peak_rss_mb'] else float('nan')
+        labels = 'same' if case['labels_sha1'] == base['labels_sha1'] else 'changed'
+        print(f"{case['target']:<28}{case['docs']:>8}{case['folders']:>9}"
+              f"{case['wall_time_s']:>10.3f}{time_ratio:>8.2f}"
+              f"{case['peak_rss_mb']:>9.0f}{rss_ratio:>8.2f}  {labels}")
+
+def command_assign(args):
+    """
+    Agreement of `cluster.py assign` with a full refit: cluster the first --docs documents with
+    a userId and persistState, assign --held-out further documents one by one, then refit on all documents and
+    compare. Refit clusters are mapped to the original labels by majority vote over the shared
+    documents, so agreement is the share of held-out documents whose assigned label equals the
+    mapped refit label (noise included).
+    """
+    sys.path.insert(0, BENCHMARK_DIR)
+    sys.path.insert(0, MODELS_DIR)
+    from synthetic_data import generate_corpus
+    import cluster
+
+    config = {**DEFAULT_CONFIG, **json.loads(args.config)}
+    total = args.docs + args.held_out
+    embeddings_data, _ = generate_corpus(total, args.folders, dim=args.dim, seed=args.seed)
+    doc_embeddings = embeddings_data['doc_embeddings']
+    doc_to_folder_map = embeddings_data['doc_to_folder_map']
+    initial = {
+        **embeddings_data,
+        'doc_embeddings': doc_embeddings[:args.docs],
+        'doc_to_folder_map': {key: value for key, value in doc_to_folder_map.items() if int(key) < args.docs}
+    }
+
+    log = io.StringIO()
+    with redirect_stderr(log), tempfile.TemporaryDirectory() as model_dir:
+        user_config = {**config, 'userId': 1, 'persistState': True, 'modelDir': model_dir}
+        start = time.perf_counter()
+        initial_labels = np.asarray(cluster.run_clustering(initial, user_config)['labels'])
+        fit_time = time.perf_counter() - start
+
+        assigned = []
+        latencies = []
+        for index in range(args.docs, total):
+            assign_config = {'userId': 1, 'modelDir': model_dir}
+            if str(index) in doc_to_folder_map:
+                assign_config['folderId'] = doc_to_folder_map[str(index)]
+            start = time.perf_counter()
+            result = cluster.run_assign({'doc_embeddings': doc_embeddings[index:index + 1]}, assign_config)
+            latencies.append((time.perf_counter() - start) * 1000)
+            assigned.append(result['label'])
+
+        start = time.perf_counter()
+        refit_labels = np.asarray(cluster.run_clustering(embeddings_data, config)['labels'])
+        refit_time = time.perf_counter() - start
+
+    # Map every refit cluster to the original label most of its shared documents had
+    mapping = {-1: -1}
+    shared = refit_labels[:args.docs]
+    for refit_label in np.unique(shared[shared >= 0]).tolist():
+        votes = initial_labels[:args.docs][shared == refit_label]
+        values, counts = np.unique(votes, return_counts=True)
+        mapping[refit_label] = int(values[np.argmax(counts)])
+    expected = np.array([mapping.get(int(label), -1) for label in refit_labels[args.docs:]])
+    assigned = np.array(assigned)
+
+    report = {
+        'environment': environment_info(),
+        'docs': args.docs,
+        'held_out': args.held_out,
+        'folders': args.folders,
+        'config': config,
+        'fit_time_s': fit_time,
+        'refit_time_s': refit_time,
+        'assign_ms': {
+            'median': float(np.median(latencies)),
+            'p95': float(np.percentile(latencies, 95)),
+            'max': float(np.max(latencies))
+        },
+        'agreement': float((assigned == expected).mean()),
+        'noise_assigned': int((assigned == -1).sum()),
+        'noise_refit': int((expected == -1).sum()),
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark cluster.py on synthetic corpora')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run the benchmark grid')
+    run_parser.add_argument('--preset', choices=sorted(PRESETS), default='quick')
+    run_parser.add_argument('--docs', type=int, nargs='+', help='Document counts (overrides the preset)')
+    run_parser.add_argument('--folders', type=int, nargs='+', help='Folder counts (overrides the preset)')
+    run_parser.add_argument('--targets', nargs='+', choices=TARGETS, default=list(TARGETS))
+    run_parser.add_argument('--dim', type=int, default=768)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--config', default='{}', help='JSON overrides for the clustering config')
+    run_parser.add_argument('--reduction', choices=['pca', 'svd', 'random_projection'], default='pca',
+                            help='Reduction method of the pipeline_reduced target')
+    run_parser.add_argument('--reduction-dim', type=int, default=32)
+    run_parser.add_argument('--guided-max-docs', type=int, default=10000)
+    run_parser.add_argument('--timeout', type=float, default=3600, help='Timeout per case in seconds')
+    run_parser.add_argument('--store-labels', action='store_true', help='Include all labels in the report')
+    run_parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+    run_parser.add_argument('--verbose', action='store_true', help='Forward cluster.py log output')
+    run_parser.set_defaults(func=command_run)
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two JSON reports')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.set_defaults(func=command_compare)
+
+    assign_parser = subparsers.add_parser('assign', help='Compare `cluster.py assign` with a full refit')
+    assign_parser.add_argument('--docs', type=int, default=5000, help='Documents of the initial clustering')
+    assign_parser.add_argument('--held-out', type=int, default=200, help='Documents assigned afterwards')
+    assign_parser.add_argument('--folders', type=int, default=50)
+    assign_parser.add_argument('--dim', type=int, default=768)
+    assign_parser.add_argument('--seed', type=int, default=0)
+    assign_parser.add_argument('--config', default='{}', help='JSON overrides for the clustering config')
+    assign_parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+    assign_parser.set_defaults(func=command_assign)
+
+    case_parser = subparsers.add_parser('case', help=argparse.SUPPRESS)
+    case_parser.add_argument('case')
+    case_parser.set_defaults(func=lambda args: print(json.dumps(run_case(json.loads(args.case)))))
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
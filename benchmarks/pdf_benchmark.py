@@ -0,0 +1,282 @@
+"""
+Benchmark für backend/models/pdf_extractor.py.
+Erzeugt synthetische PDFs ohne externe Abhängigkeiten und misst die Textextraktion.
+
+transport: maximaler Speicherverbrauch (Peak RSS) eines Skript-Aufrufs je Übergabeformat
+(Base64 auf stdin, --raw, --file) für ein großes PDF, dessen Größe im Wesentlichen aus
+einem Bild besteht.
+
+pages: Laufzeit der seitenparallelen Extraktion (--parallel N) gegenüber der sequentiellen
+für verschiedene Seitenzahlen und Worker-Anzahlen.
+
+stream: Zeit bis zur ersten Seite, Gesamtzeit und Peak RSS der seitenweisen NDJSON-Ausgabe (--ndjson)
+gegenüber der Ausgabe des ganzen Textes am Ende.
+
+budget: Laufzeit mit Embedding-Budget (--max-tokens/--max-chars, --extra-pages) gegenüber der
+vollständigen Extraktion.
+
+@author Lennart
+"""
+
+import argparse
+import base64
+import json
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+EXTRACTOR = os.path.join(BENCHMARK_DIR, '..', 'backend', 'models', 'pdf_extractor.py')
+
+def _text_content(lines):
+    operations = ['BT', '/F1 11 Tf', '14 TL', '72 760 Td']
+    for line in lines:
+        escaped = line.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+        operations.append(f'({escaped}) Tj T*')
+    operations.append('ET')
+    return '\n'.join(operations).encode('latin-1')
+
+def build_pdf(path, pages, lines_per_page=40, image_bytes=0, seed=0):
+    """
+    Write a PDF with `pages` text pages. With image_bytes > 0 the first page also draws a grayscale
+    image of (at least) that many incompressible bytes, like a scan or photo in a real document.
+    """
+    objects = {}
+    font_id = 3
+    objects[font_id] = b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>'
+    next_id = 4
+    page_ids = []
+
+    image_id = None
+    if image_bytes:
+        side = int(image_bytes ** 0.5) + 1
+        image_id = next_id
+        next_id += 1
+        data = os.urandom(side * side)
+        objects[image_id] = (
+            f'<< /Type /XObject /Subtype /Image /Width {side} /Height {side} /ColorSpace /DeviceGray '
+            f'/BitsPerComponent 8 /Length {len(data)} >>\nstream\n'
+        ).encode('latin-1') + data + b'\nendstream'
+
+    for page in range(pages):
+        lines = [f'Page {page + 1} line {line + 1}: benchmark text for the extraction of document '
+                 f'{seed} with some words to lay out' for line in range(lines_per_page)]
+        content = _text_content(lines)
+        resources = f'/Font << /F1 {font_id} 0 R >>'
+        if image_id is not None and page == 0:
+            content += b'\nq 200 0 0 200 72 100 cm /Im1 Do Q'
+            resources += f' /XObject << /Im1 {image_id} 0 R >>'
+        content_id, page_id = next_id, next_id + 1
+        next_id += 2
+        objects[content_id] = f'<< /Length {len(content)} >>\nstream\n'.encode('latin-1') + content + b'\nendstream'
+        objects[page_id] = (f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+                            f'/Resources << {resources} >> /Contents {content_id} 0 R >>').encode('latin-1')
+        page_ids.append(page_id)
+
+    objects[1] = b'<< /Type /Catalog /Pages 2 0 R >>'
+    kids = ' '.join(f'{page_id} 0 R' for page_id in page_ids)
+    objects[2] = f'<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>'.encode('latin-1')
+
+    with open(path, 'wb') as f:
+        f.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        offsets = {}
+        for object_id in sorted(objects):
+            offsets[object_id] = f.tell()
+            f.write(f'{object_id} 0 obj\n'.encode('latin-1') + objects[object_id] + b'\nendobj\n')
+        xref_offset = f.tell()
+        f.write(f'xref\n0 {next_id}\n0000000000 65535 f \n'.encode('latin-1'))
+        for object_id in range(1, next_id):
+            f.write(f'{offsets[object_id]:010d} 00000 n \n'.encode('latin-1'))
+        f.write(f'trailer\n<< /Size {next_id} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n'.encode('latin-1'))
+
+# Runs the command with stdin/stdout redirected to files and reports its own child's peak RSS.
+# The launcher is a fresh small process: a child started directly from the benchmark process would
+# report the benchmark's own (large) memory high-water mark, because Linux keeps it across vfork/exec.
+LAUNCHER = """
+import json, os, subprocess, sys, time
+command, stdin_path, stdout_path = json.loads(sys.argv[1])
+start = time.perf_counter()
+with open(stdin_path or os.devnull, 'rb') as stdin, open(stdout_path, 'wb') as stdout:
+    process = subprocess.Popen(command, stdin=stdin, stdout=stdout, stderr=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+print(json.dumps({'exit_code': os.waitstatus_to_exitcode(status), 'seconds': time.perf_counter() - start,
+                  'peak_rss_mb': usage.ru_maxrss / 1024}))
+"""
+
+def run_measured(command, stdin_path=None, directory=None):
+    """Run a command and return (stdout bytes, wall seconds, peak RSS of that command in MB)."""
+    stdout_path = os.path.join(directory or tempfile.gettempdir(), 'extractor_output.txt')
+    launcher = subprocess.run([sys.executable, '-c', LAUNCHER, json.dumps([command, stdin_path, stdout_path])],
+                              capture_output=True, check=True, text=True)
+    measurement = json.loads(launcher.stdout)
+    if measurement['exit_code'] != 0:
+        raise RuntimeError(f"{' '.join(command)} exited with code {measurement['exit_code']}")
+    with open(stdout_path, 'rb') as f:
+        output = f.read()
+    os.unlink(stdout_path)
+    return output, measurement['seconds'], measurement['peak_rss_mb']
+
+def command_transport(args):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'large.pdf')
+        build_pdf(path, args.pages, image_bytes=args.size_mb * 1024 * 1024)
+        size_mb = os.path.getsize(path) / 1024 / 1024
+        # Input files for the stdin transports, written before any measurement
+        base64_path = os.path.join(directory, 'large.b64')
+        raw_path = os.path.join(directory, 'large.raw')
+        with open(path, 'rb') as f:
+            pdf_bytes = f.read()
+        with open(base64_path, 'wb') as f:
+            f.write(base64.b64encode(pdf_bytes))
+        with open(raw_path, 'wb') as f:
+            f.write(struct.pack('>I', len(pdf_bytes)))
+            f.write(pdf_bytes)
+        del pdf_bytes
+
+        cases = {
+            'base64': ([sys.executable, EXTRACTOR], base64_path),
+            'raw': ([sys.executable, EXTRACTOR, '--raw'], raw_path),
+            'file': ([sys.executable, EXTRACTOR, '--file', path], None),
+        }
+        # Baseline: interpreter with pdfminer imported, no document
+        _, _, baseline_rss = run_measured([sys.executable, '-c', 'import pdfminer.high_level, pdfminer.layout'],
+                                          directory=directory)
+
+        report = {'pdf_mb': round(size_mb, 1), 'pages': args.pages, 'baseline_rss_mb': round(baseline_rss, 1),
+                  'transports': {}}
+        texts = set()
+        for name in args.transports:
+            command, stdin_path = cases[name]
+            output, seconds, rss = run_measured(command, stdin_path, directory)
+            texts.add(output.decode('utf-8'))
+            report['transports'][name] = {'seconds': round(seconds, 2), 'peak_rss_mb': round(rss, 1),
+                                          'chars': len(output.decode('utf-8'))}
+            print(f"[INFO] {name}: {seconds:.2f} s, peak RSS {rss:.1f} MB", file=sys.stderr)
+        report['identical_text'] = len(texts) == 1
+
+    print(json.dumps(report, indent=2))
+
+def command_pages(args):
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    report = {'cores': cores, 'cases': []}
+    with tempfile.TemporaryDirectory() as directory:
+        for pages in args.pages:
+            path = os.path.join(directory, f'pages_{pages}.pdf')
+            build_pdf(path, pages, lines_per_page=args.lines_per_page)
+            sequential_text, sequential_seconds, _ = run_measured([sys.executable, EXTRACTOR, '--file', path],
+                                                                  directory=directory)
+            print(f"[INFO] {pages} pages sequential: {sequential_seconds:.2f} s", file=sys.stderr)
+            for workers in args.workers:
+                text, seconds, rss = run_measured(
+                    [sys.executable, EXTRACTOR, '--file', path, '--parallel', str(workers), '--min-pages', '0'],
+                    directory=directory
+                )
+                report['cases'].append({
+                    'pages': pages,
+                    'workers': workers,
+                    'sequential_seconds': round(sequential_seconds, 2),
+                    'parallel_seconds': round(seconds, 2),
+                    'speedup': round(sequential_seconds / seconds, 2),
+                    'identical_text': text == sequential_text
+                })
+                print(f"[INFO] {pages} pages, {workers} workers: {seconds:.2f} s "
+                      f"(speedup {sequential_seconds / seconds:.2f})", file=sys.stderr)
+    print(json.dumps(report, indent=2))
+
+def time_to_first_line(command):
+    """Seconds from the start of the command until its first stdout line arrives."""
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    process.stdout.readline()
+    first_line = time.perf_counter() - start
+    process.stdout.read()
+    process.wait()
+    return first_line
+
+def command_stream(args):
+    report = {'cases': []}
+    with tempfile.TemporaryDirectory() as directory:
+        for pages in args.pages:
+            path = os.path.join(directory, f'pages_{pages}.pdf')
+            build_pdf(path, pages, lines_per_page=args.lines_per_page)
+            text, buffered_seconds, buffered_rss = run_measured([sys.executable, EXTRACTOR, '--file', path],
+                                                                directory=directory)
+            stream_command = [sys.executable, EXTRACTOR, '--file', path, '--ndjson']
+            records, stream_seconds, stream_rss = run_measured(stream_command, directory=directory)
+            first_page = time_to_first_line(stream_command)
+            streamed = [json.loads(line) for line in records.decode('utf-8').splitlines()]
+            report['cases'].append({
+                'pages': pages,
+                'text_mb': round(len(text) / 1024 / 1024, 2),
+                'buffered_seconds': round(buffered_seconds, 2),
+                'stream_seconds': round(stream_seconds, 2),
+                'stream_first_page_seconds': round(first_page, 2),
+                'buffered_peak_rss_mb': round(buffered_rss, 1),
+                'stream_peak_rss_mb': round(stream_rss, 1),
+                'identical_text': ''.join(record['text'] for record in streamed) == text.decode('utf-8')
+            })
+            print(f"[INFO] {pages} pages: buffered {buffered_seconds:.2f} s, stream {stream_seconds:.2f} s "
+                  f"(first page after {first_page:.2f} s)", file=sys.stderr)
+    print(json.dumps(report, indent=2))
+
+def command_budget(args):
+    limits = ['--max-tokens', str(args.max_tokens)] if args.max_tokens else ['--max-chars', str(args.max_chars)]
+    report = {'limits': limits, 'cases': []}
+    with tempfile.TemporaryDirectory() as directory:
+        for pages in args.pages:
+            path = os.path.join(directory, f'pages_{pages}.pdf')
+            build_pdf(path, pages, lines_per_page=args.lines_per_page)
+            text, full_seconds, _ = run_measured([sys.executable, EXTRACTOR, '--file', path], directory=directory)
+            for extra_pages in args.extra_pages:
+                command = [sys.executable, EXTRACTOR, '--file', path, *limits, '--extra-pages', str(extra_pages)]
+                budget_text, seconds, _ = run_measured(command, directory=directory)
+                report['cases'].append({
+                    'pages': pages,
+                    'extra_pages': extra_pages,
+                    'full_seconds': round(full_seconds, 2),
+                    'budget_seconds': round(seconds, 2),
+                    'pages_extracted': budget_text.count(b'\f'),
+                    'prefix_of_full_text': text.startswith(budget_text)
+                })
+                print(f"[INFO] {pages} pages, {extra_pages} extra: {seconds:.2f} s "
+                      f"(full {full_seconds:.2f} s)", file=sys.stderr)
+    print(json.dumps(report, indent=2))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    transport_parser = subparsers.add_parser('transport', help='Peak RSS per input transport for a large PDF')
+    transport_parser.add_argument('--size-mb', type=int, default=100, help='Size of the embedded image in MB')
+    transport_parser.add_argument('--pages', type=int, default=5, help='Text pages in the document')
+    transport_parser.add_argument('--transports', nargs='+', default=['base64', 'raw', 'file'],
+                                  choices=['base64', 'raw', 'file'])
+    transport_parser.set_defaults(handler=command_transport)
+
+    pages_parser = subparsers.add_parser('pages', help='Page-parallel vs. sequential extraction')
+    pages_parser.add_argument('--pages', type=int, nargs='+', default=[50, 200, 500], help='Page counts')
+    pages_parser.add_argument('--workers', type=int, nargs='+', default=[2, 4, 8], help='Worker counts')
+    pages_parser.add_argument('--lines-per-page', type=int, default=40)
+    pages_parser.set_defaults(handler=command_pages)
+
+    stream_parser = subparsers.add_parser('stream', help='Per-page NDJSON output vs. whole text at the end')
+    stream_parser.add_argument('--pages', type=int, nargs='+', default=[50, 500], help='Page counts')
+    stream_parser.add_argument('--lines-per-page', type=int, default=40)
+    stream_parser.set_defaults(handler=command_stream)
+
+    budget_parser = subparsers.add_parser('budget', help='Early stop at an embedding budget vs. full extraction')
+    budget_parser.add_argument('--pages', type=int, nargs='+', default=[20, 100, 500], help='Page counts')
+    budget_parser.add_argument('--max-tokens', type=int, default=512)
+    budget_parser.add_argument('--max-chars', type=int, default=0, help='Character budget, used when --max-tokens is 0')
+    budget_parser.add_argument('--extra-pages', type=int, nargs='+', default=[0, 2])
+    budget_parser.add_argument('--lines-per-page', type=int, default=40)
+    budget_parser.set_defaults(handler=command_budget)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Erzeugt synthetische Eingabedaten für cluster.py: Dokument-Embeddings mit steuerbarer
+Cluster-Struktur, Ordner-Embeddings und eine doc_to_folder_map im selben Format,
+das modelClustering.runClustering an cluster.py übergibt.
+
+@author Lennart
+"""
+
+import numpy as np
+
+def generate_corpus(doc_count, folder_count, dim=768, cluster_count=None, cluster_spread=0.35,
+                    assigned_fraction=0.5, seed=0):
+    """
+    Generate a corpus with `cluster_count` Gaussian topics on the unit sphere.
+
+    Every folder is anchored to one topic; documents that are assigned to a folder
+    (`assigned_fraction` of them) are put into a folder of their own topic. Returns the
+    embeddings_data dict expected by cluster.run_clustering plus the ground-truth topics.
+    """
+    rng = np.random.default_rng(seed)
+    if cluster_count is None:
+        cluster_count = max(2, min(folder_count, int(np.sqrt(doc_count))))
+
+    centers = rng.standard_normal((cluster_count, dim)).astype(np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+
+    topics = rng.integers(0, cluster_count, size=doc_count)
+    noise = rng.standard_normal((doc_count, dim)).astype(np.float32)
+    noise *= cluster_spread / np.sqrt(dim)
+    doc_embeddings = centers[topics] + noise
+
+    folder_topics = np.arange(folder_count) % cluster_count
+    folder_noise = rng.standard_normal((folder_count, dim)).astype(np.float32)
+    folder_noise *= (cluster_spread / 2) / np.sqrt(dim)
+    folder_matrix = centers[folder_topics] + folder_noise
+    folder_ids = [str(1000 + idx) for idx in range(folder_count)]
+
+    # Folders grouped by topic, so assigned documents land in a folder of their own topic
+    folders_by_topic = {}
+    for folder_idx, topic in enumerate(folder_topics.tolist()):
+        folders_by_topic.setdefault(topic, []).append(folder_idx)
+
+    doc_to_folder_map = {}
+    if folder_count:
+        assigned = np.flatnonzero(rng.random(doc_count) < assigned_fraction)
+        for doc_idx in assigned.tolist():
+            candidates = folders_by_topic.get(int(topics[doc_idx]))
+            if candidates:
+                folder_idx = candidates[int(rng.integers(0, len(candidates)))]
+                doc_to_folder_map[str(doc_idx)] = folder_ids[folder_idx]
+
+    embeddings_data = {
+        'doc_embeddings': doc_embeddings,
+        'folder_embeddings': dict(zip(folder_ids, folder_matrix)),
+        'doc_to_folder_map': doc_to_folder_map
+    }
+    return embeddings_data, topics